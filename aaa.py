@@ -12,15 +12,28 @@ from urllib.parse import urlparse
 import bisect
 import threading
 import queue
+import itertools
+import contextlib
+import functools
+import marshal
+import zlib
+import lzma
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
 
 import agency
 import trie
+import pathindex
+import diskcache
+import sharding
+import engine
+import logtable
+import logstream
+import decompress
 from controls import *
 from client import *
 from history import History
 
-ARANGO_LOG_ZERO = "00000000000000000000"
-
 def format_ms_timestamp(ms):
     dt = datetime.datetime.utcfromtimestamp(ms/1000.0)
     return dt.isoformat(timespec='milliseconds') + "Z"
@@ -38,6 +51,21 @@ def decode_rev_timestamp(ref):
     ms, tick = decode_rev(ref)
     return f"{format_ms_timestamp(ms)}@{tick}"
 
+def snapshot_start(log, snapshot):
+    # The first log entry that is replayed on top of snapshot, which holds
+    # all entries up to its key. None if the log starts after the entry
+    # following it.
+    idx = log.lastAtOrBefore(snapshot["_key"])
+    if idx is None:
+        if len(log) > 0 and int(log.key(0)) == int(snapshot["_key"]) + 1:
+            return 0
+        return None
+    return idx + 1
+
+def snapshot_tree(snapshot):
+    # the agency of a compaction
+    return snapshot["readDB"][0]
+
 class HighlightCommand:
     def __init__(self, color, clear, save, regex, expr, only_path):
         self.color = color
@@ -52,6 +80,7 @@ class AgencyLogList(Control):
     FILTER_NONE = 0
     FILTER_GREP = 1
     FILTER_REGEX = 2
+    FILTER_PATH = 3
 
     def __init__(self, app, rect, args):
         super().__init__(app, rect)
@@ -72,7 +101,10 @@ class AgencyLogList(Control):
         self.highlight_history = History()
 
     def title(self):
-        return "Agency Log"
+        progress = self.app.provider.loadProgress()
+        if progress is None:
+            return "Agency Log"
+        return "Agency Log (loading {:.0%})".format(progress)
 
     def serialize(self):
         return {
@@ -102,6 +134,8 @@ class AgencyLogList(Control):
             self.grep(self.filterStr)
         elif self.filterType == AgencyLogList.FILTER_REGEX:
             self.regexp(self.filterStr)
+        elif self.filterType == AgencyLogList.FILTER_PATH:
+            self.history(self.filterStr)
         else:
             raise NotImplementedError()
 
@@ -174,11 +208,12 @@ class AgencyLogList(Control):
             y = self.rect.y + i
             x = self.rect.x
             if not idx == None:
-                ent = self.app.log[idx]
+                log = self.app.log
+                ent = log[idx]
 
                 is_selected = idx == self.getSelectedIndex()
 
-                text = " ".join(x for x in ent["request"])
+                text = " ".join(log.requestPaths(idx))
                 if "epoch_millis" in ent:
                     ts = format_ms_timestamp(ent["epoch_millis"])
                 else:
@@ -190,8 +225,8 @@ class AgencyLogList(Control):
                 if is_selected:
                     attr |= curses.A_STANDOUT | curses.A_UNDERLINE
                 colors = self.__get_line_highlight(idx)
-                if not self.app.snapshot is None and not self.app.log[0]["_key"] == ARANGO_LOG_ZERO:
-                    if ent["_key"] < self.app.snapshot["_key"]:
+                if not self.app.snapshot is None and not log.key(0) == logtable.ARANGO_LOG_ZERO:
+                    if log.key(idx) < self.app.snapshot["_key"]:
                         attr |= curses.A_DIM
                 if len(colors) == 0:
                     self.app.stdscr.addnstr(y, x, msg, maxlen, attr)
@@ -214,8 +249,8 @@ class AgencyLogList(Control):
         if idx in self.marked:
             return [ColorFormat.MARKING_ATTR_LIST[self.marked[idx]]]
 
-        ent_string = json.dumps(self.app.log[idx])
-        ent_paths = " ".join(x for x in self.app.log[idx]["request"])
+        ent_string = self.app.log.text(idx)
+        ent_paths = " ".join(self.app.log.requestPaths(idx))
 
         colors = {
             "r": ColorFormat.MARKING_ATTR_LIST[0],
@@ -238,9 +273,10 @@ class AgencyLogList(Control):
 
         return active
 
-    def filter(self, predicate):
+    def filter(self, predicate, matches=None):
         # Make sure that the highlighted entry is the previously selected
-        # entry or the closest entry above that one.
+        # entry or the closest entry above that one. matches are the indexes
+        # predicate is true for, if the engine filtered the log already.
         lastHighlighted = self.__getIndex(self.highlight)
         if lastHighlighted == None:
             lastHighlighted = 0
@@ -248,12 +284,21 @@ class AgencyLogList(Control):
         self.list = []
         self.highlight = 0
         self.last_predicate = predicate
-        for i, e in enumerate(self.app.log):
-            match = predicate(e)
-            if match:
-                if i <= lastHighlighted:
-                    self.highlight = len(self.list)
-                self.list.append(i)
+        if matches is None:
+            matches = (i for i in range(len(self.app.log)) if predicate(i))
+        for i in matches:
+            if i <= lastHighlighted:
+                self.highlight = len(self.list)
+            self.list.append(i)
+
+    @staticmethod
+    def regexpPredicate(log, regexStr):
+        pattern = re.compile(regexStr)
+        return lambda i: any(not pattern.search(path) == None for path in log.requestPaths(i))
+
+    @staticmethod
+    def grepPredicate(log, string):
+        return lambda i: string in log.text(i)
 
     def regexp(self, regexStr):
         self.reset()
@@ -264,22 +309,36 @@ class AgencyLogList(Control):
         # try to compile the regex
         self.filterStr = regexStr
 
-        pattern = re.compile(regexStr)
-        predicate = lambda e: any(not pattern.search(path) == None for path in e["request"])
+        log = self.app.log
+        predicate = AgencyLogList.regexpPredicate(log, regexStr)
 
         self.filterType = AgencyLogList.FILTER_REGEX
-        self.filter(predicate)
+        self.filter(predicate, log.regexp(regexStr) if isinstance(log, RemoteLog) else None)
 
     def grep(self, string):
         self.reset()
         if not string:
             return
 
-        predicate = lambda e: string in json.dumps(e)
+        log = self.app.log
+        predicate = AgencyLogList.grepPredicate(log, string)
 
         self.filterStr = string
         self.filterType = AgencyLogList.FILTER_GREP
-        self.filter(predicate)
+        self.filter(predicate, log.grep(string) if isinstance(log, RemoteLog) else None)
+
+    def history(self, pathStr):
+        # show only entries that can change the value at the path
+        self.reset()
+        if pathStr is None:
+            return
+
+        path = agency.AgencyStore.parsePath(pathStr)
+        lastHighlighted = self.highlight
+        self.list = self.app.getPathIndex().changes(agency.AgencyStore.pathPrefix(path))
+        self.highlight = max(0, bisect.bisect_right(self.list, lastHighlighted) - 1)
+        self.filterStr = "/" + "/".join(path)
+        self.filterType = AgencyLogList.FILTER_PATH
 
     def reset(self):
         # get the current index to keep the selected entry
@@ -292,8 +351,23 @@ class AgencyLogList(Control):
         self.last_predicate = None
 
     def filter_new_entries(self, new_entries):
+        # only the appended entries are filtered, the list before them is kept
+        if self.filterType == AgencyLogList.FILTER_NONE:
+            return
+        start = len(self.app.log) - len(new_entries)
+        if self.filterType == AgencyLogList.FILTER_PATH:
+            path = agency.AgencyStore.parsePath(self.filterStr)
+            self.list.extend(self.app.getPathIndex().changes(agency.AgencyStore.pathPrefix(path), start))
+            return
+        self.list.extend(i for i in range(start, len(self.app.log)) if self.last_predicate(i))
+
+    def refilter(self):
+        # filters the whole log again, after it was reordered
         if self.filterType == AgencyLogList.FILTER_NONE:
             return
+        elif self.filterType == AgencyLogList.FILTER_PATH:
+            self.history(self.filterStr)
+            return
         self.filter(self.last_predicate)
 
     def highlight_entries(self, string):
@@ -395,17 +469,17 @@ class AgencyLogList(Control):
 
     def selectClosest(self, idx):
         if not self.list == None:
-            for i in self.list:
-                if i <= idx:
-                    self.highlight = i
-                    self.top = i
+            # the list is sorted, select the position of the last index <= idx
+            pos = max(0, bisect.bisect_right(self.list, idx) - 1)
+            self.highlight = pos
+            self.top = pos
         else:
             self.highlight = idx
             self.top = idx
 
     def goto(self, idx):
         # get global index of first log entry
-        startgidx = int(self.app.log[0]["_key"])
+        startgidx = int(self.app.log.key(0))
         self.selectClosest(idx - startgidx)
 
     @staticmethod
@@ -489,7 +563,7 @@ class AgencyLogView(LineView):
         self.head = None
 
     def title(self):
-        key = self.app.log[self.idx]['_key'] if not self.idx == None else ""
+        key = self.app.log.key(self.idx) if not self.idx == None else ""
         return "Agency Log View {}".format(key)
 
     def serialize(self):
@@ -542,69 +616,876 @@ class AgencyLogView(LineView):
         self.idx = idx
 
 
-class StoreCache:
+class ColdStore:
+    # A checkpoint as compressed blob, inflated into a new store whenever it
+    # is used. Unlike the live checkpoints it shares nothing, but a marshal
+    # dump of a store compresses to a fraction of its live size.
+
+    def __init__(self, store, live, compress, decompress):
+        raw = marshal.dumps((store.store, store.ttl.deadlines))
+        self.size = len(raw)
+        self.blob = compress(raw)
+        self.decompress = decompress
+        self.cost = sys.getsizeof(self.blob)
+        # estimated bytes of the inflated store
+        self.live = live
+        # number of DeltaStores based on this one
+        self.deltas = 0
+
+    def load(self):
+        # the tree and ttl deadlines, not shared with anything
+        return marshal.loads(self.decompress(self.blob))
+
+    def inflate(self, tree, deadlines):
+        # a store on the tree and deadlines returned by load, which it only
+        # copies on write
+        return diskcache.storeFromParts(tree, deadlines)
+
+
+class DeltaStore:
+    # A checkpoint as compressed difference to a ColdStore, its base. Most of
+    # the tree (e.g. Plan) rarely changes, so a delta is a small fraction of
+    # a full blob. It is inflated on top of the inflated base, copying only
+    # the paths that differ from it.
+
+    def __init__(self, base, raw, compress):
+        # raw is the marshal dump of the delta records and ttl deadlines
+        self.base = base
+        self.size = base.size
+        self.blob = compress(raw)
+        self.cost = sys.getsizeof(self.blob)
+
+    def inflate(self, tree):
+        # tree is the tree of the base, it is only copied on write
+        delta, deadlines = marshal.loads(self.base.decompress(self.blob))
+        store = diskcache.storeFromParts(tree, deadlines)
+        store.writeDelta(delta)
+        return store
+
+
+COLD_COMPRESSION = {
+    "zlib": (functools.partial(zlib.compress, level=1), zlib.decompress),
+    "lzma": (functools.partial(lzma.compress, preset=0), lzma.decompress),
+    "none": None,
+}
 
-    def __init__(self, maxSize):
-        self.maxSize = maxSize
-        self.cache = dict()
-        self.list = list()
-        self.indexes = list()
 
-    def refresh(self, idx):
-        try:
-            self.list.remove(idx)
-        except:
-            pass
-        self.list.append(idx)
+class StoreCache:
+    # LRU cache of stores or plain json values by log index, limited by the
+    # estimated number of bytes it keeps alive. Cached stores share most of
+    # their nodes, so every node is accounted once, with a count of the
+    # cached values and nodes referring to it. The cost of an entry is the
+    # number of bytes that were new when it was added.
+    #
+    # Eviction looks at the least recently used entries and picks the most
+    # expensive one among them. With compression, live stores are replaced
+    # by a ColdStore if that is cheaper, other entries are only dropped if
+    # there is no live store left to freeze. Cold entries are live again
+    # once they are used, except for the bases of deltas. Cold stores close
+    # to a ColdStore are kept as DeltaStore against it, unless the
+    # uncompressed delta is larger than MAX_DELTA of the uncompressed base.
+    #
+    # The tree of the last base used is kept inflated and accounted with the
+    # size of the store it was made of. Stores inflated from it or its deltas
+    # share its nodes.
+    EVICTION_CANDIDATES = 8
+    MAX_DELTA = 0.25
+
+    def __init__(self, budget, compression=None):
+        self.budget = budget
+        # (compress, decompress) of cold stores, see COLD_COMPRESSION
+        self.compression = compression
+        # idx -> (value, cost, roots), least recently used first
+        self.cache = OrderedDict()
+        self.indexes = list()
+        # id of a node -> references and id of a node -> size, two dicts of
+        # plain ints are not tracked by the garbage collector
+        self.references = dict()
+        self.sizes = dict()
+        self.resident = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cold = 0
+        self.deltas = 0
+        self.inflations = 0
+        # indexes of the ColdStores, the bases of deltas
+        self.bases = list()
+        # (base, tree, deadlines) of the last base used, consecutive
+        # evictions and inflations are mostly close to each other and load
+        # the base only once, see loadBase
+        self.baseTree = None
+        # cost of the last cold store, stores cheaper than that stay live
+        self.lastColdCost = 0
+
+    def roots(value):
+        if isinstance(value, agency.AgencyStore):
+            return [value.store, value.ttl.deadlines, value.ttl.heap]
+        return [value]
+
+    def acquire(self, roots):
+        # adds a reference to each of roots, returns the number of new bytes
+        added = 0
+        references = self.references
+        stack = list(roots)
+        while len(stack) > 0:
+            node = stack.pop()
+            count = references.get(id(node))
+            if count is not None:
+                references[id(node)] = count + 1
+                continue
+            size = sys.getsizeof(node)
+            if isinstance(node, dict):
+                size += sum(sys.getsizeof(k) for k in node)
+                children = node.values()
+            else:
+                children = node
+            for x in children:
+                if isinstance(x, (dict, list)):
+                    stack.append(x)
+                else:
+                    size += sys.getsizeof(x)
+            references[id(node)] = 1
+            self.sizes[id(node)] = size
+            added += size
+        self.resident += added
+        return added
+
+    def release(self, roots):
+        stack = list(roots)
+        while len(stack) > 0:
+            node = stack.pop()
+            count = self.references[id(node)] - 1
+            if count > 0:
+                self.references[id(node)] = count
+                continue
+            del self.references[id(node)]
+            self.resident -= self.sizes.pop(id(node))
+            stack.extend(x for x in (node.values() if isinstance(node, dict) else node)
+                         if isinstance(x, (dict, list)))
+
+    def size(self, roots):
+        # bytes of the nodes of a cached value, nodes it refers to more than
+        # once are counted each time
+        total = 0
+        stack = list(roots)
+        while len(stack) > 0:
+            node = stack.pop()
+            total += self.sizes[id(node)]
+            stack.extend(x for x in (node.values() if isinstance(node, dict) else node)
+                         if isinstance(x, (dict, list)))
+        return total
 
     def get(self, idx):
-        if idx in self.cache:
-            self.refresh(idx)
-            return self.cache[idx]
-        return None
+        entry = self.cache.get(idx)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(idx)
+        value = entry[0]
+        if isinstance(value, DeltaStore) or (isinstance(value, ColdStore) and value.deltas == 0):
+            # used again, it stays live until it is evicted once more
+            store = self.thaw(value)
+            self.set(idx, store)
+            return store
+        return self.thaw(value)
 
     def has(self, idx):
         return idx in self.cache
 
+    def peek(self, idx):
+        # like get, but neither counted nor refreshed
+        return self.thaw(self.cache[idx][0])
+
+    def thaw(self, value):
+        if isinstance(value, ColdStore):
+            self.inflations += 1
+            return value.inflate(*self.loadBase(value))
+        if isinstance(value, DeltaStore):
+            self.inflations += 1
+            return value.inflate(self.loadBase(value.base)[0])
+        return value
+
+    def loadBase(self, base):
+        # the tree and deadlines of the ColdStore base, which must not be
+        # modified
+        if self.baseTree is None or self.baseTree[0] is not base:
+            self.dropBase()
+            tree, deadlines = base.load()
+            self.baseTree = (base, tree, deadlines)
+            self.resident += base.live
+        return self.baseTree[1:]
+
+    def dropBase(self):
+        if self.baseTree is not None:
+            self.resident -= self.baseTree[0].live
+            self.baseTree = None
+
+    def freeze(self, idx):
+        # replaces the store at idx by a cold one, if that saves memory
+        value, cost, roots = self.cache[idx]
+        if self.compression is None or not isinstance(value, agency.AgencyStore) or cost <= self.lastColdCost:
+            return False
+        cold = self.delta(idx, value)
+        if cold is None:
+            cold = ColdStore(value, self.size(roots), *self.compression)
+        self.lastColdCost = cold.cost
+        if cold.cost >= cost:
+            return False
+        if isinstance(cold, DeltaStore):
+            cold.base.deltas += 1
+            self.deltas += 1
+        else:
+            bisect.insort_left(self.bases, idx)
+        # keeps its place in the lru order
+        self.cache[idx] = (cold, cold.cost, ())
+        self.release(roots)
+        self.resident += cold.cost
+        self.cold += 1
+        return True
+
+    def delta(self, idx, store):
+        # a DeltaStore of store against the closest base, None if there is no
+        # base or the delta is not small enough
+        i = bisect_left(self.bases, idx)
+        closest = min(self.bases[max(i - 1, 0):i + 1], key=lambda base: abs(base - idx), default=None)
+        if closest is None:
+            return None
+        base = self.cache[closest][0]
+        tree, _ = self.loadBase(base)
+        # decided before compressing, so deltas that are too large cost no
+        # compression
+        raw = marshal.dumps((agency.AgencyStore.delta(tree, store.store), store.ttl.deadlines))
+        if len(raw) > base.size * StoreCache.MAX_DELTA:
+            return None
+        return DeltaStore(base, raw, self.compression[0])
+
     def closest(self, idx):
         i = bisect_left(self.indexes, idx)
         if i == 0:
             return None
         return self.indexes[i - 1]
 
+    def remove(self, idx):
+        # returns the number of entries removed, a base takes its deltas along
+        value, cost, roots = self.cache.pop(idx)
+        removed = 1
+        del self.indexes[bisect_left(self.indexes, idx)]
+        if isinstance(value, (ColdStore, DeltaStore)):
+            self.resident -= cost
+        else:
+            self.release(roots)
+        if isinstance(value, ColdStore):
+            self.cold -= 1
+            del self.bases[bisect_left(self.bases, idx)]
+            if self.baseTree is not None and self.baseTree[0] is value:
+                self.dropBase()
+            if value.deltas > 0:
+                # its deltas are of no use without it
+                for delta in [i for i, (v, _, _) in self.cache.items() if isinstance(v, DeltaStore) and v.base is value]:
+                    removed += self.remove(delta)
+        elif isinstance(value, DeltaStore):
+            self.cold -= 1
+            self.deltas -= 1
+            value.base.deltas -= 1
+        return removed
+
     def set(self, idx, store):
-        self.refresh(idx)
-        if len(self.list) > self.maxSize:
-            oldIdx = self.list.pop(0)
-            try:
-                self.indexes.remove(oldIdx)
-            except:
-                pass
-            del self.cache[oldIdx]
-        self.cache[idx] = store
+        if idx in self.cache:
+            self.remove(idx)
+        roots = StoreCache.roots(store)
+        self.cache[idx] = (store, self.acquire(roots), roots)
         bisect.insort_left(self.indexes, idx)
 
+        # the entry just added is kept in any case
+        while self.resident > self.budget and len(self.cache) > 1:
+            victim = self.victim(True) if self.compression is not None else None
+            if victim is not None and self.freeze(victim):
+                continue
+            if victim is None:
+                victim = self.victim(False)
+            self.evictions += self.remove(victim)
+
+    def victim(self, live):
+        # the entry to evict next among the least recently used ones but the
+        # last, only live stores if live is set, None if there is none
+        candidates = itertools.islice(self.cache.items(), len(self.cache) - 1)
+        if live:
+            candidates = (entry for entry in candidates if isinstance(entry[1][0], agency.AgencyStore))
+        candidates = [idx for idx, _ in itertools.islice(candidates, StoreCache.EVICTION_CANDIDATES)]
+        return max(candidates, key=self.evictionScore, default=None)
+
+    def evictionScore(self, idx):
+        # Bytes freed per entry of the gap that the eviction leaves. Entries
+        # close to their neighbours are cheap to replace by replaying. Bases
+        # go last, dropping them drops their deltas as well.
+        value, cost, _ = self.cache[idx]
+        if isinstance(value, ColdStore) and value.deltas > 0:
+            return 0
+        i = bisect_left(self.indexes, idx)
+        prev = self.indexes[i - 1] if i > 0 else 0
+        next = self.indexes[i + 1] if i + 1 < len(self.indexes) else idx
+        return cost / (next - prev + 1)
+
+    def stats(self):
+        return "{} entries ({} cold, {} deltas), {:.1f} of {:.0f} MB resident, {} hits, {} misses, {} evicted, " \
+            "{} inflated".format(len(self.cache), self.cold, self.deltas, self.resident / 2**20, self.budget / 2**20,
+                                 self.hits, self.misses, self.evictions, self.inflations)
+
+
+class FixedCheckpoints:
+    # Every 5000th entry, and every 200th and 1000th entry close to the
+    # target of the replay.
+
+    def visit(self, idx, length):
+        pass
+
+    def place(self, cache, i, idx, cost, elapsed):
+        # Whether to checkpoint the store after replaying entry i on the way
+        # to idx. cost is the time entry i took, elapsed the replay time
+        # since the previous checkpoint.
+        if i % 5000 == 0:
+            return True
+        didx = idx - i
+        if didx < 500:
+            return didx % 200 == 0
+        elif didx < 2500:
+            return didx % 1000 == 0
+        return False
+
+
+class AdaptiveCheckpoints:
+    # Places a checkpoint whenever replaying since the previous one took
+    # longer than the seek latency allowed at that point of the log. Cheap
+    # entries like heartbeats thus get sparse checkpoints, expensive merges
+    # dense ones. Parts of the log that are visited often get a smaller
+    # allowance. Stepping back close to the target is served by undo
+    # records, so it needs no special treatment.
+    #
+    # The checkpoints that fit into the cache have to cover the whole log,
+    # otherwise they evict each other. So the allowance is never smaller
+    # than the time to replay the log divided by that number, but it never
+    # exceeds the latency either: a replay of more than that always gets a
+    # checkpoint. A cache too small for those is paid with evictions.
+    BUCKET_SIZE = 1024
+    MAX_DENSITY = 8
+
+    def __init__(self, latency=0.04):
+        self.latency = latency
+        # number of visits per bucket of the log
+        self.visits = dict()
+        self.length = 0
+        # measured replay time
+        self.seconds = 0
+        self.entries = 0
+
+    def visit(self, idx, length):
+        bucket = idx // AdaptiveCheckpoints.BUCKET_SIZE
+        self.visits[bucket] = self.visits.get(bucket, 0) + 1
+        self.length = length
+
+    def allowance(self, cache, i):
+        visits = self.visits.get(i // AdaptiveCheckpoints.BUCKET_SIZE, 0)
+        allowed = self.latency / min(1 + visits, AdaptiveCheckpoints.MAX_DENSITY)
+        if cache.resident > 0 and self.entries > 0:
+            fitting = cache.budget / (cache.resident / len(cache.cache))
+            allowed = min(max(allowed, self.seconds / self.entries * self.length / fitting), self.latency)
+        return allowed
+
+    def place(self, cache, i, idx, cost, elapsed):
+        self.seconds += cost
+        self.entries += 1
+        return elapsed >= self.allowance(cache, i)
+
+
+CHECKPOINT_POLICIES = {
+    "adaptive": AdaptiveCheckpoints,
+    "fixed": FixedCheckpoints,
+}
+
+
+class Coverage:
+    # union of closed intervals of log indexes
+
+    def __init__(self):
+        # sorted and disjoint (begin, end) pairs
+        self.intervals = []
+
+    def add(self, begin, end):
+        i = bisect.bisect_left(self.intervals, (begin, begin))
+        # merge with the previous interval, if they touch
+        if i > 0 and self.intervals[i - 1][1] >= begin - 1:
+            i -= 1
+            begin = self.intervals[i][0]
+        j = i
+        while j < len(self.intervals) and self.intervals[j][0] <= end + 1:
+            end = max(end, self.intervals[j][1])
+            j += 1
+        self.intervals[i:j] = [(begin, end)]
+
+    def missing(self, begin, end):
+        # the parts of [begin, end] that are not covered
+        result = []
+        i = max(0, bisect.bisect_right(self.intervals, (begin, begin)) - 1)
+        for b, e in self.intervals[i:]:
+            if b > end:
+                break
+            if b > begin:
+                result.append((begin, b - 1))
+            begin = max(begin, e + 1)
+        if begin <= end:
+            result.append((begin, end))
+        return result
+
 
 class StoreUpdateResult:
     OK = 0
     UPDATE_JSON = 1
     NO_SNAPSHOT = 2
     NOT_COVERED = 3
+    # only from StoreProvider.request and a cancelled updateIndex
+    PENDING = 4
+    FAILED = 5
+
+
+class Replay:
+    # a replay that is done a slice at a time
+
+    def __init__(self, start, end, store, listDepth):
+        self.start = start
+        self.next = start
+        self.end = end
+        self.store = store
+        self.listDepth = listDepth
+        # replay time since the last checkpoint
+        self.elapsed = 0
 
 
 class StoreProvider:
+    # undo records are kept for the last entries of each replay, so that
+    # stepping backwards reverts entries instead of replaying from a checkpoint
+    UNDO_WINDOW = 1000
+    UNDO_LIMIT = 5000
+
+    # Without requests, the worker builds checkpoints in slices of at most
+    # PREFETCH_SLICE seconds, up to PREFETCH_RANGE entries around the
+    # selected one. Entries behind the selection come first, since stepping
+    # backwards can not continue the last replay.
+    PREFETCH_RANGE = 10000
+    PREFETCH_SLICE = 0.02
+
+    # the target of a replay that took longer than this many seconds is
+    # always written to the disk cache
+    DISK_REPLAY = 1.0
+
+    # the agency state of a dump is verified by replaying at most this many
+    # log entries before it
+    STATE_VERIFY_ENTRIES = 20000
+
+    # with --sharded, replays of more entries than this are sharded, except
+    # for the undo window
+    SHARDED_MIN = 20000
+
+    # relation of a log entry to the scope, cached per entry
+    SCOPE_UNKNOWN = 0
+    SCOPE_OUTSIDE = 1
+    SCOPE_INSIDE = 2
+    SCOPE_PARENT = 3
+    SCOPE_MIXED = 4
+
     def __init__(self, app, rect):
         self.app = app
         self.store = None
-        self.cache = StoreCache(512)
+        self.cache = StoreCache(app.args.cache_mb * 2**20, COLD_COMPRESSION[app.args.cold_checkpoints])
+        self.fullCache = self.cache
+        # checkpoints of earlier sessions, see setDiskCache
+        self.disk = None
+        # compactions as seeds that are never evicted, see setSnapshots
+        self.seedStarts = []
+        self.seeds = []
+        # (index, verified) of the agency state of a dump, see setAgencyState
+        self.agencyState = None
+        self.checkpoints = CHECKPOINT_POLICIES[app.args.checkpoints]()
+        self.sharded = sharding.ShardedReplay() if app.args.sharded else None
+        self.undo = dict()
         self.lastIdx = None
         self.lastWasCopy = False
         self.rect = rect
+        # if set, only the subtree below this path is replayed
+        self.scope = None
+        self.scopeString = None
+        self.scopeListDepth = None
+        self.scopeRelations = bytearray()
+        # parts of the log replayed with the current policy and cache
+        self.coverage = Coverage()
+        self.coverageEvictions = 0
+        self.prefetchCenter = None
+        self.prefetchRanges = []
+        self.prefetchReplay = None
+        self.prefetching = False
+        # Once started, the worker thread owns everything above while it
+        # holds lock, as well as the log of the app and what is derived from
+        # it, e.g. compiled programs and the path index. The ui thread only
+        # talks to it through request and idle, and pauses it to change the
+        # replay state or the log.
+        self.worker = None
+        self.lock = threading.RLock()
+        self.interrupted = False
+        self.requests = threading.Condition()
+        self.wanted = None
+        self.results = dict()
+        self.status = None
+        self.notified = False
+        # the store of the last completed request, for the views
+        self.current = None
+
+    def reload(self):
+        # the app loaded a new log
+        self.resetPrefetch()
+        self.dropResults()
+        self.setDiskCache(self.app.openDiskCache())
+        self.setSnapshots(self.app.snapshots)
+        state = self.app.provider.agencyState()
+        if state is not None:
+            self.setAgencyState(*state)
+
+    def setScope(self, path):
+        scope = tuple(path) if path else None
+        if scope == self.scope:
+            return
+        with self.paused():
+            self.scope = scope
+            self.scopeString = agency.AgencyStore.pathPrefix(scope) if scope is not None else None
+            self.scopeRelations = bytearray(len(self.app.log or ()))
+            # stores of different scopes can not be mixed, full stores however
+            # are a valid starting point for every scope
+            self.cache = self.fullCache if scope is None else StoreCache(self.fullCache.budget, self.fullCache.compression)
+            self.undo = dict()
+            self.store = None
+            self.lastIdx = None
+            self.lastWasCopy = False
+            self.resetPrefetch()
+            self.dropResults()
+
+    def dropCheckpoints(self):
+        # the log was reordered, nothing replayed so far is valid anymore
+        with self.paused():
+            self.fullCache = StoreCache(self.fullCache.budget, self.fullCache.compression)
+            self.cache = self.fullCache if self.scope is None else StoreCache(self.fullCache.budget,
+                                                                               self.fullCache.compression)
+            self.scopeRelations = bytearray()
+            self.undo = dict()
+            self.store = None
+            self.lastIdx = None
+            self.lastWasCopy = False
+            self.resetPrefetch()
+            self.dropResults()
+
+    def setDiskCache(self, disk):
+        with self.paused():
+            self.disk = disk
+
+    def setSnapshots(self, snapshots):
+        # Every compaction is a store that is there for free. Seeds are kept
+        # as sorted list of the first entry replayed on top of each one, i.e.
+        # the first one that is not contained in it. Their trees are only
+        # read once they are used, compactions of a log container are
+        # loaded then.
+        with self.paused():
+            self.seedStarts = []
+            self.seeds = []
+            self.agencyState = None
+            self.undo = dict()
+            for snapshot in snapshots:
+                start = snapshot_start(self.app.log or logtable.LogTable(), snapshot)
+                if start is not None:
+                    self.addSeed(start, functools.partial(snapshot_tree, snapshot))
+
+    def addSeed(self, start, tree):
+        # replays after start begin with a different store from now on, tree
+        # may be a function returning it
+        self.undo = dict()
+        pos = bisect.bisect_right(self.seedStarts, start)
+        self.seedStarts.insert(pos, start)
+        self.seeds.insert(pos, tree)
+
+    def snapshotSeed(self, idx):
+        # the latest seed to replay idx from, as (start, tree)
+        pos = bisect.bisect_right(self.seedStarts, idx + 1)
+        if pos == 0:
+            return None
+        if callable(self.seeds[pos - 1]):
+            self.seeds[pos - 1] = self.seeds[pos - 1]()
+        return self.seedStarts[pos - 1], self.seeds[pos - 1]
+
+    def setAgencyState(self, index, tree):
+        # The agency state of a dump is the state after the log entry with
+        # key index. It is a seed for the end of the log, if it agrees with
+        # the entries before it. It has no ttl schedule, like compactions.
+        with self.paused():
+            log = self.app.log or logtable.LogTable()
+            key = logtable.LogTable.KEY_FORMAT.format(index)
+            idx = log.lastAtOrBefore(key)
+            verified = idx is not None and log.key(idx) == key and self.verifyState(idx, tree)
+            self.agencyState = (key, verified)
+            if verified:
+                self.addSeed(idx + 1, tree)
+
+    def verifyState(self, idx, tree):
+        # Replays the entries up to idx from the closest compaction or full
+        # checkpoint and compares the result with tree. Fails if that is more
+        # than STATE_VERIFY_ENTRIES away, the state would not save much then.
+        log = self.app.log
+        start, store = None, None
+        if log.key(0) == logtable.ARANGO_LOG_ZERO:
+            start, store = 0, agency.AgencyStore()
+        seed = self.snapshotSeed(idx)
+        if seed is not None and (start is None or seed[0] > start):
+            start, store = seed[0], agency.AgencyStore(seed[1])
+        self.loadCheckpoint(idx + 1, start)
+        closest = self.fullCache.closest(idx + 1)
+        if closest is not None and start is not None and closest + 1 > start:
+            start, store = closest + 1, agency.AgencyStore.copyFrom(self.fullCache.peek(closest))
+        if start is None or idx + 1 - start > StoreProvider.STATE_VERIFY_ENTRIES:
+            return False
+        try:
+            for i in range(start, idx + 1):
+                store.run(self.app.logProgram(i), self.app.logTimes[i])
+        except Exception:
+            return False
+        return store.store == tree
+
+    def seedStats(self):
+        msg = "{} seeds".format(len(self.seeds))
+        if self.agencyState is not None:
+            msg += ", agency state at {} {}".format(self.agencyState[0],
+                                                     "used" if self.agencyState[1] else "does not match the log")
+        return msg
+
+    def checkpoint(self, i, store, persist=False):
+        # store is not modified anymore, full stores are kept for later
+        # sessions as well
+        self.cache.set(i, store)
+        if self.disk is not None and self.cache is self.fullCache:
+            if self.disk.wants(i, len(self.app.log)) or (persist and not self.disk.closest(i + 1) == i):
+                self.disk.save(i, store)
+
+    def loadCheckpoint(self, idx, start):
+        # Loads the last checkpoint of an earlier session before idx into the
+        # cache, if a replay that starts with entry start can skip entries
+        # with it.
+        if self.disk is None or start is None:
+            return
+        closest = self.disk.closest(idx)
+        if closest is None or closest < start:
+            return
+        for cache in [self.cache, self.fullCache]:
+            known = cache.closest(idx)
+            if known is not None and known >= closest:
+                return
+        store = self.disk.load(closest)
+        if store is not None:
+            self.fullCache.set(closest, store)
+
+    def start(self):
+        # from now on, requested stores are replayed on a worker thread
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def close(self):
+        # stops the processes of sharded replays, the app is done
+        with self.paused():
+            if self.sharded is not None:
+                self.sharded.close()
+
+    @contextlib.contextmanager
+    def paused(self):
+        # stops the worker at the next log entry, for changing the replay state
+        self.interrupted = True
+        with self.lock:
+            self.interrupted = False
+            yield
+
+    def dropResults(self):
+        with self.requests:
+            self.results = dict()
+            self.requests.notify()
+
+    def request(self, indexes):
+        # Returns (result, store) for each of the indexes, if the worker has
+        # them ready. Otherwise the worker is asked for them instead of any
+        # older request, None is returned and a StoreUpdateEvent is queued
+        # once something changed.
+        indexes = tuple(indexes)
+        with self.requests:
+            if all(idx in self.results for idx in indexes):
+                results = [self.results[idx] for idx in indexes]
+                self.current = results[-1][1] if results[-1][0] == StoreUpdateResult.UPDATE_JSON else None
+                return results
+            if not self.wanted == indexes:
+                self.wanted = indexes
+                self.requests.notify()
+            return None
+
+    def work(self):
+        while True:
+            with self.requests:
+                while True:
+                    wanted = self.wanted
+                    missing = [idx for idx in wanted or () if idx not in self.results]
+                    if len(missing) > 0 or (self.prefetching and wanted is not None):
+                        break
+                    self.requests.wait()
+            with self.lock:
+                if len(missing) > 0:
+                    self.serve(wanted, missing)
+                elif self.app.args.prefetch:
+                    self.prefetching = self.prefetch(wanted[-1], lambda: self.cancelled(wanted))
+                else:
+                    self.prefetching = False
+
+    def cancelled(self, wanted):
+        return self.interrupted or not self.wanted == wanted
 
-    def updateIndex(self, idx):
+    def serve(self, wanted, missing):
+        self.status = None
+        for idx in missing:
+            try:
+                result = self.updateIndex(idx, lambda: self.cancelled(wanted))
+                if result == StoreUpdateResult.PENDING:
+                    return
+                if result == StoreUpdateResult.OK:
+                    result = StoreUpdateResult.UPDATE_JSON
+                value = agency.AgencyStore.copyFrom(self.store) if result == StoreUpdateResult.UPDATE_JSON else None
+            except Exception as e:
+                # the store is stuck in the middle of a replay
+                self.store = None
+                self.lastIdx = None
+                result, value = StoreUpdateResult.FAILED, str(e)
+            with self.requests:
+                if idx in self.wanted:
+                    self.results = {i: r for i, r in self.results.items() if i in self.wanted}
+                    self.results[idx] = (result, value)
+            self.notify()
+
+    def idle(self):
+        # the ui has nothing to do, prefetch around the last request
+        with self.requests:
+            if not self.prefetching:
+                self.prefetching = True
+                self.requests.notify()
+
+    def notify(self):
+        # wakes up the ui thread, at most one event is queued at a time
+        if not self.notified:
+            self.notified = True
+            self.app.queueEvent(StoreUpdateEvent())
+
+    def showProgress(self, progress, msg):
+        if threading.current_thread() is self.worker:
+            self.status = (progress, msg)
+            self.notify()
+        else:
+            self.app.showProgress(progress, msg, rect=self.rect)
+
+    def showPending(self):
+        # progress of the request the worker is busy with
+        progress, msg = self.status if self.status is not None else (0.0, "Waiting for store")
+        self.app.showProgress(progress, msg, rect=self.rect)
+
+    def covers(self, path):
+        return self.scope is None or tuple(path[:len(self.scope)]) == self.scope
+
+    def relateToScope(self, i):
+        # how the operations of entry i relate to the scope
+        scope = self.scopeString
+        paths = self.app.logPaths(i)
+        if any(scope.startswith(path) and not scope == path for path in paths):
+            return StoreProvider.SCOPE_PARENT
+        inside = sum(1 for path in paths if path.startswith(scope))
+        if inside == 0:
+            return StoreProvider.SCOPE_OUTSIDE
+        elif inside == len(paths):
+            return StoreProvider.SCOPE_INSIDE
+        return StoreProvider.SCOPE_MIXED
+
+    def scopedProgram(self, i, listDepth):
+        # Returns the operations of entry i that can change the scoped
+        # subtree, and whether the entry changed anything outside of it.
+        # An operation can only do so, if its path is a parent of the scope
+        # or below it. Or if it shares a prefix with the scope that goes
+        # down to a list, since assigning below a list replaces it.
+        if self.scope is None:
+            return self.app.logProgram(i), False
+
+        if i >= len(self.scopeRelations):
+            self.scopeRelations.extend(bytes(len(self.app.log) - len(self.scopeRelations)))
+        relation = self.scopeRelations[i]
+        if relation == StoreProvider.SCOPE_UNKNOWN:
+            relation = self.scopeRelations[i] = self.relateToScope(i)
+
+        if relation == StoreProvider.SCOPE_OUTSIDE and listDepth is None:
+            return (), False
+        elif relation == StoreProvider.SCOPE_INSIDE:
+            return self.app.logProgram(i), False
+        elif relation == StoreProvider.SCOPE_PARENT:
+            # parents of the scope may change the way down to it, so later
+            # operations of the entry can not be judged in advance
+            return self.app.logProgram(i), True
+
+        scope = self.scopeString
+        paths = self.app.logPaths(i)
+        related = []
+        for path in paths:
+            if path.startswith(scope):
+                related.append(True)
+            elif listDepth is not None:
+                related.append(os.path.commonprefix((path, scope)).count("/") >= listDepth)
+            else:
+                related.append(False)
+
+        program = self.app.logProgram(i)
+        outside = any(rel and not path.startswith(scope) for rel, path in zip(related, paths))
+        if all(related):
+            return program, outside
+        return tuple(record for rel, record in zip(related, program) if rel), outside
+
+    def replayEntry(self, store, i, listDepth, undo=None):
+        # Applies entry i to a store of the current scope, listDepth is the
+        # depth of the first list on the way to the scope. Returns the new
+        # list depth.
+        program, outside = self.scopedProgram(i, listDepth)
+        try:
+            # entries outside of the scope still have to let ttl expire
+            if len(program) > 0 or store.ttl.due(self.app.logTimes[i]):
+                store.run(program, self.app.logTimes[i], undo)
+        except Exception as e:
+            ent = self.app.log[i]
+            raise Exception("In log entry {idx}: {text} - {content}".format(idx=ent["_key"], text=repr(e), content=json.dumps(ent)))
+        if len(program) > 0 and self.scope is not None:
+            if outside:
+                store.prune(self.scope)
+            listDepth = pathindex.listDepth(store.store, self.scope)
+        return listDepth
+
+    def updateScopeListDepth(self):
+        # depth of the first list on the way to the scope
+        self.scopeListDepth = None
+        if self.scope is not None:
+            self.scopeListDepth = pathindex.listDepth(self.store.store, self.scope)
+
+    def seedStore(self, store):
+        # store is a full store or one of the current scope
+        if self.scope is not None:
+            store.prune(self.scope)
+        self.store = store
+
+    def updateIndex(self, idx, cancelled=None):
         updateJson = True
         if self.lastIdx != idx:
             updateJson = True
+            self.checkpoints.visit(idx, len(self.app.log or []))
             # if the id of the first log entry is ARANGO_LOG_ZERO,
             # generate the agency from empty store
             # otherwise check if the log entry is after (>=) the
@@ -616,21 +1497,29 @@ class StoreProvider:
             startidx = None
             snapshotRequired = True
 
-            if log[0]["_key"] == ARANGO_LOG_ZERO:
+            if log.key(0) == logtable.ARANGO_LOG_ZERO:
                 snapshotRequired = False
 
             # early out for cases where we can not produce a store
             if snapshotRequired:
                 if snapshot == None:
                     return StoreUpdateResult.NO_SNAPSHOT
-                elif log[idx]["_key"] < snapshot["_key"]:
+                elif log.key(idx) < snapshot["_key"] or self.app.firstValidLogIdx is None:
+                    # the log may also start after the snapshot
                     return StoreUpdateResult.NOT_COVERED
+                tree = snapshot["readDB"][0]
 
             # first check cache
             cache = self.cache.get(idx)
             if not cache == None:
                 self.lastWasCopy = False
                 self.store = cache
+            elif self.scope is not None and self.fullCache.has(idx):
+                self.seedStore(agency.AgencyStore.copyFrom(self.fullCache.get(idx)))
+                self.lastWasCopy = True
+                self.updateScopeListDepth()
+            elif self.revertTo(idx):
+                pass
             else:
                 # check if we can use last index
                 startidx = self.lastIdx + 1 if not self.lastIdx == None else None
@@ -644,77 +1533,552 @@ class StoreProvider:
                         startidx = 0
                     self.lastWasCopy = True
 
-                # lets ask cache
-                cache = self.cache.closest(idx)
-                if not cache == None and not startidx == None:
-                    if cache > startidx:
-                        startidx = cache + 1
-                        self.app.showProgress(0.0, "Copy index {} from cache".format(cache), rect=self.rect)
-                        self.store = agency.AgencyStore.copyFrom(self.cache.get(cache))
-                        self.lastWasCopy = True
-                        doCopyLastSnapshot = False
+                # a later compaction is better than where we are
+                seed = self.snapshotSeed(idx)
+                if seed is not None and startidx is not None and seed[0] > startidx:
+                    startidx, tree = seed
+                    doCopyLastSnapshot = True
+                    self.lastWasCopy = True
+
+                # lets ask cache, a scoped replay can also start from a full store
+                self.loadCheckpoint(idx + 1, startidx)
+                for cacheToAsk in [self.cache, self.fullCache]:
+                    cache = cacheToAsk.closest(idx + 1)
+                    if not cache == None and not startidx == None:
+                        if cache > startidx:
+                            startidx = cache + 1
+                            self.showProgress(0.0, "Copy index {} from cache".format(cache))
+                            self.seedStore(agency.AgencyStore.copyFrom(cacheToAsk.get(cache)))
+                            self.lastWasCopy = True
+                            doCopyLastSnapshot = False
 
                 if doCopyLastSnapshot:
-                    self.app.showProgress(0.0, "Copy from snapshot", rect=self.rect)
-                    self.store = agency.AgencyStore(snapshot["readDB"][0])
+                    self.showProgress(0.0, "Copy from snapshot")
+                    self.seedStore(agency.AgencyStore(tree))
                 elif not self.lastWasCopy:
                     self.store = agency.AgencyStore.copyFrom(self.store)
+                self.updateScopeListDepth()
 
-                lastProgress = time.process_time()
+                started = lastProgress = before = time.thread_time()
+                elapsed = 0
+
+                sharded = self.sharded is not None and self.scope is None and \
+                    idx - startidx > StoreProvider.SHARDED_MIN + StoreProvider.UNDO_WINDOW
+                if sharded:
+                    last = idx - StoreProvider.UNDO_WINDOW
+                    if self.replaySharded(startidx, last, idx, cancelled) == StoreUpdateResult.PENDING:
+                        return StoreUpdateResult.PENDING
+                    startidx = last + 1
 
                 for i in range(startidx, idx + 1):
-                    now = time.process_time()
                     # if log[idx]["_key"] >= snapshot["_key"]:
-                    ent = self.app.log[i]
-                    try:
-                        self.store.applyLog(self.app.log[i])
-                    except Exception as e:
-                        raise Exception("In log entry {idx}: {text} - {content}".format(idx=ent["_key"], text=repr(e), content=json.dumps(ent)))
-                    storeIntermediate = i % 5000 == 0 and not self.cache.has(i)
-
-                    if not storeIntermediate:
-                        didx = idx - i
-                        if didx < 500:
-                            storeIntermediate = didx % 200 == 0
-                        elif didx < 2500:
-                            storeIntermediate = didx % 1000 == 0
-
-                    if storeIntermediate:
-                        self.app.showProgress((i - startidx) / (idx + 1 - startidx),
-                                              "Generating store {}/{} - writing to cache".format(i, idx + 1),
-                                              rect=self.rect)
-                        self.cache.set(i, agency.AgencyStore.copyFrom(self.store))
+                    undo = [] if idx - i < StoreProvider.UNDO_WINDOW else None
+                    self.scopeListDepth = self.replayEntry(self.store, i, self.scopeListDepth, undo)
+                    if not undo is None:
+                        self.recordUndo(i, undo)
+
+                    now = time.thread_time()
+                    cost = now - before
+                    elapsed += cost
+                    before = now
+                    if self.checkpoints.place(self.cache, i, idx, cost, elapsed):
+                        elapsed = 0
+                        if not self.cache.has(i):
+                            self.showProgress((i - startidx) / (idx + 1 - startidx),
+                                              "Generating store {}/{} - writing to cache".format(i, idx + 1))
+                            self.checkpoint(i, agency.AgencyStore.copyFrom(self.store))
+                            before = time.thread_time()
                     elif now - lastProgress > 0.1:
-                        self.app.showProgress((i - startidx) / (idx + 1 - startidx),
-                                              "Generating store {}/{}".format(i, idx + 1), rect=self.rect)
+                        self.showProgress((i - startidx) / (idx + 1 - startidx),
+                                          "Generating store {}/{}".format(i, idx + 1))
                         lastProgress = now
 
-                self.app.showProgress(1.0, "Generating store done - writing to cache", rect=self.rect)
-                self.cache.set(idx, agency.AgencyStore.copyFrom(self.store))
-                self.app.showProgress(1.0, "Dumping json", rect=self.rect)
+                    if cancelled is not None and cancelled():
+                        # a later request can continue from here
+                        self.coverage.add(startidx, i)
+                        self.lastIdx = i
+                        return StoreUpdateResult.PENDING
+
+                if startidx <= idx:
+                    self.coverage.add(startidx, idx)
+                self.showProgress(1.0, "Generating store done - writing to cache")
+                self.checkpoint(idx, agency.AgencyStore.copyFrom(self.store),
+                                persist=sharded or time.thread_time() - started > StoreProvider.DISK_REPLAY)
+                self.showProgress(1.0, "Dumping json")
 
         self.lastIdx = idx
         return StoreUpdateResult.UPDATE_JSON if updateJson else \
             StoreUpdateResult.OK
 
+    def replaySharded(self, start, last, idx, cancelled):
+        # Replays entries start to last of a replay to idx with a process per
+        # shard, see ShardedReplay, and places checkpoints after its batches.
+        # Returns PENDING if cancelled, otherwise the store is at last.
+        done = start - 1
+        elapsed = 0
+        lastProgress = time.thread_time()
+        replay = self.sharded.replay(agency.AgencyStore.copyFrom(self.store), start, last, self.app.logProgram,
+                                     self.app.logPaths, self.app.logTimes,
+                                     lambda store, i: self.replayEntry(store, i, None))
+        try:
+            for i, cost in replay:
+                # the cost of a serial replay is spread over the entries
+                place = False
+                for j in range(done + 1, i + 1):
+                    elapsed += cost / (i - done)
+                    if self.checkpoints.place(self.cache, j, idx, cost / (i - done), elapsed):
+                        place = True
+                        elapsed = 0
+                done = i
+                if place and not self.cache.has(i):
+                    self.checkpoint(i, self.sharded.assemble())
+                if cancelled is not None and cancelled():
+                    self.store = self.sharded.assemble()
+                    self.coverage.add(start, i)
+                    self.lastIdx = i
+                    return StoreUpdateResult.PENDING
+                now = time.thread_time()
+                if now - lastProgress > 0.1:
+                    self.showProgress((i - start) / (idx + 1 - start), "Generating store {}/{} in {} processes".format(
+                        i, idx + 1, len(self.sharded.loaded)))
+                    lastProgress = now
+            self.store = self.sharded.assemble()
+        except sharding.ShardFailure as e:
+            ent = self.app.log[e.idx]
+            raise Exception("In log entry {idx}: {text} - {content}".format(idx=ent["_key"], text=e.text, content=json.dumps(ent)))
+        self.coverage.add(start, last)
+        return StoreUpdateResult.OK
+
+    def recordUndo(self, idx, undo):
+        # Undo records hold pre-images of the store they were recorded on,
+        # which depends on the seed its replay started with. They are dropped
+        # whenever the scope, the seeds or the order of the log change.
+        self.undo.pop(idx, None)
+        self.undo[idx] = undo
+        if len(self.undo) > StoreProvider.UNDO_LIMIT:
+            del self.undo[next(iter(self.undo))]
+
+    def revertTo(self, idx):
+        # Steps back from lastIdx to idx by reverting entries. Returns False
+        # if an undo record is missing, the store is unchanged in that case.
+        if self.store is None or self.lastIdx is None or not idx < self.lastIdx:
+            return False
+        if self.lastIdx - idx > len(self.undo) or \
+                not all(i in self.undo for i in range(idx + 1, self.lastIdx + 1)):
+            return False
+
+        if not self.lastWasCopy:
+            self.store = agency.AgencyStore.copyFrom(self.store)
+            self.lastWasCopy = True
+        for i in range(self.lastIdx, idx, -1):
+            self.store.revert(self.undo[i])
+        self.updateScopeListDepth()
+        return True
+
+    def resetPrefetch(self):
+        self.coverage = Coverage()
+        self.coverageEvictions = self.cache.evictions
+        self.prefetchCenter = None
+        self.prefetchRanges = []
+        self.prefetchReplay = None
+
+    def closestSeed(self, idx, full=False):
+        # The closest store to start a replay to idx with, as (index of the
+        # first entry to apply, store). None if idx can not be replayed. The
+        # store is of the current scope, unless full is set.
+        log = self.app.log
+        snapshot = self.app.snapshot
+        if log.key(0) == logtable.ARANGO_LOG_ZERO:
+            start, store = 0, agency.AgencyStore()
+        elif snapshot is None or log.key(idx) < snapshot["_key"] or self.app.firstValidLogIdx is None:
+            return None
+        else:
+            start, store = self.app.firstValidLogIdx, agency.AgencyStore(snapshot["readDB"][0])
+        seed = self.snapshotSeed(idx)
+        if seed is not None and seed[0] > start:
+            start, store = seed[0], agency.AgencyStore(seed[1])
+        self.loadCheckpoint(idx + 1, start)
+        for cache in [self.fullCache] if full else [self.cache, self.fullCache]:
+            closest = cache.closest(idx + 1)
+            if closest is not None and closest + 1 > start:
+                start, store = closest + 1, agency.AgencyStore.copyFrom(cache.peek(closest))
+        if self.scope is not None and not full:
+            store.prune(self.scope)
+        return start, store
+
+    def prefetch(self, center, cancelled=None):
+        # Does a slice of prefetching around center, returns False if there
+        # is nothing left to do. The current store is not touched.
+        log = self.app.log
+        if log is None or len(log) == 0:
+            return False
+        if self.cache.evictions != self.coverageEvictions:
+            # evicted checkpoints may have left gaps anywhere
+            self.resetPrefetch()
+        if self.cache.resident > 0.9 * self.cache.budget:
+            return False
+
+        if center != self.prefetchCenter:
+            replay = self.prefetchReplay
+            if replay is not None and replay.next > replay.start:
+                self.coverage.add(replay.start, replay.next - 1)
+            begin = max(0, center - StoreProvider.PREFETCH_RANGE)
+            end = min(len(log) - 1, center + StoreProvider.PREFETCH_RANGE)
+            self.prefetchCenter = center
+            self.prefetchRanges = self.coverage.missing(begin, center) + self.coverage.missing(center + 1, end)
+            self.prefetchReplay = None
+
+        deadline = time.thread_time() + StoreProvider.PREFETCH_SLICE
+        try:
+            while time.thread_time() < deadline:
+                if self.prefetchReplay is None:
+                    if len(self.prefetchRanges) == 0:
+                        return False
+                    begin, end = self.prefetchRanges.pop(0)
+                    seed = self.closestSeed(begin)
+                    if seed is None:
+                        continue
+                    start, store = seed
+                    listDepth = pathindex.listDepth(store.store, self.scope) if self.scope is not None else None
+                    self.prefetchReplay = Replay(start, end, store, listDepth)
+                self.prefetchStep(self.prefetchReplay, deadline, cancelled)
+                if self.prefetchReplay.next > self.prefetchReplay.end:
+                    self.coverage.add(self.prefetchReplay.start, self.prefetchReplay.end)
+                    self.prefetchReplay = None
+        except Exception:
+            # the foreground replay reports broken entries, once they are selected
+            self.prefetchRanges = []
+            self.prefetchReplay = None
+            return False
+        return True
+
+    def prefetchStep(self, replay, deadline, cancelled):
+        before = time.thread_time()
+        while replay.next <= replay.end and before < deadline and not (cancelled is not None and cancelled()):
+            i = replay.next
+            replay.listDepth = self.replayEntry(replay.store, i, replay.listDepth)
+            now = time.thread_time()
+            replay.elapsed += now - before
+            if self.checkpoints.place(self.cache, i, replay.end, now - before, replay.elapsed):
+                replay.elapsed = 0
+                if not self.cache.has(i):
+                    self.checkpoint(i, agency.AgencyStore.copyFrom(replay.store))
+                now = time.thread_time()
+            before = now
+            replay.next += 1
+
     def get(self, path):
-        return self.store.get(path)
+        return self.current.get(path)
 
     def _ref(self, path):
-        return self.store._ref(path)
+        return self.current._ref(path)
+
+    def keys(self, path):
+        # keys of the object at path, None if there is none
+        ref = self.current._ref(path)
+        return list(ref.keys()) if isinstance(ref, dict) else None
+
+    def view(self, path):
+        # what the store view displays for path
+        return self.current._ref(path)
 
     def has_store(self):
-        return self.store is not None
+        return self.current is not None
+
+    def stats(self):
+        msg = "Store cache: " + self.fullCache.stats()
+        if self.cache is not self.fullCache:
+            msg += "\nScope cache: " + self.cache.stats()
+        if self.disk is not None:
+            msg += "\nDisk cache: " + self.disk.stats()
+        msg += "\nInterned: " + self.app.interner.stats()
+        return msg + "\nSeeds: " + self.seedStats()
+
+
+class RemoteStore:
+    # a store of the engine, values are fetched when they are needed
+
+    def __init__(self, client, idx):
+        self.client = client
+        self.idx = idx
+        self.linesPath = None
+        self.lines = None
+
+    def get(self, path):
+        return self.client.call("value", self.idx, list(path))
+
+    def _ref(self, path):
+        return self.get(path)
+
+    def keys(self, path):
+        return self.client.call("keys", self.idx, list(path))
+
+    def view(self, path):
+        # the lines of path as rendered by the engine
+        path = list(path)
+        if not path == self.linesPath:
+            self.lines = engine.RemoteLines(lambda first, count: self.client.call("lines", self.idx, path, first, count),
+                                            lambda string: self.client.call("search", self.idx, path, string))
+            self.linesPath = path
+        return self.lines
+
+
+class RemoteLog(Sequence):
+    # The log of an engine process in the ui, in place of a LogTable. Rows of
+    # the key, term, time, text and request paths of entries are fetched in
+    # pages when they are displayed. Filters and the path index run in the
+    # engine, see StoreEngine, nothing is compiled or indexed in the ui.
+    PARSED = 256
+
+    def __init__(self, client):
+        self.client = client
+        self.rows = engine.RemoteLines(lambda first, count: client.call("entries", first, count), None)
+        self.pathIndex = RemotePathIndex(client)
+        self.parsed = OrderedDict()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        entry = self.parsed.get(i)
+        if entry is not None:
+            self.parsed.move_to_end(i)
+            return entry
+        entry = self.parsed[i] = json.loads(self.text(i))
+        if len(self.parsed) > RemoteLog.PARSED:
+            self.parsed.popitem(last=False)
+        return entry
+
+    def key(self, i):
+        return self.rows[i][0]
+
+    def term(self, i):
+        return self.rows[i][1]
+
+    def time(self, i):
+        return self.rows[i][2]
+
+    def text(self, i):
+        return self.rows[i][3]
+
+    def raw(self, i):
+        return self.text(i).encode()
+
+    def requestPaths(self, i):
+        return self.rows[i][4]
+
+    def lastAtOrBefore(self, key):
+        return self.client.call("lastAtOrBefore", key)
+
+    def grep(self, string):
+        # the indexes of the entries the grep of the log list matches
+        return self.client.call("grep", string)
+
+    def regexp(self, regexStr):
+        return self.client.call("regexp", regexStr)
+
+    # fetches the entries page by page
+    dump = logtable.LogTable.dump
+
+    def close(self):
+        pass
+
+
+class RemotePathIndex:
+    # the pathindex.PathIndex of the log of an engine process
+
+    def __init__(self, client):
+        self.client = client
+
+    def changes(self, path, start=0):
+        return self.client.call("changes", path, start)
+
+    def next(self, path, idx):
+        return self.client.call("next", path, idx)
+
+    def prev(self, path, idx):
+        return self.client.call("prev", path, idx)
+
+
+class RemoteSnapshot(Mapping):
+    # A compaction of an engine process, like logtable.ContainerValue it is
+    # fetched when more than its key is read, e.g. by :dump-all.
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+        self.value = None
+
+    def load(self):
+        if self.value is None:
+            self.value = self.client.call("snapshot", self.key)
+        return self.value
+
+    def __getitem__(self, name):
+        if name == "_key":
+            return self.key
+        return self.load()[name]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+class RemoteLogProvider:
+    # The provider of the ui if an engine process replays the stores. The
+    # engine has loaded the log, the ui only fetches what it displays, see
+    # RemoteLog.
+
+    def __init__(self, client):
+        self.client = client
+        self.loader = None
+        self._log = None
+        self.refresh()
+
+    def log(self):
+        return self._log
+
+    def snapshots(self):
+        return self._snapshots
+
+    def digest(self):
+        return self.client.call("digest")
+
+    def refresh(self):
+        # the engine has loaded the log when it started, it is only loaded
+        # again when the ui refreshes
+        if self._log is not None:
+            self.client.call("refresh")
+        self._log = RemoteLog(self.client)
+        self._snapshots = [RemoteSnapshot(self.client, key) for key in self.client.call("snapshots")]
+
+    def start_live_view(self, first_index, app):
+        pass
+
+    def start_loading(self, app):
+        pass
+
+    def loadProgress(self):
+        return None
+
+
+class RemoteStoreProvider:
+    # Takes the place of StoreProvider in the ui, if stores are replayed by
+    # an engine process, see StoreEngine. The views pull the lines they
+    # display and single values from the engine.
+    POLL = 0.1
+
+    def __init__(self, app, client):
+        self.app = app
+        self.client = client
+        self.rect = Rect.zero()
+        self.scope = None
+        self.status = None
+        self.notified = False
+        self.stores = dict()
+        # the store of the last completed request, for the views
+        self.current = None
+        # set while the engine is busy with a request, see poll
+        self.busy = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.poll, daemon=True).start()
+
+    def poll(self):
+        # one thread wakes up the ui to ask the engine again
+        while True:
+            self.busy.wait()
+            self.busy.clear()
+            time.sleep(RemoteStoreProvider.POLL)
+            self.notify()
+
+    @contextlib.contextmanager
+    def paused(self):
+        yield
+
+    def close(self):
+        # the engine stops its own processes
+        pass
+
+    def idle(self):
+        # the engine prefetches once a request is served
+        pass
+
+    def reload(self):
+        # the log of the ui is the one of the engine, which the provider has
+        # refreshed already, see RemoteLogProvider
+        self.stores = dict()
+        self.current = None
+
+    def request(self, indexes):
+        # like StoreProvider.request, the engine is asked again after POLL
+        # seconds as long as it is busy
+        results, self.status = self.client.call("request", list(indexes))
+        if results is None:
+            self.busy.set()
+            return None
+        stores = dict()
+        for idx, (result, value) in zip(indexes, results):
+            if result == StoreUpdateResult.UPDATE_JSON:
+                stores[idx] = self.stores.get(idx) or RemoteStore(self.client, idx)
+        self.stores = stores
+        results = [(result, stores[idx] if idx in stores else value) for idx, (result, value) in zip(indexes, results)]
+        self.current = results[-1][1] if results[-1][0] == StoreUpdateResult.UPDATE_JSON else None
+        return results
+
+    def notify(self):
+        if not self.notified:
+            self.notified = True
+            self.app.queueEvent(StoreUpdateEvent())
+
+    def showPending(self):
+        progress, msg = self.status if self.status is not None else (0.0, "Waiting for store")
+        self.app.showProgress(progress, msg, rect=self.rect)
+
+    def covers(self, path):
+        # the engine looks up paths outside of the scope itself
+        return True
+
+    def setScope(self, path):
+        scope = tuple(path) if path else None
+        self.client.call("scope", list(scope) if scope is not None else None)
+        self.scope = scope
+        self.stores = dict()
+
+    def get(self, path):
+        return self.current.get(path)
+
+    def _ref(self, path):
+        return self.current._ref(path)
+
+    def keys(self, path):
+        return self.current.keys(path)
+
+    def view(self, path):
+        return self.current.view(path)
+
+    def has_store(self):
+        return self.current is not None
+
+    def stats(self):
+        return self.client.call("stats")
 
 
 class AgencyStoreView(LineView):
+    ANNOTATION_CACHE_BYTES = 16 * 2**20
+
     def __init__(self, app, rect):
         super().__init__(app, rect)
         self.store = app.storeProvider
+        self.pending = False
         self.path = []
         self.pathHistory = History()
         self.annotations = dict()
-        self.annotationCache = StoreCache(64)
+        self.annotationCache = StoreCache(AgencyStoreView.ANNOTATION_CACHE_BYTES)
         self.annotationsTrie = None
         self.annotations_format = {
             "server": "{ShortName}, {Endpoint}, {Status}",
@@ -723,6 +2087,8 @@ class AgencyStoreView(LineView):
         }
 
     def title(self):
+        if self.store.scope is not None:
+            return "Agency Store View (scope /{})".format("/".join(self.store.scope))
         return "Agency Store View"
 
     def serialize(self):
@@ -744,7 +2110,12 @@ class AgencyStoreView(LineView):
         idx = self.app.list.getSelectedIndex()
         if idx == None:
             return
-        result = self.store.updateIndex(idx)
+        results = self.store.request([idx])
+        self.pending = results is None
+        if self.pending:
+            # keep showing the previous store until the worker is done
+            return
+        result, value = results[0]
         if result == StoreUpdateResult.NO_SNAPSHOT:
             self.head = None
             self.lines = [(ColorFormat.CF_ERROR, "No snapshot available")]
@@ -753,19 +2124,55 @@ class AgencyStoreView(LineView):
             self.head = None
             self.lines = [(ColorFormat.CF_ERROR, "Can not replicate agency state. Not covered by snapshot.")]
             return
+        elif result == StoreUpdateResult.FAILED:
+            self.head = None
+            self.lines = [(ColorFormat.CF_ERROR, value)]
+            return
         elif result == StoreUpdateResult.UPDATE_JSON:
             updateJson = True
         else:
             assert result == StoreUpdateResult.OK
 
+        if not self.store.covers(self.path):
+            # paths outside of the scope are looked up on their own
+            if updateJson:
+                try:
+                    value = self.app.valueAt(self.path, idx)
+                except ValueError as e:
+                    self.lines = [(ColorFormat.CF_ERROR, str(e))]
+                    return
+                self.load_annotations()
+                self.jsonLines(value)
+            return
+
         if updateJson:
-            self.load_annotations()
-            self.jsonLines(self.store._ref(self.path))
+            try:
+                self.load_annotations()
+                self.jsonLines(self.store.view(self.path))
+            except engine.EngineError as e:
+                self.lines = [(ColorFormat.CF_ERROR, str(e))]
+
+    def jsonLines(self, value):
+        # the lines of an engine are rendered there
+        if isinstance(value, engine.RemoteLines):
+            self.json = value
+            self.lines = value
+            self.searchLines()
+        else:
+            super().jsonLines(value)
+
+    def searchLines(self):
+        if isinstance(self.lines, engine.RemoteLines) and self.findStr is not None:
+            self.findList = self.lines.search(self.findStr)
+        else:
+            super().searchLines()
 
     def update(self):
         self.head = "/" + "/".join(self.path)
         self.updateStore()
         super().update()
+        if self.pending:
+            self.store.showPending()
 
     def update_format_string(self, what):
         if what not in self.annotations_format:
@@ -811,8 +2218,11 @@ class AgencyStoreView(LineView):
                     group = None
                     if "groupId" in data:
                         gid = data["groupId"]
-                        group = self.store._ref(["arango", "Plan", "CollectionGroups", dbname, str(gid)])
-                        assert group is not None
+                        groupPath = ["arango", "Plan", "CollectionGroups", dbname, str(gid)]
+                        # groups outside of the replay scope are not known
+                        if self.store.covers(groupPath):
+                            group = self.store._ref(groupPath)
+                            assert group is not None
                         
 
 
@@ -850,9 +2260,30 @@ class AgencyStoreView(LineView):
             self.path = agency.AgencyStore.parsePath(pathstr)
             self.pathHistory.append(pathstr)
             self.updateStore(updateJson=True)
+        elif c == ord('c'):
+            self.jumpToChange(True)
+        elif c == ord('C'):
+            self.jumpToChange(False)
+        elif c == ord('H'):
+            self.app.list.history("/" + "/".join(self.path))
         else:
             super().input(c)
 
+    def jumpToChange(self, forward):
+        # select the next or previous log entry that can change the current path
+        idx = self.app.list.getSelectedIndex()
+        if idx is None:
+            return
+        index = self.app.getPathIndex()
+        key = agency.AgencyStore.pathPrefix(self.path)
+        target = index.next(key, idx) if forward else index.prev(key, idx)
+        if target is None:
+            self.app.displayMsg("No {} change of /{}".format("later" if forward else "earlier", "/".join(self.path)),
+                                curses.A_STANDOUT)
+            return
+        self.app.list.follow = False
+        self.app.list.selectClosest(target)
+
     def set(self, store):
         self.store = store
 
@@ -880,15 +2311,15 @@ class AgencyStoreView(LineView):
         path = agency.AgencyStore.parsePath(pathstr)
 
         if pathstr[-1] == "/":
-            ref = self.store._ref(path)
-            if not ref == None and isinstance(ref, dict):
-                return list(ref.keys())
+            keys = self.store.keys(path)
+            if keys is not None:
+                return keys
         else:
-            ref = self.store._ref(path[:-1])
-            if not ref == None and isinstance(ref, dict):
+            keys = self.store.keys(path[:-1])
+            if keys is not None:
                 word = path[-1]
                 # Now find all key that start with word
-                keys = [h for h in ref.keys() if h.startswith(word)]
+                keys = [h for h in keys if h.startswith(word)]
 
                 if len(keys) == 0:
                     return None
@@ -904,9 +2335,9 @@ class AgencyStoreView(LineView):
                     return "/" + "/".join(path[:-1] + [common])
 
                 elif path[-1] == keys[0] and not pathstr[-1] == "/":
-                    ref = self.store._ref(path)
-                    if not ref == None and isinstance(ref, dict):
-                        return (pathstr + "/", ref.keys())
+                    keys = self.store.keys(path)
+                    if keys is not None:
+                        return (pathstr + "/", keys)
                 else:
                     return "/" + "/".join(path[:-1] + [keys[0]])
         return None
@@ -925,8 +2356,7 @@ class AgencyDiffView(PureLineView):
     def title(self):
         return "Agency Store Diff"
 
-    def getStoreRef(self, idx):
-        result = self.store.updateIndex(idx)
+    def getStoreRef(self, result, value):
         if result == StoreUpdateResult.NO_SNAPSHOT:
             self.head = None
             self.lines = [(ColorFormat.CF_ERROR, "No snapshot available")]
@@ -935,8 +2365,12 @@ class AgencyDiffView(PureLineView):
             self.head = None
             self.lines = [(ColorFormat.CF_ERROR, "Can not replicate agency state. Not covered by snapshot.")]
             return None
+        elif result == StoreUpdateResult.FAILED:
+            self.head = None
+            self.lines = [(ColorFormat.CF_ERROR, value)]
+            return None
         else:
-            return self.store.store
+            return value
 
     def update(self):
 
@@ -948,19 +2382,29 @@ class AgencyDiffView(PureLineView):
             super().update()
             return
 
-        oldStore = self.getStoreRef(idx-1)
-        newStore = self.getStoreRef(idx)
+        results = self.store.request([idx - 1, idx])
+        if results is None:
+            # keep showing the previous diff until the worker is done
+            super().update()
+            self.store.showPending()
+            return
+
+        oldStore = self.getStoreRef(*results[0])
+        newStore = self.getStoreRef(*results[1])
 
         if oldStore is None or newStore is None:
             return
 
-        entry = self.app.log[idx]
         lines = []
-        for path in entry["request"]:
+        for path in self.app.log.requestPaths(idx):
             lines.append([(curses.A_BOLD, path)])
             parsedPath = agency.AgencyStore.parsePath(path)
-            oldLines = AgencyDiffView.split_json(oldStore._ref(parsedPath))
-            newLines = AgencyDiffView.split_json(newStore._ref(parsedPath))
+            try:
+                oldLines = AgencyDiffView.split_json(self.app.storeValue(oldStore, parsedPath, idx - 1))
+                newLines = AgencyDiffView.split_json(self.app.storeValue(newStore, parsedPath, idx))
+            except ValueError as e:
+                lines.append([(ColorFormat.CF_ERROR, str(e))])
+                continue
             diffLines = self.computeDiff(oldLines, newLines)
             lines.extend(diffLines)
         self.lines = lines
@@ -1013,20 +2457,139 @@ class NewLogEntriesEvent:
         self.log = log
 
 
+class StoreUpdateEvent:
+    # the store provider finished or progressed on a request
+    pass
+
+
 class ExceptionInNetworkThread:
     def __init__(self, msg):
         self.msg = msg
 
 
-class ArangoAgencyAnalyserApp(App):
-    def __init__(self, stdscr, provider, args):
+class LoadedLog:
+    # The log of provider with what is derived from it, shared by the ui and
+    # the engine process. Expects log, provider, args and storeProvider.
+
+    def loadLog(self):
+        # takes over the log of the provider, the store provider has to be
+        # paused. A replaced log is not read anymore, its file is closed.
+        previous = self.log
+        self.log = self.provider.log()
+        if previous is not None and previous is not self.log:
+            previous.close()
+        if isinstance(self.log, RemoteLog):
+            # the engine compiles and indexes its log
+            self.logTimes = self.logPrograms = self.logPathSummaries = self.interner = None
+        else:
+            self.logTimes = self.log.times
+            self.logPrograms = [None] * len(self.log or [])
+            self.logPathSummaries = [None] * len(self.log or [])
+            # shares the values of the compiled log with the client ids and
+            # request paths of the log table, also of live entries
+            self.interner = self.log.interner
+        self.pathIndex = None
+        self.pathLookup = None
+        self.snapshots = self.provider.snapshots()
+        self.snapshot = self.snapshots[0] if len(self.snapshots) > 0 else None
+        self.firstValidLogIdx = None
+        if not self.snapshot == None and not self.log.key(0) == logtable.ARANGO_LOG_ZERO:
+            # the oldest compaction that the log does not start after, like
+            # the seeds of StoreProvider.setSnapshots
+            for snapshot in self.snapshots:
+                start = snapshot_start(self.log, snapshot)
+                if start is not None:
+                    self.snapshot, self.firstValidLogIdx = snapshot, start
+                    break
+        self.storeProvider.reload()
+
+    def openDiskCache(self):
+        if self.args.disk_cache is None:
+            return None
+        digest = self.provider.digest()
+        if digest is None:
+            return None
+        return diskcache.DiskCache(self.args.disk_cache, digest, self.args.disk_cache_mb * 2**20)
+
+    def logProgram(self, i):
+        # compiled request of log entry i, compiled when first replayed
+        program = self.logPrograms[i]
+        if program is None:
+            program = self.logPrograms[i] = agency.AgencyStore.compile(self.log[i]["request"], self.interner)
+        return program
+
+    def logPaths(self, i):
+        # paths of the operations of log entry i in the form of
+        # AgencyStore.pathPrefix, aligned with the records of its program
+        paths = self.logPathSummaries[i]
+        if paths is None:
+            paths = tuple(agency.AgencyStore.pathPrefix(record[2]) for record in self.logProgram(i))
+            paths = self.logPathSummaries[i] = self.interner.path(paths)
+        return paths
+
+    def getPathIndex(self):
+        # built on first use, entries received since are added incrementally.
+        # Entries are compiled on the way, so the worker is paused. The log of
+        # an engine is indexed there.
+        if isinstance(self.log, RemoteLog):
+            return self.log.pathIndex
+        with self.storeProvider.paused():
+            if self.pathIndex is None:
+                self.pathIndex = pathindex.PathIndex()
+            index = self.pathIndex
+            lastProgress = time.process_time()
+            for i in range(index.count, len(self.log)):
+                index.add(i, self.logPaths(i))
+                now = time.process_time()
+                if now - lastProgress > 0.1:
+                    self.showProgress(i / len(self.log), "Indexing paths {}/{}".format(i, len(self.log)),
+                                      rect=self.storeProvider.rect)
+                    lastProgress = now
+        return index
+
+    def getPathLookup(self):
+        # point in time lookups share the compiled log, the seeds and the
+        # full checkpoints with the store provider
+        index = self.getPathIndex()
+        if self.pathLookup is None:
+            self.pathLookup = pathindex.PathLookup(self.log, index, self.logProgram, self.logPaths, self.logTimes,
+                                                   functools.partial(self.storeProvider.closestSeed, full=True))
+        return self.pathLookup
+
+    def valueAt(self, path, idx):
+        # The value at path after entry idx. The lookup uses the cache of the
+        # worker, which has no lock of its own, so the worker is paused.
+        with self.storeProvider.paused():
+            return self.getPathLookup().storeAt(path, idx)._ref(path)
+
+    def storeValue(self, store, path, idx):
+        # the value at path in store, which the store provider returned for
+        # entry idx, paths outside of its scope are looked up on their own
+        if self.storeProvider.covers(path):
+            return store._ref(path)
+        return self.valueAt(path, idx)
+
+
+class ArangoAgencyAnalyserApp(App, LoadedLog):
+    def __init__(self, stdscr, provider, args, engineClient=None):
         super().__init__(stdscr)
         self.log = None
+        self.logTimes = None
+        self.logPrograms = None
+        self.logPathSummaries = None
+        self.interner = None
+        self.pathIndex = None
+        self.pathLookup = None
+        # all compactions by key, snapshot is the oldest one
+        self.snapshots = []
         self.snapshot = None
         self.firstValidLogIdx = None
         self.args = args
 
-        self.storeProvider = StoreProvider(self, Rect.zero())
+        if engineClient is not None:
+            self.storeProvider = RemoteStoreProvider(self, engineClient)
+        else:
+            self.storeProvider = StoreProvider(self, Rect.zero())
         self.list = AgencyLogList(self, Rect.zero(), args)
         self.view = AgencyStoreView(self, Rect.zero())
         self.diffView = AgencyDiffView(self, Rect.zero())
@@ -1038,6 +2601,7 @@ class ArangoAgencyAnalyserApp(App):
 
         self.provider = provider
         self.refresh(updateSelection=True, refreshProvider=False)
+        self.storeProvider.start()
 
         if args.execute:
             for cmd in args.execute:
@@ -1055,21 +2619,16 @@ class ArangoAgencyAnalyserApp(App):
         if refreshProvider:
             self.provider.refresh()
             self.clearWindow()
-        self.log = self.provider.log()
-        self.snapshot = self.provider.snapshot()
-        self.firstValidLogIdx = None
-        if self.args.live:
-            self.provider.start_live_view(int(self.log[-1]['_key']), self)
-
-        if not self.snapshot == None and not self.log[0]["_key"] == ARANGO_LOG_ZERO:
-            for i, e in enumerate(self.log):
-                if e["_key"] <= self.snapshot["_key"]:
-                    self.firstValidLogIdx = i
-                else:
-                    break
+        # the worker must not replay while the log is replaced
+        with self.storeProvider.paused():
+            self.loadLog()
+            if self.args.live:
+                self.provider.start_live_view(int(self.log[-1]['_key']), self)
+            self.provider.start_loading(self)
 
-            if updateSelection:
-                self.list.selectClosest(self.firstValidLogIdx)
+            if self.firstValidLogIdx is not None and updateSelection:
+                # the entry of the snapshot
+                self.list.selectClosest(max(self.firstValidLogIdx - 1, 0))
 
     def dumpJSON(self, filename):
         data = None
@@ -1083,9 +2642,11 @@ class ArangoAgencyAnalyserApp(App):
 
     def dumpAll(self, logfile, snapshotfile):
         with open(logfile, "w") as f:
-            json.dump(self.log, f)
+            self.log.dump(f)
         with open(snapshotfile, "w") as f:
-            json.dump(self.snapshot, f)
+            # compactions of containers and engines are loaded for this
+            snapshots = [dict(snapshot) for snapshot in self.snapshots]
+            json.dump(snapshots if len(snapshots) > 1 else snapshots[0] if len(snapshots) > 0 else None, f)
 
     def update(self):
         self.split.update()
@@ -1101,14 +2662,48 @@ class ArangoAgencyAnalyserApp(App):
                 e2['_key'] = str(e['index'])
                 e2['timestamp'] = datetime.datetime.utcnow().isoformat(timespec='milliseconds') + "Z"
                 modified.append(e2)
-
-            self.log.extend(modified)
-            self.list.filter_new_entries(modified)
+            self.appendEntries(modified)
+        elif isinstance(ev, LogEntriesLoadedEvent):
+            if ev.loader is self.provider.loader:
+                self.appendEntries(ev.entries, ev.texts)
+        elif isinstance(ev, LogLoadedEvent):
+            if ev.loader is self.provider.loader:
+                self.finishLoading(ev.error)
+        elif isinstance(ev, StoreUpdateEvent):
+            # the views pick up the new state in the next update
+            self.storeProvider.notified = False
         elif isinstance(ev, ExceptionInNetworkThread):
             self.displayMsg("Network thread: " + ev.msg, curses.A_STANDOUT)
         else:
             super().handleEvent(ev)
 
+    def appendEntries(self, entries, texts=None):
+        # extends logTimes as well, texts as for LogTable.extend
+        with self.storeProvider.paused():
+            self.log.extend(entries, texts)
+            self.logPrograms.extend([None] * len(entries))
+            self.logPathSummaries.extend([None] * len(entries))
+        self.list.filter_new_entries(entries)
+
+    def idle(self):
+        self.storeProvider.idle()
+        return False
+
+    def finishLoading(self, error):
+        if error is not None:
+            self.provider.loader = None
+            self.displayMsg("Loading log: " + error, curses.A_STANDOUT)
+            return
+        reordered = self.provider.loaded()
+        # compactions, agency state and digest are known now
+        with self.storeProvider.paused():
+            if reordered:
+                self.storeProvider.dropCheckpoints()
+                self.view.annotationCache = StoreCache(AgencyStoreView.ANNOTATION_CACHE_BYTES)
+            self.loadLog()
+        if reordered:
+            self.list.refilter()
+
     def execCmd(self, argv):
         cmd = argv[0].lower()
 
@@ -1158,6 +2753,17 @@ class ArangoAgencyAnalyserApp(App):
                     return
             self.dumpAll(dumpLogFile, dumpSnapshotFile)
 
+        elif cmd == "convert":
+            if len(argv) != 2:
+                raise ValueError("convert requires one parameter")
+            if self.provider.loadProgress() is not None:
+                raise ValueError("The log is still loading")
+            if isinstance(self.log, RemoteLog):
+                raise ValueError("The log is loaded by the engine, use --convert without it")
+            logtable.writeContainer(argv[1], self.log, self.snapshots, self.provider.agencyState())
+            self.displayMsg("Log written to `{}`".format(argv[1]), 0)
+        elif cmd == "cache":
+            self.displayMsg(self.storeProvider.stats(), 0)
         elif cmd == "time":
             self.displayMsg("It is now {}".format(datetime.datetime.now().time()), 0)
         elif cmd == "help":
@@ -1173,6 +2779,17 @@ class ArangoAgencyAnalyserApp(App):
             self.view.update()
         elif cmd == "filter":
             self.list.run_filter_prompt(argv[1])
+        elif cmd == "history":
+            if len(argv) > 2:
+                raise ValueError("history expects at most one path")
+            self.list.history(argv[1] if len(argv) == 2 else "/" + "/".join(self.view.path))
+        elif cmd == "scope":
+            if len(argv) > 2:
+                raise ValueError("scope expects at most one path")
+            path = agency.AgencyStore.parsePath(argv[1]) if len(argv) == 2 else self.view.path
+            self.storeProvider.setScope(path)
+            # annotations of a scoped store are incomplete
+            self.view.annotationCache = StoreCache(AgencyStoreView.ANNOTATION_CACHE_BYTES)
         elif cmd[0] == "h":
             # highlight command
             cmd = AgencyLogList.parse_highlight_command(cmd, argv[1:])
@@ -1197,54 +2814,475 @@ class ArangoAgencyAnalyserApp(App):
         self.split.layout(self.rect)
 
 
-class ArangoAgencyLogFileProvider:
+class EngineApp(LoadedLog):
+    # what a StoreProvider needs of the app, in an engine process without ui
+
+    def __init__(self, provider, args):
+        self.provider = provider
+        self.args = args
+        self.log = None
+        self.storeProvider = StoreProvider(self, Rect.zero())
+        self.loadLog()
+        self.storeProvider.start()
+
+    def queueEvent(self, ev):
+        # clients poll, there is nobody to wake up
+        self.storeProvider.notified = False
+
+    def showProgress(self, progress, msg, rect=None):
+        pass
+
+
+class StoreEngine:
+    # Serves the stores of an EngineApp to ui processes, see engine.py and
+    # RemoteStoreProvider. All clients share the replay state, their requests
+    # are served in turn: each client has its latest request queued, the
+    # worker replays the oldest one of them, and a request is only cancelled
+    # by a newer one of the same client. The stores of the last requests and
+    # the lines of their last rendered paths are kept.
+    #
+    # The ui shows the log of the engine, see RemoteLog, entries are read,
+    # filtered and looked up in the path index here.
+    OPERATIONS = {"request", "value", "keys", "lines", "search", "scope", "stats", "refresh", "digest",
+                  "entries", "lastAtOrBefore", "grep", "regexp", "changes", "next", "prev", "snapshots", "snapshot"}
+    STORES = 16
+    RENDERED = 8
+
+    def __init__(self, app):
+        self.app = app
+        self.provider = app.storeProvider
+        self.lock = threading.Lock()
+        self.stores = OrderedDict()
+        self.rendered = OrderedDict()
+        # indexes of the waiting requests by client, oldest first, and the
+        # results of those served while their client was not asking
+        self.queue = OrderedDict()
+        self.served = dict()
+
+    def handle(self, client, operation, *args):
+        if not operation in StoreEngine.OPERATIONS:
+            raise ValueError("Unknown operation `{}`".format(operation))
+        if operation == "request":
+            return self.request(client, *args)
+        return getattr(self, operation)(*args)
+
+    def closed(self, client):
+        with self.lock:
+            self.queue.pop(client, None)
+            self.served.pop(client, None)
+
+    def request(self, client, indexes):
+        # (results, None) like StoreProvider.request, without the stores, or
+        # (None, status) while the worker is busy with this or another
+        # client's request
+        indexes = tuple(indexes)
+        with self.lock:
+            served = self.served.pop(client, None)
+            if served is not None and served[0] == indexes:
+                return served[1], None
+            # a newer request of a client keeps its turn
+            self.queue[client] = indexes
+            while len(self.queue) > 0:
+                first, wanted = next(iter(self.queue.items()))
+                results = self.provider.request(wanted)
+                if results is None:
+                    return None, self.provider.status
+                del self.queue[first]
+                for idx, (result, value) in zip(wanted, results):
+                    if result == StoreUpdateResult.UPDATE_JSON:
+                        self.stores[idx] = value
+                        self.stores.move_to_end(idx)
+                while len(self.stores) > StoreEngine.STORES:
+                    self.stores.popitem(last=False)
+                if first is client:
+                    break
+                self.served[first] = (wanted, self.reply(results))
+        # like the ui of a local provider, the client has what it asked for,
+        # the worker prefetches unless others are waiting
+        if len(self.queue) == 0:
+            self.provider.idle()
+        return self.reply(results), None
+
+    def reply(self, results):
+        return [(result, None if result == StoreUpdateResult.UPDATE_JSON else value) for result, value in results]
+
+    def store(self, idx):
+        with self.lock:
+            store = self.stores.get(idx)
+        if store is None:
+            raise ValueError("The store of log entry {} is not available anymore".format(idx))
+        return store
+
+    def value(self, idx, path):
+        return self.app.storeValue(self.store(idx), path, idx)
+
+    def keys(self, idx, path):
+        ref = self.store(idx)._ref(path)
+        return list(ref.keys()) if isinstance(ref, dict) else None
+
+    def render(self, idx, path):
+        # the lines of path like LineView.jsonLines, paths outside of the
+        # scope are looked up like the store view does
+        key = (idx, tuple(path), self.provider.scope)
+        with self.lock:
+            lines = self.rendered.get(key)
+        if lines is None:
+            value = self.app.storeValue(self.store(idx), path, idx)
+            lines = json.dumps(value, indent=4, separators=(',', ': ')).splitlines()
+            with self.lock:
+                self.rendered[key] = lines
+                while len(self.rendered) > StoreEngine.RENDERED:
+                    self.rendered.popitem(last=False)
+        return lines
+
+    def lines(self, idx, path, first, count):
+        lines = self.render(idx, path)
+        return len(lines), lines[first:first + count]
+
+    def search(self, idx, path, string):
+        return [i for i, line in enumerate(self.render(idx, path)) if line.find(string) != -1]
+
+    def scope(self, path):
+        self.provider.setScope(path)
+        self.forget()
+
+    def stats(self):
+        return self.provider.stats()
+
+    def refresh(self):
+        self.app.provider.refresh()
+        with self.provider.paused():
+            self.app.loadLog()
+        self.forget()
+
+    def digest(self):
+        return self.app.provider.digest()
+
+    def entries(self, first, count):
+        # (number of entries, rows of RemoteLog)
+        log = self.app.log
+        return len(log), [(log.key(i), log.term(i), log.time(i), log.text(i), log.requestPaths(i))
+                          for i in range(first, min(first + count, len(log)))]
+
+    def lastAtOrBefore(self, key):
+        return self.app.log.lastAtOrBefore(key)
+
+    def grep(self, string):
+        predicate = AgencyLogList.grepPredicate(self.app.log, string)
+        return [i for i in range(len(self.app.log)) if predicate(i)]
+
+    def regexp(self, regexStr):
+        predicate = AgencyLogList.regexpPredicate(self.app.log, regexStr)
+        return [i for i in range(len(self.app.log)) if predicate(i)]
+
+    def changes(self, path, start):
+        return self.app.getPathIndex().changes(path, start)
+
+    def next(self, path, idx):
+        return self.app.getPathIndex().next(path, idx)
+
+    def prev(self, path, idx):
+        return self.app.getPathIndex().prev(path, idx)
+
+    def snapshots(self):
+        # keys of the compactions, see RemoteSnapshot
+        return [snapshot["_key"] for snapshot in self.app.snapshots]
+
+    def snapshot(self, key):
+        for snapshot in self.app.snapshots:
+            if snapshot["_key"] == key:
+                return dict(snapshot)
+        raise ValueError("There is no compaction with key {}".format(key))
+
+    def forget(self):
+        with self.lock:
+            self.stores = OrderedDict()
+            self.rendered = OrderedDict()
+
+
+def sorted_snapshots(snapshots):
+    # compactions by key, without duplicates
+    return sorted({s["_key"]: s for s in snapshots if s is not None}.values(), key=lambda s: s["_key"])
+
+
+class LogFileLoader:
+    # The part of a log file that is still being read when it is streamed,
+    # see ArangoAgencyLogFileProvider. Compactions, the agency state of an
+    # agency-dump and the digest are complete once done is set.
+
+    def __init__(self, logfile):
+        # the digest is of the file as it is, compressed or not
+        self.digest = diskcache.DatasetDigest()
+        self.digest.part(os.path.getsize(logfile))
+        self.f = decompress.InputFile(logfile, self.digest.update)
+        self.stream = logstream.LogStream(self.f)
+        self.entries = self.stream.entries()
+        self.lastKey = None
+        # whether the entries came in the order of their keys
+        self.sorted = True
+        self.done = False
+        self.snapshots = []
+        self.state = None
+        # raw bytes of the snapshot files, they follow the log in the digest
+        self.snapshotContents = []
+
+    def read(self, count=None, seconds=None):
+        # the next entries and their texts in the file, up to count of them
+        # or as many as are read within seconds
+        deadline = time.monotonic() + seconds if seconds is not None else None
+        entries = []
+        texts = []
+        for entry in self.entries:
+            key = entry["_key"]
+            if self.lastKey is not None and key < self.lastKey:
+                self.sorted = False
+            self.lastKey = key
+            entries.append(entry)
+            texts.append(self.stream.raw)
+            if (count is not None and len(entries) >= count) or \
+                    (deadline is not None and time.monotonic() >= deadline):
+                return entries, texts
+        self.finish()
+        return entries, texts
+
+    def finish(self):
+        # interprets the attributes besides the log, like a complete load
+        stream = self.stream
+        if stream.object:
+            if stream.logAttribute is None:
+                if "result" in stream.fields or "log" in stream.fields:
+                    raise Exception("Expected log to be a list")
+                raise Exception("Log file: can not interpret object")
+            if stream.logAttribute == "log":
+                self.snapshots.append(stream.fields.get("compaction"))
+                if "agency" in stream.fields and "index" in stream.fields:
+                    self.state = (stream.fields["index"], stream.fields["agency"])
+        # the digest covers the whole file, also what follows the log
+        while len(self.f.read(decompress.InputFile.CHUNK)) > 0:
+            pass
+        for content in self.snapshotContents:
+            self.digest.part(len(content))
+            self.digest.update(content)
+        self.done = True
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def progress(self):
+        return self.f.rawRead / self.f.size if self.f.size > 0 else 1.0
+
+
+class LogEntriesLoadedEvent:
+    # the next entries of a log that is streamed, with their texts
+    def __init__(self, loader, entries, texts, progress):
+        self.loader = loader
+        self.entries = entries
+        self.texts = texts
+        self.progress = progress
+
+
+class LogLoadedEvent:
+    # a streamed log is complete, or failed with error
+    def __init__(self, loader, error=None):
+        self.loader = loader
+        self.error = error
+
 
-    def __init__(self, logfile, snapshotFile):
+class ArangoAgencyLogFileProvider:
+    # With streaming, refresh only reads the first entries of the log file.
+    # The rest is read on a thread once start_loading is called, which
+    # queues them as LogEntriesLoadedEvent and ends with a LogLoadedEvent,
+    # after which the app calls loaded.
+    #
+    # A mapped log file is not loaded at all, see logtable.MappedLogTable,
+    # and neither is a log container, see logtable.writeContainer. Their
+    # digest is only computed when it is needed.
+    FIRST_ENTRIES = 1000
+    SNAPSHOT_SUFFIXES = (".json", ".json.gz", ".json.xz", ".json.bz2")
+    # how long entries are collected before they are queued, in seconds
+    BATCH_SECONDS = 0.2
+
+    def __init__(self, logfile, snapshotFiles, streaming=False, mapped=False, indexDirectory=None):
+        # snapshotFiles are files or directories of them, each one holding a
+        # compaction or a list of them. Indexes of mapped files are kept in
+        # indexDirectory, if there is one.
         self.logfile = logfile
-        self.snapshotFile = snapshotFile
+        self.snapshotFiles = snapshotFiles
+        self.streaming = streaming
+        self.mapped = mapped
+        self.indexDirectory = indexDirectory
+        self.loader = None
+        self.snapshotContents = None
         self.refresh()
 
     def log(self):
         return self._log
 
-    def snapshot(self):
-        return self._snapshot
+    def snapshots(self):
+        if self.loader is None:
+            return self._snapshots
+        # while loading, only compactions within the entries read so far can
+        # be placed, see snapshot_start
+        if len(self._log) == 0:
+            return []
+        last = self._log.key(len(self._log) - 1)
+        return [s for s in self._snapshots if s["_key"] <= last]
+
+    def agencyState(self):
+        # (index, state) of an agency-dump, None for plain logs. A log
+        # container only loads the state when it is asked for.
+        if callable(self._agencyState):
+            return self._agencyState()
+        return self._agencyState
 
     def start_live_view(self, first_index, app):
         pass
 
-    def refresh(self):
-        log = None
-        snapshot = None
-
-        with open(self.logfile, "r", encoding="utf-8") as f:
-            print("Loading log from `{}`".format(self.logfile))
-            log = json.load(f)
-            if isinstance(log, dict):
-                if "result" in log:
-                    print("Interpreting object as query result, using `result` attribute")
-                    log = log["result"]
-                elif "log" in log:
-                    print("Interpreting object as agency-dump result, using `log` and `compaction` attribute")
-                    snapshot = log.get("compaction")
-                    log = log.get("log")
-                else:
-                    raise Exception("Log file: can not interpret object")
-
-            if not isinstance(log, list):
-                raise Exception("Expected log to be a list")
-            log.sort(key=lambda x: x["_key"])
+    def start_loading(self, app):
+        loader = self.loader
+        if loader is not None:
+            threading.Thread(target=self.load, args=(loader, app), daemon=True).start()
 
-        if self.snapshotFile:
-            if snapshot == None:
-                with open(self.snapshotFile, "r", encoding="utf-8") as f:
-                    print("Loading snapshot from `{}`".format(self.snapshotFile))
-                    snapshot = json.load(f)
+    def load(self, loader, app):
+        # stops when the log is refreshed in the meantime
+        try:
+            while self.loader is loader and not loader.done:
+                entries, texts = loader.read(seconds=ArangoAgencyLogFileProvider.BATCH_SECONDS)
+                app.queueEvent(LogEntriesLoadedEvent(loader, entries, texts, loader.progress()))
+            if loader.done:
+                app.queueEvent(LogLoadedEvent(loader))
+        except Exception as e:
+            app.queueEvent(LogLoadedEvent(loader, str(e)))
+        finally:
+            loader.close()
+
+    def loadProgress(self):
+        # fraction of the log file read, None if it is loaded
+        loader = self.loader
+        return loader.progress() if loader is not None else None
+
+    def loaded(self):
+        # Takes over what is only known at the end of the file. Returns True
+        # if the log had to be sorted, indexes of entries have changed then.
+        loader, self.loader = self.loader, None
+        self._snapshots = sorted_snapshots(loader.snapshots)
+        self._agencyState = loader.state
+        self._digest = loader.digest.hexdigest()
+        if loader.sorted:
+            return False
+        self._log = self._log.sortedByKey()
+        return True
+
+    def digest(self):
+        # identifies the loaded log and snapshot for the disk cache
+        if self._digest is None and self.snapshotContents is not None:
+            digest = diskcache.DatasetDigest()
+            self._log.digestInto(digest)
+            for content in self.snapshotContents:
+                digest.part(len(content))
+                digest.update(content)
+            self._digest = digest.hexdigest()
+            self.snapshotContents = None
+        return self._digest
+
+    def snapshotPaths(self):
+        for path in self.snapshotFiles:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    if name.endswith(ArangoAgencyLogFileProvider.SNAPSHOT_SUFFIXES):
+                        yield os.path.join(path, name)
             else:
-                print("Ignoring snapshot file")
+                yield path
+
+    def readFile(self, path, contents):
+        # the decompressed content of path, the file as it is is appended to
+        # contents for the digest
+        chunks = []
+        with decompress.InputFile(path, chunks.append) as f:
+            data = f.read()
+        contents.append(chunks[0] if len(chunks) == 1 else b"".join(chunks))
+        return data
+
+    def readSnapshots(self, snapshots, contents):
+        for path in self.snapshotPaths():
+            print("Loading snapshot from `{}`".format(path))
+            snapshot = json.loads(self.readFile(path, contents))
+            if isinstance(snapshot, dict) and "result" in snapshot:
+                snapshot = snapshot["result"]
+            snapshots.extend(snapshot if isinstance(snapshot, list) else [snapshot])
+
+    def refresh(self):
+        if logtable.isContainer(self.logfile):
+            self.refreshContainer()
+            return
+        if self.mapped:
+            if not decompress.isCompressed(self.logfile):
+                self.refreshMapped()
+                return
+            print("`{}` is compressed and can not be mapped, consider a log container".format(self.logfile))
+        self.refreshFile()
+
+    def refreshMapped(self):
+        print("Mapping log from `{}`".format(self.logfile))
+        log = logtable.MappedLogTable(self.logfile, self.indexDirectory)
+        if not log.indexed and log.indexPath() is not None:
+            print("Indexed {} entries, the index is kept in `{}`".format(len(log), log.indexPath()))
+        elif not log.indexed:
+            print("Indexed {} entries, use --disk-cache to keep the index".format(len(log)))
+        snapshots = []
+        state = None
+        if log.object:
+            if log.logAttribute is None:
+                if "result" in log.fieldSpans or "log" in log.fieldSpans:
+                    raise Exception("Expected log to be a list")
+                raise Exception("Log file: can not interpret object")
+            if log.logAttribute == "log":
+                snapshots.append(log.field("compaction"))
+                if "agency" in log.fieldSpans and "index" in log.fieldSpans:
+                    state = (log.field("index"), log.field("agency"))
+        contents = []
+        self.readSnapshots(snapshots, contents)
+
+        self._log = log
+        self._snapshots = sorted_snapshots(snapshots)
+        self._agencyState = state
+        self._digest = None
+        self.snapshotContents = contents
+
+    def refreshContainer(self):
+        print("Opening log container `{}`".format(self.logfile))
+        log = logtable.ContainerLogTable(self.logfile)
+        snapshots = list(log.snapshots)
+        contents = []
+        self.readSnapshots(snapshots, contents)
 
         self._log = log
-        self._snapshot = snapshot
+        self._snapshots = sorted_snapshots(snapshots)
+        self._agencyState = log.agencyState
+        self._digest = None
+        self.snapshotContents = contents
+
+    def refreshFile(self):
+        # Without streaming the whole file is read at once. The thread of a
+        # previous loader stops on its own.
+        self.loader = None
+        print("Loading log from `{}`".format(self.logfile))
+        loader = LogFileLoader(self.logfile)
+        try:
+            self.readSnapshots(loader.snapshots, loader.snapshotContents)
+            entries, texts = loader.read(count=ArangoAgencyLogFileProvider.FIRST_ENTRIES if self.streaming else None)
+        except:
+            loader.close()
+            raise
+        self._log = logtable.LogTable(entries, texts)
+        self._snapshots = sorted_snapshots(loader.snapshots)
+        self._agencyState = None
+        self._digest = None
+        self.loader = loader
+        if loader.done:
+            # small enough to be read at once
+            self.loaded()
 
 
 class ArangoAgencyLogEndpointProvider:
@@ -1257,8 +3295,15 @@ class ArangoAgencyLogEndpointProvider:
     def log(self):
         return self._log
 
-    def snapshot(self):
-        return self._snapshot
+    def snapshots(self):
+        return self._snapshots
+
+    def agencyState(self):
+        return self._agencyState
+
+    def digest(self):
+        # the log of a server changes, nothing to keep checkpoints for
+        return None
 
     def refresh(self):
         role = self.client.serverRole()
@@ -1269,15 +3314,17 @@ class ArangoAgencyLogEndpointProvider:
             dump = self.client.agencyDump()
             if not isinstance(dump, dict):
                 raise Exception("Expected object in agency-dump")
-            self._log = dump.get("log")
-            self._snapshot = dump.get("compaction")
+            self._log = logtable.LogTable(dump.get("log") or [])
+            self._snapshots = sorted_snapshots([dump.get("compaction")])
+            self._agencyState = (dump["index"], dump["agency"]) if "agency" in dump and "index" in dump else None
         elif role == "AGENT":
             print("Querying for log")
-            self._log = list(self.client.query("for l in log sort l._key return l"))
-            print("Querying for snapshot")
-            snapshots = self.client.query("for s in compact filter s._key >= @first sort s._key limit 1 return s",
-                                          first=self._log[0]["_key"])
-            self._snapshot = next(iter(snapshots), None)
+            self._log = logtable.LogTable(self.client.query("for l in log sort l._key return l"))
+            print("Querying for snapshots")
+            # compactions that the log starts after are skipped by loadLog
+            snapshots = self.client.query("for s in compact sort s._key return s")
+            self._snapshots = sorted_snapshots(snapshots)
+            self._agencyState = None
         else:
             raise Exception("Unknown sever role " + role)
 
@@ -1292,6 +3339,12 @@ class ArangoAgencyLogEndpointProvider:
         except Exception as e:
             app.queueEvent(ExceptionInNetworkThread(str(e)))
 
+    def start_loading(self, app):
+        pass
+
+    def loadProgress(self):
+        return None
+
     def start_live_view(self, first_index, app):
         if self.process is not None:
             return
@@ -1329,7 +3382,7 @@ class ColorFormat:
     MARKING_ATTR_LIST = None
 
 
-def main(stdscr, provider, args):
+def main(stdscr, provider, args, engineClient):
     stdscr.clear()
     curses.curs_set(0)
 
@@ -1345,8 +3398,11 @@ def main(stdscr, provider, args):
         ColorPairs.getPair(curses.COLOR_BLACK, curses.COLOR_MAGENTA),
     ]
 
-    app = ArangoAgencyAnalyserApp(stdscr, provider, args)
-    app.run()
+    app = ArangoAgencyAnalyserApp(stdscr, provider, args, engineClient)
+    try:
+        app.run()
+    finally:
+        app.storeProvider.close()
 
 
 # A = ["0"]
@@ -1358,21 +3414,65 @@ if __name__ == '__main__':
     try:
         parser = argparse.ArgumentParser()
         parser.add_argument("log", help="log file or endpoint", type=str)
-        parser.add_argument('add', nargs='?', type=str, help="optional, snapshot file or jwt")
+        parser.add_argument('add', nargs='*', type=str,
+                            help="optional, snapshot files or directories of them, or jwt")
         parser.add_argument("-k", "--noverify", help="don't verify certs", action="store_true")
         parser.add_argument("-u", "--userpass", help="use username and password instead of jwt", action="store_true")
         parser.add_argument("--live", help="automatically receive updates (experimental)", action="store_true")
         parser.add_argument("--follow", help="start with follow mode on", action="store_true")
         parser.add_argument('-e', '--execute', action='append', help="execute this command during startup")
+        parser.add_argument("--mmap", help="map the log file into memory instead of loading it, entries are parsed "
+                                           "when they are used", action="store_true")
+        parser.add_argument("--no-streaming", help="load the whole log file before starting the ui",
+                            dest="streaming", action="store_false")
+        parser.add_argument("--no-prefetch", help="do not build checkpoints while idle", dest="prefetch",
+                            action="store_false")
+        parser.add_argument("--checkpoints", help="checkpoint placement policy (default adaptive)",
+                            choices=list(CHECKPOINT_POLICIES.keys()), default="adaptive")
+        parser.add_argument("--cache-mb", help="memory budget of the store cache in MB (default 1024)", type=int,
+                            default=1024)
+        parser.add_argument("--cold-checkpoints", help="compression of checkpoints evicted from memory (default none)",
+                            choices=list(COLD_COMPRESSION.keys()), default="none")
+        parser.add_argument("--sharded", help="replay long parts of the log in one process per top level subtree",
+                            action="store_true")
+        parser.add_argument("--disk-cache", help="keep checkpoints of log files in this directory", type=str)
+        parser.add_argument("--disk-cache-mb", help="size limit of the disk cache in MB (default 4096)", type=int,
+                            default=4096)
+        parser.add_argument("--engine", help="replay stores in a separate engine process", action="store_true")
+        parser.add_argument("--connect", help="use the engine serving on this address (host:port or socket path)",
+                            type=str)
+        parser.add_argument("--convert", help="write the log with its snapshots into this log container and exit",
+                            type=str)
+        parser.add_argument("--serve", help="run an engine for the log without ui, on this address", type=str)
+        parser.add_argument("--attached", help=argparse.SUPPRESS, action="store_true")
         args = parser.parse_args()
 
+        if args.live and (args.engine or args.connect):
+            parser.error("--live does not work with an engine")
+        if args.convert is not None and (args.engine or args.connect or args.serve):
+            parser.error("--convert does not work with an engine")
+        engineProcess = None
+        if args.engine:
+            args.connect, engineProcess = engine.spawn(os.path.abspath(__file__),
+                                                       [arg for arg in sys.argv[1:] if not arg == "--engine"])
+
         o = urlparse(args.log)
 
-        if not o.netloc:
-            provider = ArangoAgencyLogFileProvider(o.path, args.add)
+        engineClient = None
+        if args.connect is not None:
+            # the ui shows the log of the engine instead of loading it
+            print("Connecting to engine at {}".format(args.connect))
+            engineClient = engine.EngineClient(args.connect, engineProcess)
+            provider = RemoteLogProvider(engineClient)
+        elif not o.netloc:
+            # an engine needs the whole log, the ui shows the first entries
+            # while the rest is read
+            streaming = args.streaming and args.serve is None and args.convert is None
+            indexDirectory = os.path.join(args.disk_cache, "index") if args.disk_cache is not None else None
+            provider = ArangoAgencyLogFileProvider(o.path, args.add, streaming, args.mmap, indexDirectory)
         else:
             host = o.netloc
-            authstr = args.add
+            authstr = args.add[0] if len(args.add) > 0 else None
             auth = None
 
             if not authstr is None:
@@ -1399,8 +3499,21 @@ if __name__ == '__main__':
             client = ArangoClient(conn, auth)
             provider = ArangoAgencyLogEndpointProvider(client)
 
+        if args.convert is not None:
+            print("Writing log container `{}`".format(args.convert))
+            logtable.writeContainer(args.convert, provider.log(), provider.snapshots(), provider.agencyState())
+            sys.exit(0)
+
+        if args.serve is not None:
+            storeEngine = StoreEngine(EngineApp(provider, args))
+            try:
+                engine.serve(args.serve, storeEngine.handle, args.attached, storeEngine.closed,
+                             storeEngine.provider.close)
+            finally:
+                storeEngine.provider.close()
+
         os.putenv("ESCDELAY", "0")  # Ugly hack to enabled escape key for direct use
-        curses.wrapper(main, provider, args)
+        curses.wrapper(main, provider, args, engineClient)
         os._exit(1)
     except Exception as e:
         raise e
@@ -3,26 +3,154 @@ import json
 import copy
 import dateutil.parser, datetime
 import heapq
+import array
+
+class AgencyTtl:
+
+    # Deadlines of keys with a time to live. The heap may contain entries
+    # that were replaced or removed in the meantime, those are dropped when
+    # they reach the top. An entry is valid if it matches the deadline map.
+
+    def __init__(self):
+        self.deadlines = dict()
+        self.heap = []
+
+    def __contains__(self, key):
+        return key in self.deadlines
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def copy(self):
+        ttl = AgencyTtl()
+        ttl.deadlines = self.deadlines.copy()
+        ttl.heap = self.heap.copy()
+        return ttl
+
+    def set(self, key, path, deadline):
+        self.deadlines[key] = (deadline, path)
+        heapq.heappush(self.heap, (deadline, key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.compact()
+
+    def remove(self, key):
+        self.deadlines.pop(key, None)
+
+    def due(self, now):
+        return len(self.heap) > 0 and self.heap[0][0] < now
+
+    def restore(self, key, entry):
+        # reverts key to an entry previously returned by get
+        if entry is None:
+            self.deadlines.pop(key, None)
+        else:
+            self.deadlines[key] = entry
+            heapq.heappush(self.heap, (entry[0], key))
+
+    def get(self, key):
+        return self.deadlines.get(key)
+
+    def expire(self, now):
+        # removes all entries that are before now, returns (key, entry) pairs
+        expired = []
+        while len(self.heap) > 0 and self.heap[0][0] < now:
+            deadline, key = heapq.heappop(self.heap)
+            entry = self.deadlines.get(key)
+            if entry is not None and entry[0] == deadline:
+                del self.deadlines[key]
+                expired.append((key, entry))
+        return expired
+
+    def compact(self):
+        self.heap = [(deadline, key) for key, (deadline, _) in self.deadlines.items()]
+        heapq.heapify(self.heap)
+
 
 class AgencyStore:
 
-    def __init__(self, store = {}, ttlt = []):
-        self.store = copy.deepcopy(store)
-        self.ttlt = copy.deepcopy(ttlt)
+    # The store is a persistent tree of plain dicts and lists. Nodes may be
+    # shared between several stores (e.g. checkpoints in the StoreCache), so
+    # a node is only modified in place if this store owns it, i.e. created it
+    # since the last copy. Everything else is copied on write, which means
+    # that only the path from the root to the modified node is duplicated.
+    # The same holds for the ttl schedule, which is copied as a whole.
+    #
+    # Owned nodes are kept referenced, so their ids are not reused while
+    # they are in _owned. Nodes that left the tree stay there as well, after
+    # a run that leaves more than OWNED of them ownership starts over, which
+    # costs one more copy of the paths written next.
+    OWNED = 4096
+
+    def __init__(self, store = {}, ttl = None):
+        self.store = store
+        self.ttl = ttl if ttl is not None else AgencyTtl()
+        self._ttlOwned = ttl is None
+        self._owned = dict()
 
     def __str__(self):
         return json.dumps(self.store)
 
     def copyFrom(store):
-        return AgencyStore(store.store, store.ttlt)
+        # from now on both stores share all nodes
+        store._owned.clear()
+        store._ttlOwned = False
+        return AgencyStore(store.store, store.ttl)
+
+    def replaceTtl(self, ttl):
+        # the schedule is owned by this store from now on
+        self.ttl = ttl
+        self._ttlOwned = True
+
+    def _writableTtl(self):
+        if not self._ttlOwned:
+            self.ttl = self.ttl.copy()
+            self._ttlOwned = True
+        return self.ttl
+
+    def _own(self, node):
+        if not isinstance(node, (dict, list)) or id(node) in self._owned:
+            return node
+        node = node.copy()
+        # keep a reference, so the id is not reused while we rely on it
+        self._owned[id(node)] = node
+        return node
+
+    def _root(self):
+        self.store = self._own(self.store)
+        return self.store
+
+    def _child(self, node, key):
+        # node has to be owned by this store
+        child = node[key]
+        owned = self._own(child)
+        if owned is not child:
+            node[key] = owned
+        return owned
+
+    def _writable(self, path):
+        # same as _ref, but returns a node that can be modified in place
+        node = self._root()
+        for x in path:
+            try:
+                key = int(x) if isinstance(node, list) else x
+                node[key]
+            except:
+                return None
+            node = self._child(node, key)
+        return node
+
+    def _object(self, path):
+        # the writable object at path, replacing whatever is not an object
+        store = self._root()
+        for x in path:
+            if not x in store or not isinstance(store[x], dict):
+                store[x] = self._own({})
+            store = self._child(store, x)
+        return store
 
     def set(self, path, value):
-        store = self.store
-        for x in path[:-1]:
-            if not x in store or not isinstance(store[x], dict):
-                store[x] = {}
-            store = store[x]
-        store[path[-1]] = copy.deepcopy(value)
+        store = self._object(path[:-1])
+        store[path[-1]] = value
 
     def delete(self, path):
         store = self.store
@@ -30,17 +158,20 @@ class AgencyStore:
             if not isinstance(store, dict) or not x in store:
                 return
             store = store[x]
-        if not isinstance(store, dict):
+        if not isinstance(store, dict) or not path[-1] in store:
             return
+        store = self._root()
+        for x in path[:-1]:
+            store = self._child(store, x)
         store.pop(path[-1], None)
 
     def push(self, path, value):
-        ref = self._ref(path[:-1])
+        ref = self._writable(path[:-1])
         if isinstance(ref, dict):
             key = path[-1]
             if key in ref:
                 if isinstance(ref[key], list):
-                    ref[key].append(value)
+                    self._child(ref, key).append(value)
                 else:
                     ref[key] = [value]
             else:
@@ -50,14 +181,15 @@ class AgencyStore:
 
     def push_queue(self, path, value, max_len):
         default_value = [value][-max_len:] if max_len > 0 else []
-        ref = self._ref(path[:-1])
+        ref = self._writable(path[:-1])
         if isinstance(ref, dict):
             key = path[-1]
             if key in ref:
                 if isinstance(ref[key], list):
-                    ref[key].append(value)
-                    while len(ref[key]) > max_len:
-                        ref[key].pop(0)
+                    queue = self._child(ref, key)
+                    queue.append(value)
+                    while len(queue) > max_len:
+                        queue.pop(0)
                 else:
                     ref[key] = default_value
             else:
@@ -68,26 +200,26 @@ class AgencyStore:
     def pop(self, path):
         ref = self._ref(path)
         if isinstance(ref, list):
-            ref.pop()
+            self._writable(path).pop()
 
     def shift(self, path):
         ref = self._ref(path)
         if isinstance(ref, list):
-            ref.pop(0)
+            self._writable(path).pop(0)
 
     def erase(self, path, value):
         ref = self._ref(path)
         if isinstance(ref, list):
             if value in ref:
-                ref.remove(value)
+                self._writable(path).remove(value)
 
     def prepend(self, path, value):
-        ref = self._ref(path[:-1])
+        ref = self._writable(path[:-1])
         if isinstance(ref, dict):
             key = path[-1]
             if key in ref:
                 if isinstance(ref[key], list):
-                    ref[key].insert(0, value)
+                    self._child(ref, key).insert(0, value)
                 else:
                     ref[key] = [value]
             else:
@@ -96,7 +228,7 @@ class AgencyStore:
             self.set(path, [value])
 
     def add(self, path, delta):
-        ref = self._ref(path[:-1])
+        ref = self._writable(path[:-1])
         if isinstance(ref, dict):
             key = path[-1]
             if key in ref:
@@ -109,13 +241,37 @@ class AgencyStore:
         else:
             self.set(path, delta)
 
-    def applyLog(self, log):
-        now = None
+    def applyLog(self, log, now = None):
+        # now can be passed if the time of the entry is already known
+        if now is None:
+            now = AgencyStore.logTime(log)
+        self.apply(log["request"], now)
+
+    def logTime(log):
+        # seconds since epoch of a log entry, 0 if unknown
+        if "epoch_millis" in log:
+            return log["epoch_millis"] / 1000
         try:
-            now = dateutil.parser.parse(log["timestamp"]) if "timestamp" in log else None
+            if "timestamp" in log:
+                return datetime.datetime.timestamp(dateutil.parser.parse(log["timestamp"]))
         except:
             pass
-        self.apply(log["request"], 0 if now is None else datetime.datetime.timestamp(now))
+        return 0
+
+    def logTimes(log):
+        # consecutive entries mostly share the same timestamp string,
+        # so each distinct string is parsed only once
+        times = array.array('d')
+        parsed = dict()
+        for ent in log:
+            if "epoch_millis" in ent or not "timestamp" in ent:
+                times.append(AgencyStore.logTime(ent))
+                continue
+            ts = ent["timestamp"]
+            if not ts in parsed:
+                parsed[ts] = AgencyStore.logTime(ent)
+            times.append(parsed[ts])
+        return times
 
 
     def readLock(self, path, user):
@@ -135,18 +291,22 @@ class AgencyStore:
 
     def replace(self, path, val, new):
         ref = self._ref(path)
-        if isinstance(ref, list):
+        if isinstance(ref, list) and val in ref:
+            ref = self._writable(path)
             for index, entry in enumerate(ref):
                 if entry == val:
                     ref[index] = new
 
     def update(self, path, val, mergeObjects, keepNull):
-        ref = self.get(path)
+        ref = self._ref(path)
         if not isinstance(ref, dict):
             ref = {}
 
         def merge(under, over):
-            ret = copy.deepcopy(under)
+            # nested objects are merged into fresh copies, untouched
+            # subtrees are shared with the previous value
+            ret = dict(under)
+            self._owned[id(ret)] = ret
             for k, v in over.items():
                 if v is None:
                     if keepNull:
@@ -166,96 +326,253 @@ class AgencyStore:
         self.set(path, result)
 
 
-    def executeOperation(self, path, op, value):
-        if op == "shift":
-            self.shift(path)
-        elif op == "prepend":
-            self.prepend(path, value['new'])
-        elif op == "increment":
-            delta = value['step'] if 'step' in value else 1
-            self.add(path, delta)
-        elif op == "decrement":
-            delta = value['step'] if 'step' in value else 1
-            self.add(path, - delta)
-        elif op == "delete" :
-            self.delete(path)
-        elif op == "set":
-            self.set(path, value['new'])
-        elif op == "push":
-            self.push(path, value['new'])
-        elif op == "push-queue":
-            self.push_queue(path, value['new'], value['len'])
-        elif op == "pop":
-            self.pop(path)
-
-        elif op == "read-lock":
-            self.readLock(path, value['by'])
-        elif op == "read-unlock":
-            self.readUnlock(path, value['by'])
-        elif op == "write-lock":
-            self.writeLock(path, value['by'])
-        elif op == "write-unlock":
-            self.writeUnlock(path, value['by'])
-
-        elif op == "erase":
-            self.erase(path, value['val'])
-        elif op == "replace":
-            self.replace(path, value['val'], value['new'])
-        elif op == "unobserve" or op == "observe":
-            pass
-        elif op == "update":
-            mergeObjects = value.get("mergeObjects", True)
-            keepNull = value.get("keepNull", False)
-            self.update(path, value['val'], mergeObjects, keepNull)
-        else:
-            raise Exception("Unknown operation")
+    def _noop(self, path):
+        pass
+
+    def _missingField(self, path, field):
+        raise KeyError(field)
+
+    def _unknownOperation(self, path):
+        raise Exception("Unknown operation")
+
+    # Maps an operation to a function that extracts the store method and its
+    # operands from the request value. Missing fields raise a KeyError.
+    OPERATIONS = {
+        "shift": lambda value: (AgencyStore.shift, ()),
+        "prepend": lambda value: (AgencyStore.prepend, (value['new'],)),
+        "increment": lambda value: (AgencyStore.add, (value['step'] if 'step' in value else 1,)),
+        "decrement": lambda value: (AgencyStore.add, (- (value['step'] if 'step' in value else 1),)),
+        "delete": lambda value: (AgencyStore.delete, ()),
+        "set": lambda value: (AgencyStore.set, (value['new'],)),
+        "push": lambda value: (AgencyStore.push, (value['new'],)),
+        "push-queue": lambda value: (AgencyStore.push_queue, (value['new'], value['len'])),
+        "pop": lambda value: (AgencyStore.pop, ()),
+
+        "read-lock": lambda value: (AgencyStore.readLock, (value['by'],)),
+        "read-unlock": lambda value: (AgencyStore.readUnlock, (value['by'],)),
+        "write-lock": lambda value: (AgencyStore.writeLock, (value['by'],)),
+        "write-unlock": lambda value: (AgencyStore.writeUnlock, (value['by'],)),
+
+        "erase": lambda value: (AgencyStore.erase, (value['val'],)),
+        "replace": lambda value: (AgencyStore.replace, (value['val'], value['new'])),
+        "observe": lambda value: (AgencyStore._noop, ()),
+        "unobserve": lambda value: (AgencyStore._noop, ()),
+        "update": lambda value: (AgencyStore.update, (value['val'], value.get("mergeObjects", True),
+                                                      value.get("keepNull", False))),
+    }
+
+    def compile(request, interner=None):
+        # Translates a request into a program, a list of records
+        #   (op, function, path, normalizedPath, ttl, operands)
+        # Paths are parsed only once and run does not need to look at the
+        # request anymore. normalizedPath is None for values that are
+        # assigned directly, those do not touch the ttl. With a
+        # hashcons.Interner, paths and values are shared with equal ones of
+        # other programs.
+        program = []
+        for path, value in request.items():
+            path = tuple(AgencyStore.parsePath(path))
+            if interner is not None:
+                path = interner.path(path)
+                value = interner.value(value)
+
+            if (not isinstance(value, dict)) or ( not 'op' in value and not 'new' in value ):
+                program.append(("set", AgencyStore.set, path, None, None, (value,)))
+                continue
+
+            op = value['op'] if 'op' in value else 'set'
+            normalizedPath = "/".join(path)
+            if interner is not None:
+                normalizedPath = interner.string(normalizedPath)
+            ttl = value.get('ttl')
+            try:
+                function, operands = AgencyStore.OPERATIONS[op](value) if op in AgencyStore.OPERATIONS else \
+                    (AgencyStore._unknownOperation, ())
+            except KeyError as e:
+                # fail when the operation is executed, like the agency would
+                function, operands = AgencyStore._missingField, (e.args[0],)
+            program.append((op, function, path, normalizedPath, ttl, operands))
+        return program
 
     def apply(self, request, now = None):
+        self.run(AgencyStore.compile(request), now)
+
+    def run(self, program, now = None, undo = None):
+        # If undo is a list, the records needed by revert to restore the
+        # current state are appended to it.
 
         # Lets have a look into the TTL
-        if not now == None:
-            while len(self.ttlt) > 0:
-                top = self.ttlt[0]
-                mintime = top[0]
-                # remove all entries that are before now
-                if mintime < now:
-                    self.delete(top[1])
-                    heapq.heappop(self.ttlt)
-                else:
-                    break
+        if not now == None and self.ttl.due(now):
+            self.expire(now, undo)
 
-        for path in request:
-            value = request[path]
-            path = AgencyStore.parsePath(path)
+        for op, function, path, normalizedPath, ttl, operands in program:
+            if not undo is None:
+                self._recordPreimage(path, undo)
 
-            if (not isinstance(value, dict)) or ( not 'op' in value and not 'new' in value ):
-                # directly apply value
-                self.set(path, value)
-            else:
-                op = value['op'] if 'op' in value else 'set'
-                normalizedPath = "/".join(path)
+            if not normalizedPath is None:
+                if not undo is None and (normalizedPath in self.ttl or not ttl is None):
+                    undo.append(("ttl", normalizedPath, self.ttl.get(normalizedPath)))
 
-                if len(self.ttlt) > 0:
+                if normalizedPath in self.ttl:
                     # delete the old ttl entry
-                    for i, x in enumerate(self.ttlt):
-                        if x[1] == normalizedPath:
-                            del self.ttlt[i]
-
-                if 'ttl' in value and not now == None:
-                    heapq.heappush(self.ttlt, (now + value['ttl'], normalizedPath))
-
-                try:
-                    self.executeOperation(path, op, value)
-                except KeyError as e:
-                    raise Exception("{path}: Missing field for operation `{op}`: {text}".format(path=normalizedPath, op=op, text=repr(e)))
-                except Exception as e:
-                    raise Exception("{path}: Exception when executing operation `{op}`: {text}".format(path=normalizedPath, op=op, text=repr(e)))
-
-
+                    self._writableTtl().remove(normalizedPath)
+
+                if not ttl is None and not now == None:
+                    self._writableTtl().set(normalizedPath, path, now + ttl)
+
+            try:
+                function(self, path, *operands)
+            except KeyError as e:
+                raise Exception("{path}: Missing field for operation `{op}`: {text}".format(path="/".join(path), op=op, text=repr(e)))
+            except Exception as e:
+                raise Exception("{path}: Exception when executing operation `{op}`: {text}".format(path="/".join(path), op=op, text=repr(e)))
+
+        if len(self._owned) > AgencyStore.OWNED:
+            self._owned.clear()
+
+    def expire(self, now, undo=None):
+        # deletes the keys whose ttl is before now, returns their paths
+        paths = []
+        for key, entry in self._writableTtl().expire(now):
+            if not undo is None:
+                undo.append(("ttl", key, entry))
+                self._recordPreimage(entry[1], undo)
+            self.delete(entry[1])
+            paths.append(entry[1])
+        return paths
+
+    def _recordPreimage(self, path, undo):
+        # An operation on path only modifies the subtree below the first
+        # prefix of path that is not an object. Remember that subtree as it
+        # is now. Nothing in it is owned afterwards, so it is never modified
+        # in place and can be put back as is.
+        node = self.store
+        depth = len(path)
+        for i, x in enumerate(path[:-1]):
+            child = node.get(x)
+            if not isinstance(child, dict):
+                depth = i + 1
+                break
+            node = child
+
+        if depth == 0:
+            self._owned.clear()
+            undo.append(("node", (), True, self.store))
+        else:
+            key = path[depth - 1]
+            self._disown(node.get(key))
+            undo.append(("node", path[:depth], key in node, node.get(key)))
+
+    def _disown(self, node):
+        # gives up the nodes of a subtree. Owned nodes only have owned
+        # parents, so the walk stops at nodes that are not owned.
+        stack = [node]
+        while len(stack) > 0:
+            node = stack.pop()
+            if self._owned.pop(id(node), None) is None:
+                continue
+            stack.extend(node.values() if isinstance(node, dict) else node)
+
+    def revert(self, undo):
+        # undoes the run that recorded undo, the store has to be in the
+        # state right after that run
+        for record in reversed(undo):
+            if record[0] == "ttl":
+                _, key, entry = record
+                self._writableTtl().restore(key, entry)
+            else:
+                _, path, existed, value = record
+                if len(path) == 0:
+                    self.store = value
+                elif existed:
+                    self.set(path, value)
+                else:
+                    self.delete(path)
+
+    def prune(self, prefix):
+        # Drops everything that is neither on the way to prefix nor below it.
+        # Operations on prefix, on its parents or below it behave the same on
+        # the pruned store, as long as the parents of prefix are objects.
+        def pruned(node, depth):
+            if depth == len(prefix) or not isinstance(node, dict):
+                return node
+            key = prefix[depth]
+            if not key in node:
+                return {}
+            return {key: pruned(node[key], depth + 1)}
+
+        self._owned.clear()
+        self.store = pruned(self.store, 0)
+
+    def delta(old, new):
+        # Differences between two trees as (path, exists, value) records, the
+        # least that patch needs to turn old into new. Objects are compared
+        # key by key, everything else is replaced as a whole. Subtrees that
+        # are equal, in particular shared ones, are not descended into.
+        delta = []
+        def walk(path, old, new):
+            for key, value in new.items():
+                if not key in old:
+                    delta.append((path + (key,), True, value))
+                    continue
+                other = old[key]
+                if other is value or (type(other) is type(value) and other == value):
+                    continue
+                if isinstance(value, dict) and isinstance(other, dict):
+                    walk(path + (key,), other, value)
+                else:
+                    delta.append((path + (key,), True, value))
+            for key in old:
+                if not key in new:
+                    delta.append((path + (key,), False, None))
+
+        walk((), old, new)
+        return delta
+
+    def writeDelta(self, delta):
+        # Applies the records of delta, like patch, but copies shared nodes
+        # on write. The objects on the way to the previous record are kept,
+        # records close to each other, which delta returns one after another,
+        # only look up the part of their path that differs.
+        parentPath = ()
+        nodes = [self._root()]
+        for path, exists, value in delta:
+            if not exists:
+                self.delete(path)
+                continue
+            if not path[:-1] == parentPath:
+                common = 0
+                for x, y in zip(path[:-1], parentPath):
+                    if not x == y:
+                        break
+                    common += 1
+                del nodes[common + 1:]
+                for x in path[common:-1]:
+                    node = nodes[-1]
+                    if not x in node or not isinstance(node[x], dict):
+                        node[x] = self._own({})
+                    nodes.append(self._child(node, x))
+                parentPath = path[:-1]
+            nodes[-1][path[-1]] = value
+
+    def patch(tree, delta):
+        # applies the records of delta in place, tree must not be shared
+        for path, exists, value in delta:
+            node = tree
+            for x in path[:-1]:
+                node = node[x]
+            if exists:
+                node[path[-1]] = value
+            else:
+                del node[path[-1]]
 
     def parsePath(path):
         return list(filter(None, path.split('/')))
 
+    def pathPrefix(path):
+        # a/b/ for (a, b), a string prefix of the same form of all paths below
+        return "".join(x + "/" for x in path)
+
     def _ref(self, path):
         result = self.store
         try:
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import gc
+from array import array
+
+import agency
+import pathindex
+import logtable
+import hashcons
+import tracemalloc
+
+
+def synthetic_ttl_log(count, servers, seed=0):
+    # Mimics a cluster where most entries are heartbeats and locks, every one
+    # of them carrying a ttl and refreshing a previously set key.
+    rnd = random.Random(seed)
+    log = []
+    for i in range(count):
+        server = "PRMR-{}".format(rnd.randrange(servers))
+        kind = rnd.random()
+        if kind < 0.6:
+            request = {
+                "arango/Supervision/Health/" + server: {
+                    "op": "set", "ttl": 15,
+                    "new": {"Status": "GOOD", "Endpoint": "tcp://[::1]:8530", "ShortName": server}
+                }
+            }
+        elif kind < 0.8:
+            request = {"arango/Sync/ServerStates/" + server: {"op": "set", "ttl": 5, "new": {"time": i}}}
+        elif kind < 0.9:
+            request = {"arango/Supervision/Shards/s{}".format(rnd.randrange(servers * 10)):
+                           {"op": "write-lock", "by": server, "ttl": 30}}
+        else:
+            request = {"arango/Sync/LatestID": {"op": "increment", "step": 1}}
+        log.append({"_key": "{:020}".format(i), "request": request, "now": 1000 + i / 10})
+    return log
+
+
+def synthetic_log(count, seed=0, databases=4, collections=50, servers=9):
+    # A mix of heartbeats, plan and current changes, counters and merges,
+    # roughly distributed like in the logs of a busy cluster.
+    rnd = random.Random(seed)
+    log = []
+    for i in range(count):
+        server = "PRMR-{}".format(rnd.randrange(servers))
+        database = "db{}".format(rnd.randrange(databases))
+        collection = str(rnd.randrange(collections))
+        shard = "s{}{}".format(collection, rnd.randrange(4))
+        kind = rnd.random()
+        if kind < 0.4:
+            request = {"arango/Supervision/Health/" + server: {"op": "set", "new": {"Status": "GOOD", "Timestamp": i}}}
+        elif kind < 0.5:
+            request = {
+                "arango/Plan/Collections/{}/{}".format(database, collection): {
+                    "op": "set", "new": {
+                        "name": "c" + collection, "replicationFactor": 3,
+                        "shards": {"s{}{}".format(collection, j): [server, "PRMR-0", "PRMR-1"] for j in range(4)},
+                    }
+                },
+                "arango/Plan/Version": {"op": "increment"},
+            }
+        elif kind < 0.7:
+            request = {
+                "arango/Current/Collections/{}/{}/{}/{}".format(database, collection, shard, server): {
+                    "op": "set", "new": {"servers": [server, "PRMR-0"], "error": False, "indexes": []}
+                },
+                "arango/Current/Version": {"op": "increment"},
+            }
+        elif kind < 0.8:
+            request = {"arango/Target/Pending/{}".format(i): {"op": "update", "val": {"type": "moveShard", "shard": shard}}}
+        elif kind < 0.9:
+            request = {"arango/Target/Pending/{}".format(rnd.randrange(max(i, 1))): {"op": "delete"}}
+        else:
+            request = {"arango/Sync/LatestID": {"op": "increment", "step": 1}}
+        log.append({"_key": "{:020}".format(i), "request": request, "now": 1000 + i / 10})
+    return log
+
+
+def example_log(filename):
+    with open(filename, "r", encoding="utf-8") as f:
+        log = json.load(f)
+    if isinstance(log, dict):
+        log = log.get("result") or log.get("log")
+    log.sort(key=lambda x: x["_key"])
+    times = agency.AgencyStore.logTimes(log)
+    return [{"_key": e["_key"], "request": e["request"], "now": times[i]} for i, e in enumerate(log)]
+
+
+def example_logs():
+    base = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example")
+    return [(name, example_log(os.path.join(base, name))) for name in ["small.json", "agency-dump.json"]]
+
+
+def replay(log, store=None):
+    store = store or agency.AgencyStore()
+    start = time.perf_counter()
+    for ent in log:
+        store.apply(ent["request"], ent["now"])
+    return store, time.perf_counter() - start
+
+
+def report(name, count, seconds):
+    print("{:<40} {:>10} entries {:>8.3f} s {:>12.0f} entries/s".format(name, count, seconds, count / seconds))
+
+
+def bench_ttl(args):
+    for servers in [10, 100, 1000]:
+        log = synthetic_ttl_log(args.count, servers)
+        store, seconds = replay(log)
+        report("ttl replay, {} servers".format(servers), len(log), seconds)
+        print("  pending ttl entries: {}".format(len(store.ttl)))
+
+
+def interpret(store, request, now):
+    # applies a request without a program, like AgencyStore.apply did before
+    # requests were compiled: every replay parses the paths and looks up the
+    # operations again
+    if store.ttl.due(now):
+        store.expire(now)
+    for path, value in request.items():
+        path = agency.AgencyStore.parsePath(path)
+        if not isinstance(value, dict) or (not "op" in value and not "new" in value):
+            store.set(path, value)
+            continue
+        normalizedPath = "/".join(path)
+        if normalizedPath in store.ttl:
+            store._writableTtl().remove(normalizedPath)
+        if "ttl" in value:
+            store._writableTtl().set(normalizedPath, tuple(path), now + value["ttl"])
+        function, operands = agency.AgencyStore.OPERATIONS[value.get("op", "set")](value)
+        function(store, path, *operands)
+
+
+def replay_interpreted(log, store=None):
+    store = store or agency.AgencyStore()
+    start = time.perf_counter()
+    for ent in log:
+        interpret(store, ent["request"], ent["now"])
+    return store, time.perf_counter() - start
+
+
+def replay_programs(programs, log, store=None):
+    store = store or agency.AgencyStore()
+    start = time.perf_counter()
+    for program, ent in zip(programs, log):
+        store.run(program, ent["now"])
+    return store, time.perf_counter() - start
+
+
+def bench_replay(args):
+    logs = example_logs() + [("synthetic", synthetic_log(args.count))]
+    for name, log in logs:
+        # small logs are replayed several times to get a stable measurement
+        rounds = max(1, args.count // len(log))
+
+        start = time.perf_counter()
+        programs = [agency.AgencyStore.compile(ent["request"]) for ent in log]
+        compileTime = time.perf_counter() - start
+
+        interpreted = sum(replay_interpreted(log)[1] for _ in range(rounds))
+        compiled = sum(replay_programs(programs, log)[1] for _ in range(rounds))
+        report("{} interpreted".format(name), len(log) * rounds, interpreted)
+        report("{} compiled".format(name), len(log) * rounds, compiled)
+        print("  compiling once took {:.3f} s, compiled replay is {:.2f}x faster".format(compileTime, interpreted / compiled))
+        same = replay_interpreted(log)[0], replay_programs(programs, log)[0]
+        print("  same store: {}".format(same[0].store == same[1].store and
+                                         same[0].ttl.deadlines == same[1].ttl.deadlines))
+
+
+def bench_lookup(args):
+    log = synthetic_log(args.count)
+    start = time.perf_counter()
+    lookup = pathindex.PathLookup(log)
+    report("lookup, compile and index", len(log), time.perf_counter() - start)
+
+    rnd = random.Random(1)
+    paths = [["arango", "Plan", "Version"], ["arango", "Sync", "LatestID"], ["arango", "Supervision", "Health", "PRMR-3"],
+             ["arango", "Plan", "Collections", "db1", "7"], ["arango", "Target", "Pending", "500"]]
+    queries = [(rnd.choice(paths), rnd.randrange(len(log))) for _ in range(10000)]
+    for name, ordered in [("random", queries), ("increasing", sorted(queries, key=lambda x: x[1]))]:
+        lookup.memo.clear()
+        start = time.perf_counter()
+        for path, idx in ordered:
+            lookup.valueAt(path, idx)
+        seconds = time.perf_counter() - start
+        print("  {} {} lookups: {:.1f} us per lookup".format(len(ordered), name, seconds / len(ordered) * 1e6))
+        # the same questions again, now served from the remembered states
+        start = time.perf_counter()
+        for path, idx in ordered:
+            lookup.valueAt(path, idx)
+        seconds = time.perf_counter() - start
+        print("  {} {} lookups, repeated: {:.1f} us per lookup".format(len(ordered), name, seconds / len(ordered) * 1e6))
+
+    store, seconds = replay(log)
+    print("  for comparison, replaying the store up to a random entry takes {:.0f} us on average".format(seconds / 2 * 1e6))
+
+
+class ReplayApp:
+    # the parts of ArangoAgencyAnalyserApp used by the StoreProvider
+    def __init__(self, log, checkpoints, cacheMb, cold="none", sharded=False):
+        self.log = logtable.LogTable(log)
+        self.logTimes = array('d', (e["now"] for e in log))
+        self.logPrograms = [agency.AgencyStore.compile(e["request"]) for e in log]
+        self.logPathSummaries = [tuple(agency.AgencyStore.pathPrefix(record[2]) for record in program)
+                                 for program in self.logPrograms]
+        self.snapshot = None
+        self.firstValidLogIdx = None
+        self.args = argparse.Namespace(checkpoints=checkpoints, cache_mb=cacheMb, cold_checkpoints=cold,
+                                       sharded=sharded)
+
+    def logProgram(self, i):
+        return self.logPrograms[i]
+
+    def logPaths(self, i):
+        return self.logPathSummaries[i]
+
+    def showProgress(self, *args, **kwargs):
+        pass
+
+
+def with_merges(log, every, size, seed=0):
+    # replaces every n-th entry by a large merge, which is expensive to replay
+    rnd = random.Random(seed)
+    log = list(log)
+    for i in range(0, len(log), every):
+        val = {"s{}".format(rnd.randrange(size * 10)): {"servers": ["PRMR-0", "PRMR-1"], "index": i} for _ in range(size)}
+        log[i] = dict(log[i], request={"arango/Current/Merged": {"op": "update", "val": val}})
+    return log
+
+
+def navigation(count, length, seed=0):
+    # Seeks of a user: jumps to random entries, jumps close to a few entries
+    # of interest and browsing around the last position.
+    rnd = random.Random(seed)
+    spots = [rnd.randrange(length) for _ in range(5)]
+    idx = length - 1
+    result = []
+    for _ in range(count):
+        kind = rnd.random()
+        if kind < 0.3:
+            idx = rnd.randrange(length)
+        elif kind < 0.6:
+            idx = rnd.choice(spots) + rnd.randrange(-5000, 5000)
+        else:
+            idx += rnd.randrange(-50, 50)
+        idx = min(max(idx, 0), length - 1)
+        result.append(idx)
+    return result
+
+
+def seek(provider, seeks):
+    # sorted latencies of the seeks and the garbage collection time of the
+    # slowest one
+    pauses = []
+    def collected(phase, info):
+        pauses.append(time.perf_counter())
+    gc.callbacks.append(collected)
+    latencies = []
+    try:
+        for idx in seeks:
+            pauses.clear()
+            start = time.perf_counter()
+            provider.updateIndex(idx)
+            latencies.append((time.perf_counter() - start, sum(pauses[1::2]) - sum(pauses[0::2])))
+    finally:
+        gc.callbacks.remove(collected)
+    latencies.sort()
+    return [latency for latency, _ in latencies], latencies[-1][1]
+
+
+def report_seeks(name, latencies, collecting, target=None):
+    print("{:<10} seeks: mean {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms, {:.1f} ms of it in gc".format(
+        name, sum(latencies) / len(latencies) * 1e3, latencies[len(latencies) * 9 // 10] * 1e3,
+        latencies[len(latencies) * 99 // 100] * 1e3, latencies[-1] * 1e3, collecting * 1e3))
+    if target is not None:
+        over = sum(1 for latency in latencies if latency > target)
+        print("  {} of {} seeks took longer than the target of {:.0f} ms, the worst {:.1f}x as long".format(
+            over, len(latencies), target * 1e3, latencies[-1] / target))
+
+
+def bench_checkpoints(args):
+    import aaa
+    log = with_merges(synthetic_log(args.count), 50, 500)
+    seeks = navigation(500, len(log))
+    for policy in aaa.CHECKPOINT_POLICIES.keys():
+        provider = aaa.StoreProvider(ReplayApp(log, policy, args.cache_mb), aaa.Rect.zero())
+        start = time.perf_counter()
+        provider.updateIndex(len(log) - 1)
+        print("{:<10} initial replay {:.2f} s".format(policy, time.perf_counter() - start))
+        report_seeks(policy, *seek(provider, seeks), getattr(provider.checkpoints, "latency", None))
+        print("  cache: {}".format(provider.cache.stats()))
+
+
+def bench_cold(args):
+    import aaa
+    log = with_merges(synthetic_log(args.count), 50, 500)
+    seeks = navigation(500, len(log))
+    for cold in aaa.COLD_COMPRESSION.keys():
+        provider = aaa.StoreProvider(ReplayApp(log, "adaptive", args.cache_mb, cold), aaa.Rect.zero())
+        start = time.perf_counter()
+        provider.updateIndex(len(log) - 1)
+        initial = time.perf_counter() - start
+        perEntry = initial / len(log)
+
+        report_seeks(cold, *seek(provider, seeks))
+        print("  cache: {}".format(provider.cache.stats()))
+
+        cache = provider.cache
+        for kind, name in ((aaa.ColdStore, "full"), (aaa.DeltaStore, "delta")):
+            # deltas of the same base one after another, like evictions of
+            # neighbours, so mostly the base is inflated already
+            frozen = sorted((entry for entry, _, _ in cache.cache.values() if isinstance(entry, kind)),
+                            key=lambda entry: id(getattr(entry, "base", entry)))
+            if len(frozen) == 0:
+                continue
+            start = time.perf_counter()
+            for entry in frozen:
+                cache.thaw(entry)
+            inflate = (time.perf_counter() - start) / len(frozen)
+            print("  inflating a {} checkpoint takes {:.1f} ms, as long as replaying {:.0f} entries, "
+                  "{:.0f} KB compressed from {:.0f} KB".format(
+                      name, inflate * 1e3, inflate / perEntry,
+                      sum(entry.cost for entry in frozen) / len(frozen) / 2**10,
+                      sum(entry.size for entry in frozen) / len(frozen) / 2**10))
+
+
+def bench_sharded(args):
+    import aaa
+    log = with_merges(synthetic_log(args.count), 50, 500)
+    stores = []
+    for sharded in [False, True]:
+        provider = aaa.StoreProvider(ReplayApp(log, "adaptive", args.cache_mb, sharded=sharded), aaa.Rect.zero())
+        start = time.perf_counter()
+        provider.updateIndex(len(log) - 1)
+        report("sharded replay" if sharded else "serial replay", len(log), time.perf_counter() - start)
+        print("  cache: {}".format(provider.cache.stats()))
+        stores.append(provider.store)
+        if provider.sharded is not None:
+            provider.sharded.close()
+    print("  same store: {}".format(stores[0].store == stores[1].store and
+                                     stores[0].ttl.deadlines == stores[1].ttl.deadlines))
+
+
+def bench_reopen(args):
+    import aaa, diskcache
+    log = with_merges(synthetic_log(args.count), 50, 500)
+    key = diskcache.datasetKey(json.dumps(log).encode())
+    with tempfile.TemporaryDirectory() as directory:
+        for session in ["first", "second"]:
+            provider = aaa.StoreProvider(ReplayApp(log, "adaptive", args.cache_mb), aaa.Rect.zero())
+            provider.setDiskCache(diskcache.DiskCache(directory, key, 2**40))
+            start = time.perf_counter()
+            provider.updateIndex(len(log) - 1)
+            print("{:<6} session: last entry after {:.1f} ms, {}".format(
+                session, (time.perf_counter() - start) * 1e3, provider.disk.stats()))
+
+
+def bench_intern(args):
+    # Memory of the compiled log and of checkpoints every 1000 entries, with
+    # and without sharing equal values. Entries are parsed from their text
+    # while measuring, like the LogTable of the app does.
+    logs = example_logs() + [("synthetic", synthetic_log(args.count))]
+    for name, log in logs:
+        texts = [json.dumps(e["request"]) for e in log]
+        times = [e["now"] for e in log]
+        sizes = []
+        for interner in [None, hashcons.Interner()]:
+            tracemalloc.start()
+            programs = [agency.AgencyStore.compile(json.loads(text), interner) for text in texts]
+            compiled = tracemalloc.get_traced_memory()[0]
+            store = agency.AgencyStore()
+            checkpoints = []
+            for i, program in enumerate(programs):
+                store.run(program, times[i])
+                if i % 1000 == 999:
+                    checkpoints.append(store)
+                    store = agency.AgencyStore.copyFrom(store)
+            sizes.append((compiled, tracemalloc.get_traced_memory()[0]))
+            tracemalloc.stop()
+            del programs, store, checkpoints
+        (compiled, total), (internedCompiled, internedTotal) = sizes
+        print("{:40s} {:7d} entries  compiled log {:7.1f} -> {:7.1f} MB, with checkpoints {:7.1f} -> {:7.1f} MB "
+              "({:.0f}% saved)".format(name, len(log), compiled / 2**20, internedCompiled / 2**20, total / 2**20,
+                                       internedTotal / 2**20, 100 * (1 - internedTotal / total)))
+        print("  {}".format(interner.stats()))
+
+
+BENCHMARKS = {
+    "ttl": bench_ttl,
+    "replay": bench_replay,
+    "lookup": bench_lookup,
+    "checkpoints": bench_checkpoints,
+    "cold": bench_cold,
+    "sharded": bench_sharded,
+    "intern": bench_intern,
+    "reopen": bench_reopen,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay benchmarks for the agency store")
+    parser.add_argument("benchmark", choices=list(BENCHMARKS.keys()) + ["all"])
+    parser.add_argument("-n", "--count", help="number of synthetic log entries", type=int, default=100000)
+    parser.add_argument("--cache-mb", help="memory budget of the store cache", type=int, default=1024)
+    args = parser.parse_args()
+
+    if args.benchmark == "all":
+        for bench in BENCHMARKS.values():
+            bench(args)
+    else:
+        BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
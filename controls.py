@@ -535,7 +535,14 @@ class App:
         else:
             raise RuntimeError("Unknown action")
 
+    def idle(self):
+        # Called repeatedly while there are no events, as long as it returns
+        # True. A call should not take longer than a few milliseconds.
+        return False
+
     def handle_events(self):
+        while self.input_queue.empty() and self.idle():
+            pass
         item = self.input_queue.get()
         self.handleEvent(item)
 
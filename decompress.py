@@ -0,0 +1,118 @@
+import bz2
+import gzip
+import lzma
+import os
+import queue
+import threading
+
+
+# compressions of input files by the bytes they start with
+COMPRESSIONS = [
+    (b"\x1f\x8b", lambda f: gzip.GzipFile(fileobj=f, mode="rb")),
+    (b"\xfd7zXZ\x00", lambda f: lzma.LZMAFile(f)),
+    (b"BZh", lambda f: bz2.BZ2File(f)),
+]
+
+
+class InputFile:
+    # A binary file that is read only forward, like a log or a snapshot file.
+    # Files compressed with gzip, xz or bz2 are decompressed while they are
+    # read. Decompression runs on a thread of its own, up to AHEAD chunks
+    # ahead of the reader, so it overlaps with parsing. The codecs release
+    # the GIL while they decompress.
+    #
+    # consumed is called with the bytes as they are in the file, rawRead
+    # counts them, e.g. for progress and the disk cache digest.
+    CHUNK = 1 << 20
+    AHEAD = 8
+
+    def __init__(self, path, consumed=None):
+        self.f = open(path, "rb")
+        self.size = os.fstat(self.f.fileno()).st_size
+        self.consumed = consumed
+        self.rawRead = 0
+        magic = self.f.read(max(len(m) for m, _ in COMPRESSIONS))
+        self.f.seek(0)
+        self.compressed = False
+        for prefix, decoder in COMPRESSIONS:
+            if magic.startswith(prefix):
+                self.compressed = True
+                self.decoder = decoder(RawReader(self))
+                break
+        if self.compressed:
+            self.chunks = queue.Queue(InputFile.AHEAD)
+            self.rest = b""
+            self.eof = False
+            self.closed = False
+            threading.Thread(target=self.decompress, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def readRaw(self, size=-1):
+        data = self.f.read(size)
+        self.rawRead += len(data)
+        if self.consumed is not None:
+            self.consumed(data)
+        return data
+
+    def decompress(self):
+        try:
+            while not self.closed:
+                data = self.decoder.read(InputFile.CHUNK)
+                self.put(data)
+                if len(data) == 0:
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        # gives up once the reader is gone
+        while not self.closed:
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        if not self.compressed:
+            return self.readRaw(size)
+        parts = [self.rest]
+        length = len(self.rest)
+        while (size < 0 or length < size) and not self.eof:
+            data = self.chunks.get()
+            if isinstance(data, Exception):
+                self.eof = True
+                raise data
+            self.eof = len(data) == 0
+            parts.append(data)
+            length += len(data)
+        data = b"".join(parts)
+        if size < 0:
+            size = len(data)
+        self.rest = data[size:]
+        return data[:size]
+
+    def close(self):
+        if self.compressed:
+            self.closed = True
+        self.f.close()
+
+
+class RawReader:
+    # what a decoder reads the file through
+    def __init__(self, input):
+        self.input = input
+
+    def read(self, size=-1):
+        return self.input.readRaw(size)
+
+
+def isCompressed(path):
+    with open(path, "rb") as f:
+        magic = f.read(max(len(m) for m, _ in COMPRESSIONS))
+    return any(magic.startswith(prefix) for prefix, _ in COMPRESSIONS)
@@ -0,0 +1,191 @@
+import hashlib
+import marshal
+import os
+import struct
+from bisect import bisect_left, insort_left
+
+import agency
+
+
+def datasetKey(*parts):
+    # Name of the checkpoints of a log and snapshot, given their raw bytes.
+    digest = DatasetDigest()
+    for part in parts:
+        digest.part(len(part))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DatasetDigest:
+    # datasetKey of parts that are read in chunks, the size of each part has
+    # to be known before its first chunk
+
+    def __init__(self):
+        self.digest = hashlib.blake2b(digest_size=20)
+        self.digest.update("format {}".format(DiskCache.FORMAT).encode())
+
+    def part(self, size):
+        self.digest.update(size.to_bytes(8, "little"))
+
+    def update(self, data):
+        self.digest.update(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+def storeFromParts(tree, deadlines):
+    # A store of a serialized tree and ttl deadlines. It shares nothing with
+    # other stores.
+    ttl = agency.AgencyTtl()
+    ttl.deadlines = deadlines
+    ttl.compact()
+    return agency.AgencyStore(tree, ttl)
+
+
+class DiskCache:
+    # Checkpoints of earlier sessions, one directory per dataset below the
+    # cache directory and one file per checkpoint. Files are complete stores,
+    # they share nothing, so only a few of them are kept per log. All
+    # datasets together are limited by budget bytes, the least recently used
+    # files are dropped first. Files are a header of MAGIC, the format, the
+    # marshal version and the index, followed by the marshal dump of the
+    # tree and ttl deadlines, like ColdStore. They are validated when they
+    # are read.
+    FORMAT = 3
+    MAGIC = b"aaa-checkpoint\n"
+    HEADER = struct.Struct("<IIQ")
+    SUFFIX = ".ckpt"
+    # checkpoints per log, evenly spread
+    CHECKPOINTS = 64
+
+    def __init__(self, directory, key, budget):
+        self.directory = directory
+        self.path = os.path.join(directory, key)
+        self.budget = budget
+        os.makedirs(self.path, exist_ok=True)
+        self.indexes = sorted(int(name[:-len(DiskCache.SUFFIX)]) for name in os.listdir(self.path)
+                              if name.endswith(DiskCache.SUFFIX))
+        self.loads = 0
+        self.writes = 0
+        self.failures = 0
+        # bytes of all datasets, as of the last prune plus the files written
+        # since, other sessions prune their own writes
+        self.size = 0
+        self.prune()
+
+    def fileName(self, idx):
+        return os.path.join(self.path, "{}{}".format(idx, DiskCache.SUFFIX))
+
+    def closest(self, idx):
+        # the last checkpoint before idx, like StoreCache.closest
+        i = bisect_left(self.indexes, idx)
+        if i == 0:
+            return None
+        return self.indexes[i - 1]
+
+    def wants(self, idx, length):
+        # whether a checkpoint at idx is far enough from all others
+        spacing = max(1, length // DiskCache.CHECKPOINTS)
+        i = bisect_left(self.indexes, idx)
+        if i < len(self.indexes) and self.indexes[i] - idx < spacing:
+            return False
+        if i > 0 and idx - self.indexes[i - 1] < spacing:
+            return False
+        return True
+
+    def load(self, idx):
+        # the store at idx, None if the file is gone or broken
+        name = self.fileName(idx)
+        try:
+            with open(name, "rb") as f:
+                data = f.read()
+            header = DiskCache.HEADER.unpack_from(data, len(DiskCache.MAGIC)) \
+                if data.startswith(DiskCache.MAGIC) else None
+            if not header == (DiskCache.FORMAT, marshal.version, idx):
+                raise ValueError("Checkpoint {} is not in format {}".format(name, DiskCache.FORMAT))
+            tree, deadlines = marshal.loads(memoryview(data)[len(DiskCache.MAGIC) + DiskCache.HEADER.size:])
+            if not isinstance(tree, dict) or not isinstance(deadlines, dict):
+                raise ValueError("Checkpoint {} holds no tree".format(name))
+            for key, (deadline, path) in deadlines.items():
+                if not isinstance(key, str) or not isinstance(deadline, (int, float)) or \
+                        not isinstance(path, tuple) or not all(isinstance(x, str) for x in path):
+                    raise ValueError("Checkpoint {} has broken deadlines".format(name))
+            # the modification time is the last use
+            os.utime(name)
+        except Exception:
+            self.failures += 1
+            self.discard(idx)
+            return None
+        self.loads += 1
+        return storeFromParts(tree, deadlines)
+
+    def save(self, idx, store):
+        data = DiskCache.MAGIC + DiskCache.HEADER.pack(DiskCache.FORMAT, marshal.version, idx) + \
+            marshal.dumps((store.store, store.ttl.deadlines))
+        name = self.fileName(idx)
+        temp = "{}.{}.tmp".format(name, os.getpid())
+        try:
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, name)
+        except OSError:
+            # a full or read-only disk only costs the next session a replay
+            self.failures += 1
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            return
+        if not idx in self.indexes:
+            insort_left(self.indexes, idx)
+        self.writes += 1
+        self.size += len(data)
+        if self.size > self.budget:
+            self.prune()
+
+    def discard(self, idx):
+        try:
+            os.remove(self.fileName(idx))
+        except OSError:
+            pass
+        i = bisect_left(self.indexes, idx)
+        if i < len(self.indexes) and self.indexes[i] == idx:
+            del self.indexes[i]
+
+    def prune(self):
+        files = []
+        for dataset in os.scandir(self.directory):
+            if not dataset.is_dir():
+                continue
+            for entry in os.scandir(dataset.path):
+                if entry.name.endswith(DiskCache.SUFFIX):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        # removed by another session
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, dataset.path, entry.name))
+        total = sum(size for _, size, _, _ in files)
+        files.sort()
+        for _, size, path, name in files:
+            if total <= self.budget:
+                break
+            if path == self.path:
+                self.discard(int(name[:-len(DiskCache.SUFFIX)]))
+            else:
+                try:
+                    os.remove(os.path.join(path, name))
+                except OSError:
+                    pass
+                try:
+                    # fails as long as there are files left
+                    os.rmdir(path)
+                except OSError:
+                    pass
+            total -= size
+        self.size = total
+
+    def stats(self):
+        return "{} checkpoints, {:.1f} of {:.0f} MB on disk, {} loads, {} writes, {} failures".format(
+            len(self.indexes), self.size / 2**20, self.budget / 2**20, self.loads, self.writes, self.failures)
@@ -0,0 +1,172 @@
+import collections
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+# Protocol between the ui and an engine process that replays the log. Each
+# request is a tuple (operation, arguments...), each reply ("ok", value) or
+# ("error", text). Connections are authenticated with the key in this
+# environment variable.
+KEY_VARIABLE = "AAA_ENGINE_KEY"
+
+
+class EngineError(Exception):
+    pass
+
+
+def parseAddress(address):
+    # host:port is a tcp address, anything else the path of a unix socket
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return host or "localhost", int(port)
+    return address
+
+
+def authkey(generate=False):
+    # the key is never printed, a generated one is written to a file that
+    # only the owner can read
+    key = os.environ.get(KEY_VARIABLE)
+    if key is None:
+        if not generate:
+            raise EngineError("{} is not set".format(KEY_VARIABLE))
+        key = os.environ[KEY_VARIABLE] = secrets.token_hex(16)
+        print("Clients need {} set to the content of {}".format(KEY_VARIABLE, writeKey(key)))
+    return key.encode()
+
+
+def writeKey(key):
+    directory = tempfile.mkdtemp(prefix="aaa-engine-")
+    path = os.path.join(directory, "key")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(key)
+    return path
+
+
+def serve(address, handler, attached=False, closed=None, stop=None):
+    # Answers requests with handler(client, operation, *arguments) until the
+    # process is killed, one thread per connection. client is a token of the
+    # connection, closed(client) is called when it is gone. An attached
+    # engine exits when its stdin is closed, i.e. when the ui that started it
+    # is gone, after calling stop.
+    listener = Listener(parseAddress(address), authkey=authkey(generate=True))
+    if attached:
+        threading.Thread(target=waitForUi, args=(stop,), daemon=True).start()
+    print("Serving on {}".format(address))
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception as e:
+            # failed authentication
+            print("Refused connection: {}".format(e))
+            continue
+        threading.Thread(target=answer, args=(conn, handler, closed), daemon=True).start()
+
+
+def waitForUi(stop):
+    sys.stdin.read()
+    try:
+        if stop is not None:
+            stop()
+    finally:
+        os._exit(0)
+
+
+def answer(conn, handler, closed=None):
+    client = object()
+    try:
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ("ok", handler(client, *request))
+                except Exception as e:
+                    reply = ("error", str(e))
+                conn.send(reply)
+    finally:
+        if closed is not None:
+            closed(client)
+
+
+def spawn(script, argv):
+    # Starts `script argv --serve <socket> --attached` and returns (address,
+    # process). Its output goes to a file next to the socket, the key is
+    # passed to it only in the environment.
+    directory = tempfile.mkdtemp(prefix="aaa-engine-")
+    address = os.path.join(directory, "socket")
+    os.environ.setdefault(KEY_VARIABLE, secrets.token_hex(16))
+    with open(os.path.join(directory, "output"), "w") as output:
+        process = subprocess.Popen([sys.executable, script] + argv + ["--serve", address, "--attached"],
+                                   stdin=subprocess.PIPE, stdout=output, stderr=subprocess.STDOUT)
+    print("Started engine, its output is in {}".format(output.name))
+    return address, process
+
+
+class EngineClient:
+
+    def __init__(self, address, process=None, timeout=600):
+        # waits for the engine to listen, a process that was just started
+        # has to load the log first
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.conn = Client(parseAddress(address), authkey=authkey())
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if process is not None and process.poll() is not None:
+                    raise EngineError("Engine exited with status {}".format(process.returncode))
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+        self.process = process
+        self.lock = threading.Lock()
+
+    def call(self, *request):
+        with self.lock:
+            self.conn.send(request)
+            status, value = self.conn.recv()
+        if status == "error":
+            raise EngineError(value)
+        return value
+
+
+class RemoteLines:
+    # The lines of a value rendered by the engine, or the rows of its log,
+    # fetched in pages when they are displayed. fetch(first, count) returns
+    # (total, lines).
+    PAGE = 200
+    PAGES = 16
+
+    def __init__(self, fetch, search):
+        self.fetch = fetch
+        self.search = search
+        self.pages = collections.OrderedDict()
+        self.total, lines = fetch(0, RemoteLines.PAGE)
+        self.pages[0] = lines
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.total
+        if not 0 <= i < self.total:
+            raise IndexError(i)
+        page = i // RemoteLines.PAGE
+        lines = self.pages.get(page)
+        if lines is None:
+            _, lines = self.fetch(page * RemoteLines.PAGE, RemoteLines.PAGE)
+            self.pages[page] = lines
+            if len(self.pages) > RemoteLines.PAGES:
+                self.pages.popitem(last=False)
+        else:
+            self.pages.move_to_end(page)
+        return lines[i - page * RemoteLines.PAGE]
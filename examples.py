@@ -0,0 +1,12 @@
+import json
+import os
+
+# the example logs the tests run on
+EXAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "example")
+
+
+def example(name):
+    # the log entries of an example file, of an agency-dump as well
+    with open(os.path.join(EXAMPLE, name)) as f:
+        log = json.load(f)
+    return log["log"] if isinstance(log, dict) else log
@@ -0,0 +1,87 @@
+import math
+
+
+class Interner:
+    # Hash-consing of JSON values. Equal strings, numbers, path tuples and
+    # small objects and arrays are replaced by one shared instance, so
+    # values that repeat across the log are only kept once, in the compiled
+    # log as well as in every store they are written to. Shared values are
+    # never modified in place, stores copy nodes they do not own before
+    # writing to them (see AgencyStore._own).
+    #
+    # Containers are shared if all their values are and they have at most
+    # MAX_ITEMS of them, larger ones are rarely repeated and their keys
+    # would cost more than they save.
+    MAX_ITEMS = 16
+
+    def __init__(self):
+        self.strings = dict()
+        self.paths = dict()
+        # by (type, value) for numbers, plus the sign for floats, (type,
+        # keys and ids of the shared values) for containers
+        self.values = dict()
+        # number of values replaced by a shared one
+        self.hits = 0
+
+    def string(self, s):
+        shared = self.strings.setdefault(s, s)
+        if shared is not s:
+            self.hits += 1
+        return shared
+
+    def path(self, path):
+        # a tuple of strings, e.g. a parsed path
+        shared = self.paths.get(path)
+        if shared is None:
+            shared = self.paths[path] = tuple(self.string(x) for x in path)
+        elif shared is not path:
+            self.hits += 1
+        return shared
+
+    def value(self, value):
+        return self._value(value)[0]
+
+    def _value(self, value):
+        # (value, shared), a value that is not shared is new or the original
+        if isinstance(value, str):
+            return self.string(value), True
+        if value is None or isinstance(value, bool):
+            return value, True
+        if isinstance(value, float):
+            # 0.0 == -0.0, the sign tells them apart
+            return self._shared((float, value, math.copysign(1, value)), value)
+        if isinstance(value, int):
+            return self._shared((int, value), value)
+        if isinstance(value, dict):
+            result = dict()
+            shared = len(value) <= Interner.MAX_ITEMS
+            for k, v in value.items():
+                v, s = self._value(v)
+                result[self.string(k)] = v
+                shared = shared and s
+            if not shared:
+                return result, False
+            key = (dict,) + tuple(x for k, v in result.items() for x in (k, id(v)))
+            return self._shared(key, result)
+        if isinstance(value, list):
+            result = []
+            shared = len(value) <= Interner.MAX_ITEMS
+            for v in value:
+                v, s = self._value(v)
+                result.append(v)
+                shared = shared and s
+            if not shared:
+                return result, False
+            key = (list,) + tuple(id(v) for v in result)
+            return self._shared(key, result)
+        return value, False
+
+    def _shared(self, key, value):
+        shared = self.values.setdefault(key, value)
+        if shared is not value:
+            self.hits += 1
+        return shared, True
+
+    def stats(self):
+        return "{} strings, {} paths, {} values shared, {} duplicates replaced".format(
+            len(self.strings), len(self.paths), len(self.values), self.hits)
@@ -0,0 +1,139 @@
+import codecs
+import json
+
+
+class LogStream:
+    # Reads the entries of a log file one by one while the file is read in
+    # chunks, so the first entries are there long before the whole file is
+    # parsed. Understands the shapes ArangoAgencyLogFileProvider reads: a
+    # list of entries, a query result {"result": [...]} and an agency-dump
+    # {"log": [...], "compaction": ..., ...}.
+    #
+    # Entries and all other values are decoded with
+    # json.JSONDecoder.raw_decode. A value that does not fit into the buffer
+    # is decoded again once more of the file is read, the buffer grows by at
+    # least its own size each time, so large values are not decoded over and
+    # over again.
+    #
+    # The byte offsets of the last value decoded are kept in span, those of
+    # the other attributes in fieldSpans, e.g. for MappedLogTable. Its text
+    # is kept in raw, encoded like in the file, e.g. for LogTable.
+    CHUNK = 1 << 20
+    # characters at the end of the buffer, see _truncated
+    TRUNCATED = 16
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, f, consumed=None):
+        # f is a binary file, consumed is called with every chunk read
+        self.f = f
+        self.consumed = consumed
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder("utf-8-sig")()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.bytesRead = 0
+        # the first bytes of the file, until it is known whether they are a
+        # BOM
+        self.head = b""
+        # the byte offset of buffer[pos] in the file
+        self.bytePos = 0
+        self.span = None
+        self.raw = None
+        # whether the file is an object, and its attribute holding the log
+        self.object = False
+        self.logAttribute = None
+        # the other attributes of an object, complete after entries
+        self.fields = dict()
+        self.fieldSpans = dict()
+
+    def _read(self, size):
+        data = self.f.read(size)
+        if self.bytesRead < len(codecs.BOM_UTF8):
+            # the decoder drops a BOM, which may take more than one read
+            self.head += data[:len(codecs.BOM_UTF8)]
+            if self.head[:len(codecs.BOM_UTF8)] == codecs.BOM_UTF8:
+                self.bytePos = len(codecs.BOM_UTF8)
+        if self.consumed is not None:
+            self.consumed(data)
+        self.bytesRead += len(data)
+        self.eof = len(data) == 0
+        self.buffer = self.buffer[self.pos:] + self.utf8.decode(data, final=self.eof)
+        self.pos = 0
+
+    def _peek(self):
+        # the next character that is no whitespace, "" at the end of the file
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in LogStream.WHITESPACE:
+                self.pos += 1
+                self.bytePos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self._read(LogStream.CHUNK)
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c == "" or c not in chars:
+            raise json.JSONDecodeError("Expecting one of `{}`".format(chars), self.buffer, self.pos)
+        self.pos += 1
+        self.bytePos += 1
+        return c
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of the buffer may go on in the file
+                if end < len(self.buffer) or self.eof:
+                    start = self.bytePos
+                    self.raw = self.buffer[self.pos:end].encode()
+                    self.bytePos += len(self.raw)
+                    self.pos = end
+                    self.span = (start, self.bytePos)
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof or not self._truncated(e):
+                    offset = self.bytePos + len(self.buffer[self.pos:e.pos].encode())
+                    raise json.JSONDecodeError("{} at byte {} of the file".format(e.msg, offset), e.doc, e.pos)
+            self._read(max(LogStream.CHUNK, len(self.buffer) - self.pos))
+
+    def _truncated(self, e):
+        # Whether decoding may only have failed because the buffer ends
+        # within the value. A literal, number or escape that is cut off fails
+        # within its last few characters, a string at its start. Anything
+        # else is broken, it is not read on to the end of the file.
+        return e.msg.startswith("Unterminated string") or len(self.buffer) - e.pos <= LogStream.TRUNCATED
+
+    def _list(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._expect("]")
+            return
+        while True:
+            yield self._value()
+            if self._expect(",]") == "]":
+                return
+
+    def entries(self):
+        # yields the entries of the log, fields and logAttribute are set
+        # once it is exhausted
+        if self._peek() == "[":
+            yield from self._list()
+            return
+        self._expect("{")
+        self.object = True
+        if self._peek() == "}":
+            self._expect("}")
+            return
+        while True:
+            key = self._value()
+            self._expect(":")
+            if self.logAttribute is None and key in ("result", "log") and self._peek() == "[":
+                self.logAttribute = key
+                yield from self._list()
+            else:
+                self.fields[key] = self._value()
+                self.fieldSpans[key] = self.span
+            if self._expect(",}") == "}":
+                return
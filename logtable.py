@@ -0,0 +1,598 @@
+import array
+import hashlib
+import json
+import mmap
+import operator
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+
+import agency
+import hashcons
+import logstream
+
+# the key of the first entry of an agency, there is nothing before it
+ARANGO_LOG_ZERO = "00000000000000000000"
+
+
+class InternedColumn:
+    # a column with few distinct values, each of them is stored once
+
+    def __init__(self):
+        self.ids = array.array('I')
+        self.values = []
+        self.index = dict()
+
+    def append(self, value):
+        id = self.index.get(value)
+        if id is None:
+            id = self.index[value] = len(self.values)
+            self.values.append(value)
+        self.ids.append(id)
+
+    def load(self, values):
+        # takes over the values of a stored column, ids are set separately
+        self.values = list(values)
+        self.index = {value: id for id, value in enumerate(self.values)}
+
+    def __getitem__(self, i):
+        return self.values[self.ids[i]]
+
+
+class LogTable(Sequence):
+    # The log as columns instead of a list of dicts. Keys and terms are
+    # integer arrays, times (see AgencyStore.logTimes) a float array, client
+    # ids and the paths of the requests are interned. Entries are kept as
+    # their JSON text in one buffer and parsed when they are accessed, the
+    # last PARSED of them stay parsed.
+    #
+    # Entries read from a log file are kept as they are written there, see
+    # extend. Others are dumped without the fields that follow from the key
+    # column, raw adds them again.
+    #
+    # Client ids and request paths go through interner, which the app also
+    # compiles the log with, see hashcons.Interner.
+    #
+    # Indexing returns the entry as dict, like the list of a provider. Code
+    # that only needs a field uses the accessors, which do not parse.
+    PARSED = 4096
+    KEY_FORMAT = "{:020d}"
+    # what is dropped from the text of an entry, by index
+    KEPT, NO_KEY, NO_ID = range(3)
+    ID_PREFIX = "log/"
+
+    def __init__(self, entries=(), texts=None):
+        self.keys = array.array('Q')
+        self.terms = array.array('q')
+        # keys and terms that do not fit into the arrays, by index
+        self.oddKeys = dict()
+        self.oddTerms = dict()
+        self.times = array.array('d')
+        self.clientIds = InternedColumn()
+        self.paths = InternedColumn()
+        self.interner = hashcons.Interner()
+        self.data = bytearray()
+        self.offsets = array.array('Q', [0])
+        self.dropped = bytearray()
+        self.parsed = OrderedDict()
+        self.lock = threading.Lock()
+        self.extend(entries, texts)
+
+    def extend(self, entries, texts=None):
+        # texts are the encoded entries as they are written in a log file,
+        # see LogStream.raw, they are kept as they are. Without them entries
+        # are dumped without their _key, and without an _id of the key.
+        entries = list(entries)
+        if texts is not None:
+            for text in texts:
+                self.data += text
+                self.offsets.append(len(self.data))
+            self.dropped += bytes(len(entries))
+        else:
+            for entry in entries:
+                rest = dict(entry)
+                key = rest.pop("_key")
+                dropped = LogTable.NO_KEY
+                if rest.get("_id") == LogTable.ID_PREFIX + key:
+                    del rest["_id"]
+                    dropped = LogTable.NO_ID
+                self.data += json.dumps(rest).encode()
+                self.offsets.append(len(self.data))
+                self.dropped.append(dropped)
+        self._addColumns(entries)
+
+    def _addColumns(self, entries):
+        # len counts the keys, so they are added last, an entry is complete
+        # once it is counted
+        self.times.extend(agency.AgencyStore.logTimes(entries))
+        for entry in entries:
+            i = len(self.keys)
+            term = entry.get("term")
+            if isinstance(term, int) and -2**63 <= term < 2**63:
+                self.terms.append(term)
+            else:
+                self.terms.append(0)
+                self.oddTerms[i] = term
+            self.clientIds.append(self.interner.value(entry.get("clientId")))
+            self.paths.append(self.interner.path(tuple(entry["request"])))
+            key = entry["_key"]
+            if key.isdigit() and len(key) == 20 and int(key) < 2**64:
+                self.keys.append(int(key))
+            else:
+                self.oddKeys[i] = key
+                self.keys.append(0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        with self.lock:
+            entry = self.parsed.get(i)
+            if entry is not None:
+                self.parsed.move_to_end(i)
+                return entry
+        entry = json.loads(self.raw(i))
+        with self.lock:
+            self.parsed[i] = entry
+            if len(self.parsed) > LogTable.PARSED:
+                self.parsed.popitem(last=False)
+        return entry
+
+    def key(self, i):
+        if i in self.oddKeys:
+            return self.oddKeys[i]
+        return LogTable.KEY_FORMAT.format(self.keys[i])
+
+    def term(self, i):
+        if i in self.oddTerms:
+            return self.oddTerms[i]
+        return self.terms[i]
+
+    def time(self, i):
+        return self.times[i]
+
+    def clientId(self, i):
+        return self.clientIds[i]
+
+    def requestPaths(self, i):
+        # the paths of the request of entry i, in the order of the request
+        return self.paths[i]
+
+    def raw(self, i):
+        # the encoded text of entry i, dumped entries are the same as
+        # json.dumps of them as long as _key and _id came first
+        data = self.data[self.offsets[i]:self.offsets[i + 1]]
+        dropped = self.dropped[i]
+        if dropped == LogTable.KEPT:
+            return data
+        key = self.key(i)
+        head = {"_key": key, "_id": LogTable.ID_PREFIX + key} if dropped == LogTable.NO_ID else {"_key": key}
+        head = json.dumps(head).encode()
+        return head if data == b"{}" else head[:-1] + b", " + data[1:]
+
+    def text(self, i):
+        return self.raw(i).decode()
+
+    def lastAtOrBefore(self, key):
+        # the last entry with a key up to key, None if there is none, the
+        # log is sorted by key
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1 if lo > 0 else None
+
+    def sortedByKey(self):
+        # a copy of the log sorted by key, entries are not parsed
+        order = sorted(range(len(self)), key=self.key)
+        log = LogTable()
+        log.interner = self.interner
+        for i in order:
+            log.data += self.data[self.offsets[i]:self.offsets[i + 1]]
+            log.offsets.append(len(log.data))
+        log.dropped = bytearray(self.dropped[i] for i in order)
+        log._takeColumns(self, order)
+        return log
+
+    def _takeColumns(self, log, order):
+        # the columns of log, entry i is entry order[i] of log
+        position = {old: new for new, old in enumerate(order)}
+        self.keys, self.terms, self.times, self.clientIds.ids, self.paths.ids = [
+            array.array(column.typecode, (column[i] for i in order))
+            for column in [log.keys, log.terms, log.times, log.clientIds.ids, log.paths.ids]]
+        self.clientIds.load(self.interner.value(value) for value in log.clientIds.values)
+        self.paths.load(self.interner.path(path) for path in log.paths.values)
+        self.oddKeys = {position[i]: key for i, key in log.oddKeys.items()}
+        self.oddTerms = {position[i]: term for i, term in log.oddTerms.items()}
+
+    def dump(self, f):
+        # writes the log like json.dump of the list of entries
+        f.write("[")
+        for i in range(len(self)):
+            if i > 0:
+                f.write(", ")
+            f.write(self.text(i))
+        f.write("]")
+
+    def close(self):
+        # releases the file of the log, if there is one
+        pass
+
+
+def packColumns(fields, columns):
+    # json fields and arrays after them, read back by unpackColumns
+    header = json.dumps(dict(fields, columns=[[column.typecode, len(column)] for column in columns])).encode()
+    return b"".join([len(header).to_bytes(8, "little"), header] + [column.tobytes() for column in columns])
+
+
+def unpackColumns(data, typecodes):
+    # the fields and columns of packColumns, raises ValueError if data is cut
+    # off or its columns are not of the given types
+    size = int.from_bytes(data[:8], "little")
+    if len(data) < 8 + size:
+        raise ValueError("Header is cut off")
+    fields = json.loads(bytes(data[8:8 + size]))
+    layout = fields.pop("columns")
+    if not [typecode for typecode, _ in layout] == list(typecodes):
+        raise ValueError("Columns are not of types {}".format(typecodes))
+    pos = 8 + size
+    columns = []
+    for typecode, length in layout:
+        column = array.array(typecode)
+        end = pos + length * column.itemsize
+        if not isinstance(length, int) or length < 0 or end > len(data):
+            raise ValueError("Column is cut off")
+        column.frombytes(data[pos:end])
+        columns.append(column)
+        pos = end
+    return fields, columns
+
+
+# starts, ends, keys, terms, times, client ids and paths, see packTable
+TABLE_COLUMNS = "QQQqdII"
+
+
+def packTable(log, starts, ends, fields):
+    # the columns of a LogTable with the spans of its entries in a file and
+    # further json fields, read back by unpackTable
+    fields = dict(fields, oddKeys=list(log.oddKeys.items()), oddTerms=list(log.oddTerms.items()),
+                  clientIds=log.clientIds.values, paths=log.paths.values)
+    return packColumns(fields, [starts, ends, log.keys, log.terms, log.times, log.clientIds.ids, log.paths.ids])
+
+
+def unpackTable(log, fields, columns, size):
+    # Sets the columns and spans of packTable, as returned by unpackColumns,
+    # on log. Raises ValueError unless the columns fit together and all
+    # spans lie within the first size bytes of the file.
+    starts, ends, keys, terms, times, clientIdIds, pathIds = columns
+    count = len(keys)
+    oddKeys = {i: key for i, key in fields.pop("oddKeys")}
+    oddTerms = {i: term for i, term in fields.pop("oddTerms")}
+    clientIds = fields.pop("clientIds")
+    paths = [tuple(path) for path in fields.pop("paths")]
+    if not all(len(column) == count for column in columns):
+        raise ValueError("Columns differ in length")
+    if not all(isinstance(i, int) and 0 <= i < count for i in list(oddKeys) + list(oddTerms)):
+        raise ValueError("Odd keys or terms out of range")
+    if not all(isinstance(key, str) for key in oddKeys.values()):
+        raise ValueError("Odd keys are no strings")
+    if count > 0 and (max(clientIdIds) >= len(clientIds) or max(pathIds) >= len(paths)):
+        raise ValueError("Interned ids out of range")
+    if count > 0 and (not all(map(operator.le, starts, ends)) or max(ends) > size):
+        raise ValueError("Entries beyond the end of the file")
+    log.starts, log.ends, log.keys, log.terms, log.times, log.clientIds.ids, log.paths.ids = columns
+    log.oddKeys = oddKeys
+    log.oddTerms = oddTerms
+    log.clientIds.load(log.interner.value(clientId) for clientId in clientIds)
+    log.paths.load(log.interner.path(path) for path in paths)
+
+
+class MappedLogTable(LogTable):
+    # A LogTable over a log file that is mapped into memory, for files that
+    # are too large to be loaded. Entries are not copied, they are kept as
+    # byte spans of the file, text returns them as they are written there.
+    #
+    # The spans and the columns come from one scan over the file, in which
+    # each entry is parsed once and dropped again. Given an index directory,
+    # they are stored there as index of the file, so the next session, or
+    # another one at the same time, only reads the index. The index is valid
+    # as long as size and modification time of the file are the same.
+    #
+    # For an object the other attributes are kept as spans as well, see
+    # field.
+    INDEX_SUFFIX = ".aaaidx"
+    INDEX_FORMAT = 2
+    # entries parsed before their columns are added
+    SCAN_BATCH = 10000
+
+    def __init__(self, path, indexDirectory=None):
+        super().__init__()
+        self.path = path
+        self.indexDirectory = indexDirectory
+        self.file = open(path, "rb")
+        stat = os.fstat(self.file.fileno())
+        if stat.st_size == 0:
+            self.file.close()
+            raise ValueError("Log file `{}` is empty".format(path))
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.version = [stat.st_size, stat.st_mtime_ns]
+        self.starts = array.array('Q')
+        self.ends = array.array('Q')
+        # shape of the file, see LogStream
+        self.object = False
+        self.logAttribute = None
+        self.fieldSpans = dict()
+        try:
+            # whether the index was read instead of scanning the file
+            self.indexed = self.loadIndex()
+            if not self.indexed:
+                self.scan()
+                self.saveIndex()
+        except:
+            self.close()
+            raise
+
+    def extend(self, entries, texts=None):
+        if len(list(entries)) > 0:
+            raise TypeError("Entries can not be added to a mapped log")
+
+    def raw(self, i):
+        return self.map[self.starts[i]:self.ends[i]]
+
+    def field(self, name, default=None):
+        # an attribute of the object in the file besides the log
+        if not name in self.fieldSpans:
+            return default
+        start, end = self.fieldSpans[name]
+        return json.loads(self.map[start:end])
+
+    def scan(self):
+        with open(self.path, "rb") as f:
+            stream = logstream.LogStream(f)
+            batch = []
+            for entry in stream.entries():
+                self.starts.append(stream.span[0])
+                self.ends.append(stream.span[1])
+                batch.append(entry)
+                if len(batch) >= MappedLogTable.SCAN_BATCH:
+                    self._addColumns(batch)
+                    batch = []
+            self._addColumns(batch)
+        self.object = stream.object
+        self.logAttribute = stream.logAttribute
+        self.fieldSpans = stream.fieldSpans
+        self.sortByKey()
+
+    def sortByKey(self):
+        if all(self.key(i) <= self.key(i + 1) for i in range(len(self) - 1)):
+            return
+        order = sorted(range(len(self)), key=self.key)
+        for column in [self.starts, self.ends]:
+            column[:] = array.array(column.typecode, (column[i] for i in order))
+        self._takeColumns(self, order)
+
+    def indexPath(self):
+        # None without an index directory, files are told apart by their path
+        if self.indexDirectory is None:
+            return None
+        name = hashlib.blake2b(os.path.abspath(self.path).encode(), digest_size=20).hexdigest()
+        return os.path.join(self.indexDirectory, name + MappedLogTable.INDEX_SUFFIX)
+
+    def loadIndex(self):
+        # False if there is no index of this version of the file
+        name = self.indexPath()
+        if name is None:
+            return False
+        try:
+            with open(name, "rb") as f:
+                data = f.read()
+            fields, columns = unpackColumns(data, TABLE_COLUMNS)
+            if not fields["format"] == MappedLogTable.INDEX_FORMAT or not fields["version"] == self.version:
+                return False
+            fieldSpans = {name: tuple(span) for name, span in fields["fieldSpans"].items()}
+            if not all(0 <= start <= end <= len(self.map) for start, end in fieldSpans.values()):
+                return False
+            unpackTable(self, fields, columns, len(self.map))
+        except Exception:
+            return False
+        self.object = bool(fields["object"])
+        self.logAttribute = fields["logAttribute"]
+        self.fieldSpans = fieldSpans
+        return True
+
+    def saveIndex(self):
+        name = self.indexPath()
+        if name is None:
+            return
+        data = packTable(self, self.starts, self.ends,
+                         dict(format=MappedLogTable.INDEX_FORMAT, version=self.version, object=self.object,
+                              logAttribute=self.logAttribute, fieldSpans=self.fieldSpans))
+        temp = "{}.{}.tmp".format(name, os.getpid())
+        try:
+            os.makedirs(self.indexDirectory, exist_ok=True)
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, name)
+        except OSError:
+            # a read-only directory only costs the next session a scan
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def digestInto(self, digest):
+        digestMap(self.map, digest)
+
+
+def digestMap(map, digest):
+    # adds a mapped file to a diskcache.DatasetDigest, like datasetKey does
+    digest.part(len(map))
+    for offset in range(0, len(map), logstream.LogStream.CHUNK):
+        digest.update(map[offset:offset + logstream.LogStream.CHUNK])
+
+
+# Container of a log with its compactions and the agency state of a dump,
+# written by writeContainer and read by ContainerLogTable. After MAGIC and
+# the offset of the header, entries follow as their length and their text
+# (see LogTable.raw), then the compactions and the agency state as their
+# json text. The header at the end is written by packTable and holds the
+# columns of a LogTable, the spans of the entries, and the keys of the
+# compactions and the index of the agency state with the spans of their
+# texts.
+CONTAINER_MAGIC = b"\x00aaa-log\n"
+CONTAINER_FORMAT = 4
+
+
+def isContainer(path):
+    with open(path, "rb") as f:
+        return f.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
+
+
+def writeContainer(path, log, snapshots, agencyState):
+    # log is a LogTable of any kind, the file is replaced at once when it is
+    # complete
+    starts = array.array('Q')
+    ends = array.array('Q')
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp, "wb") as f:
+            f.write(CONTAINER_MAGIC)
+            f.write(bytes(8))
+            pos = f.tell()
+            for i in range(len(log)):
+                data = log.raw(i)
+                f.write(len(data).to_bytes(4, "little"))
+                f.write(data)
+                starts.append(pos + 4)
+                pos += 4 + len(data)
+                ends.append(pos)
+            spans = []
+            for value in [dict(snapshot) for snapshot in snapshots] + \
+                    ([agencyState[1]] if agencyState is not None else []):
+                data = json.dumps(value).encode()
+                f.write(data)
+                spans.append([pos, pos + len(data)])
+                pos += len(data)
+            state = [agencyState[0]] + spans.pop() if agencyState is not None else None
+            f.write(packTable(log, starts, ends, dict(
+                format=CONTAINER_FORMAT, agencyState=state,
+                snapshots=[[snapshot["_key"]] + span for snapshot, span in zip(snapshots, spans)])))
+            f.seek(len(CONTAINER_MAGIC))
+            f.write(pos.to_bytes(8, "little"))
+        os.replace(temp, path)
+    except:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+
+class ContainerValue(Mapping):
+    # A compaction or agency state in a log container, parsed from its text
+    # when more than the key of a compaction is read, e.g. when a replay
+    # starts from it.
+
+    def __init__(self, container, span, key=None):
+        self.container = container
+        self.span = span
+        self.key = key
+        self.value = None
+
+    def load(self):
+        if self.value is None:
+            self.value = self.container.load(self.span)
+        return self.value
+
+    def __getitem__(self, name):
+        if name == "_key" and self.key is not None:
+            return self.key
+        return self.load()[name]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+class ContainerLogTable(LogTable):
+    # A LogTable over a container written by writeContainer, mapped into
+    # memory. Opening it only reads the header, entries are parsed when
+    # they are accessed, compactions and the agency state are loaded when
+    # they are first needed.
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = None
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.readHeader()
+        except:
+            self.close()
+            raise
+
+    def readHeader(self):
+        if not self.map[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC:
+            raise ValueError("`{}` is no log container".format(self.path))
+        header = int.from_bytes(self.map[len(CONTAINER_MAGIC):len(CONTAINER_MAGIC) + 8], "little")
+        try:
+            if not len(CONTAINER_MAGIC) + 8 <= header <= len(self.map):
+                raise ValueError("Header beyond the end of the file")
+            fields, columns = unpackColumns(self.map[header:], TABLE_COLUMNS)
+            if not fields["format"] == CONTAINER_FORMAT:
+                raise ValueError("Log container `{}` is not in format {}".format(self.path, CONTAINER_FORMAT))
+            # entries, compactions and the agency state end before the header
+            unpackTable(self, fields, columns, header)
+            snapshots = [(key, (start, end)) for key, start, end in fields["snapshots"]]
+            state = fields["agencyState"]
+            index, start, end = state if state is not None else (0, 0, 0)
+            if not all(isinstance(key, str) and 0 <= start <= end <= header for key, (start, end) in snapshots) or \
+                    not (isinstance(index, int) and 0 <= start <= end <= header):
+                raise ValueError("Compactions or agency state are broken")
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValueError("Log container `{}` is broken: {}".format(self.path, e))
+        self.snapshots = [ContainerValue(self, span, key) for key, span in snapshots]
+        self.state = (index, ContainerValue(self, (start, end))) if state is not None else None
+
+    def agencyState(self):
+        # (index, state) like ArangoAgencyLogFileProvider.agencyState, the
+        # state is loaded by this call
+        return (self.state[0], self.state[1].load()) if self.state is not None else None
+
+    def load(self, span):
+        try:
+            return json.loads(self.map[span[0]:span[1]])
+        except ValueError as e:
+            raise ValueError("Log container `{}` is broken: {}".format(self.path, e))
+
+    def extend(self, entries, texts=None):
+        if len(list(entries)) > 0:
+            raise TypeError("Entries can not be added to a log container")
+
+    def raw(self, i):
+        return self.map[self.starts[i]:self.ends[i]]
+
+    def digestInto(self, digest):
+        digestMap(self.map, digest)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
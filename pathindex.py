@@ -0,0 +1,230 @@
+import array
+import os
+from bisect import bisect_left, bisect_right
+
+import agency
+import logtable
+
+
+def listDepth(store, path):
+    # depth of the first list on the way to path, None if there is none
+    node = store
+    for depth, x in enumerate(path):
+        if isinstance(node, list):
+            return depth
+        if not isinstance(node, dict) or not x in node:
+            return None
+        node = node[x]
+    return None
+
+
+def prefixes(path):
+    # all prefixes of a path in the form of AgencyStore.pathPrefix,
+    # starting with the root "" and ending with path itself
+    result = [""]
+    start = 0
+    while True:
+        end = path.find("/", start)
+        if end == -1:
+            return result
+        result.append(path[:end + 1])
+        start = end + 1
+
+
+def logKey(log, i):
+    # the key of entry i, a LogTable has it without parsing the entry
+    key = getattr(log, "key", None)
+    return key(i) if key is not None else log[i]["_key"]
+
+
+class PathIndex:
+    # Maps agency paths to the sorted indexes of the log entries touching
+    # them. Entries have to be added in order.
+
+    def __init__(self):
+        # entries with an operation on the path or below it
+        self.below = dict()
+        # entries with an operation on exactly that path
+        self.exact = dict()
+        self.count = 0
+
+    def _append(self, index, key, idx):
+        indexes = index.get(key)
+        if indexes is None:
+            indexes = index[key] = array.array('I')
+        elif indexes[-1] == idx:
+            return
+        indexes.append(idx)
+
+    def add(self, idx, paths):
+        # paths are the operation paths of entry idx, see AgencyStore.pathPrefix
+        assert idx == self.count
+        for path in paths:
+            self._append(self.exact, path, idx)
+            for prefix in prefixes(path):
+                self._append(self.below, prefix, idx)
+        self.count += 1
+
+    def _lists(self, path):
+        # An entry can change the value at path, if it has an operation on
+        # path, below it or on one of its parents.
+        lists = [self.exact.get(prefix) for prefix in prefixes(path)[:-1]]
+        lists.append(self.below.get(path))
+        return [x for x in lists if x is not None]
+
+    def changes(self, path, start=0):
+        # entries from start on that can change the value at path
+        result = set()
+        for indexes in self._lists(path):
+            result.update(indexes[bisect_left(indexes, start):])
+        return sorted(result)
+
+    def next(self, path, idx):
+        # first entry after idx that can change path, None if there is none
+        candidates = []
+        for indexes in self._lists(path):
+            i = bisect_right(indexes, idx)
+            if i < len(indexes):
+                candidates.append(indexes[i])
+        return min(candidates, default=None)
+
+    def prev(self, path, idx):
+        # last entry before idx that can change path, None if there is none
+        candidates = []
+        for indexes in self._lists(path):
+            i = bisect_left(indexes, idx)
+            if i > 0:
+                candidates.append(indexes[i - 1])
+        return max(candidates, default=None)
+
+
+class PathLookup:
+    # Answers what the value at a path was after a given log entry without
+    # replaying the whole agency. Starting at the closest full store, only
+    # entries that can change the path are applied to a store pruned to it.
+    # paths with remembered states and the number of applied entries
+    # between two of them
+    MEMO_SIZE = 1024
+    MEMO_DISTANCE = 64
+
+    def __init__(self, log, index=None, program=None, paths=None, times=None, seeds=None):
+        # program(i) returns the compiled request of entry i, paths(i) the
+        # paths of its operations, see AgencyStore.pathPrefix, and index is
+        # a PathIndex over the log. All of them are built from the log if
+        # missing. seeds(idx) returns the closest full store to replay idx
+        # from as (index of the first entry to apply, store), or None if idx
+        # can not be replayed, like StoreProvider.closestSeed. Without it,
+        # the log has to start with the first entry of the agency.
+        if program is None:
+            programs = [agency.AgencyStore.compile(e["request"]) for e in log]
+            program = programs.__getitem__
+        if paths is None:
+            pathLists = [tuple(agency.AgencyStore.pathPrefix(record[2]) for record in program(i))
+                         for i in range(len(log))]
+            paths = pathLists.__getitem__
+        if index is None:
+            index = PathIndex()
+            for i in range(len(log)):
+                index.add(i, paths(i))
+        self.log = log
+        self.index = index
+        self.program = program
+        self.paths = paths
+        self.times = agency.AgencyStore.logTimes(log) if times is None else times
+        self.seeds = seeds
+        # states of a path seen by earlier lookups, as sorted list of
+        # indexes and the pruned stores after those entries
+        self.memo = dict()
+
+    def seed(self, idx):
+        # the closest full store to replay entry idx from as (index, store),
+        # index is the last entry contained in the store
+        if self.seeds is not None:
+            seed = self.seeds(idx)
+        elif logKey(self.log, 0) == logtable.ARANGO_LOG_ZERO:
+            seed = (0, agency.AgencyStore())
+        else:
+            seed = None
+        if seed is None:
+            raise ValueError("Can not replicate agency state. Not covered by snapshot.")
+        return seed[0] - 1, seed[1]
+
+    def related(self, key, depth, paths):
+        # Which operations can change the value at key. Those on a parent,
+        # on key or below it, and with a list on the way to key, all of
+        # those sharing the path down to that list.
+        result = []
+        for path in paths:
+            if path.startswith(key) or key.startswith(path):
+                result.append(True)
+            elif not depth is None:
+                result.append(os.path.commonprefix((path, key)).count("/") >= depth)
+            else:
+                result.append(False)
+        return result
+
+    def storeAt(self, path, idx):
+        # store pruned to path with the state after log entry idx
+        path = tuple(path)
+        if not 0 <= idx < len(self.log):
+            raise ValueError("Log index {} out of range".format(idx))
+        start, store = self.seed(idx)
+        memo = self.memo.pop(path, None)
+        if memo is None:
+            memo = ([], [])
+        self.memo[path] = memo
+        if len(self.memo) > PathLookup.MEMO_SIZE:
+            del self.memo[next(iter(self.memo))]
+        pos = bisect_right(memo[0], idx)
+        if pos > 0 and memo[0][pos - 1] >= start:
+            start, store = memo[0][pos - 1], memo[1][pos - 1]
+
+        store = agency.AgencyStore.copyFrom(store)
+        store.prune(path)
+        key = agency.AgencyStore.pathPrefix(path)
+        depth = listDepth(store.store, path)
+        i = start
+        applied = 0
+        while True:
+            # below a list any operation sharing the way down to it matters
+            i = self.index.next(key if depth is None else agency.AgencyStore.pathPrefix(path[:depth]), i)
+            if i is None or i > idx:
+                break
+            program = self.program(i)
+            paths = self.paths(i)
+            if any(key.startswith(x) and not key == x for x in paths):
+                # parents may change the way down to path, run the entry as is
+                related = [True] * len(paths)
+            else:
+                related = self.related(key, depth, paths)
+                program = tuple(record for rel, record in zip(related, program) if rel)
+            try:
+                store.run(program, self.times[i])
+            except Exception as e:
+                raise Exception("In log entry {idx}: {text}".format(idx=self.log[i]["_key"], text=repr(e)))
+            if any(rel and not x.startswith(key) for rel, x in zip(related, paths)):
+                store.prune(path)
+            depth = listDepth(store.store, path)
+            applied += 1
+            if applied % PathLookup.MEMO_DISTANCE == 0:
+                self.remember(memo, i, store)
+
+        # ttl of the entries in between still expires
+        if store.ttl.due(self.times[idx]):
+            store.run((), self.times[idx])
+            store.prune(path)
+
+        self.remember(memo, idx, store)
+        return agency.AgencyStore.copyFrom(store)
+
+    def remember(self, memo, idx, store):
+        indexes, stores = memo
+        pos = bisect_left(indexes, idx)
+        if pos < len(indexes) and indexes[pos] == idx:
+            return
+        indexes.insert(pos, idx)
+        stores.insert(pos, agency.AgencyStore.copyFrom(store))
+
+    def valueAt(self, path, idx):
+        # value at path after log entry idx, None if it did not exist
+        return self.storeAt(path, idx).get(path)
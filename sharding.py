@@ -0,0 +1,352 @@
+import math
+import multiprocessing
+import time
+
+import agency
+import diskcache
+
+
+# Subtrees that are replayed in a process of their own, everything else is
+# replayed by one more process.
+SHARDS = (("arango", "Plan"), ("arango", "Current"), ("arango", "Supervision"), ("arango", "Target"), (".agency",))
+
+
+class ShardFailure(Exception):
+
+    def __init__(self, idx, text):
+        super().__init__(text)
+        self.idx = idx
+        self.text = text
+
+
+def locate(tree, path):
+    # (depth, node), the number of keys of path that exist on the way down
+    # and the node at path, which is only valid if depth is len(path)
+    node = tree
+    for depth, key in enumerate(path):
+        if not isinstance(node, dict) or not key in node:
+            return depth, None
+        node = node[key]
+    return len(path), node
+
+
+def parentsAreObjects(tree, path):
+    # missing parents are fine, operations below path create them as objects
+    node = tree
+    for key in path[:-1]:
+        if not key in node:
+            return True
+        node = node[key]
+        if not isinstance(node, dict):
+            return False
+    return True
+
+
+def touched(tree, path):
+    # The subtree an operation on path can change. It ends at the first node
+    # on the way that is no object, parents that are missing are created.
+    node = tree
+    for depth, key in enumerate(path):
+        if not isinstance(node, dict):
+            return path[:depth]
+        if not key in node:
+            return path
+        node = node[key]
+    return path
+
+
+def without(tree, paths):
+    # tree without the subtrees at paths, everything else is shared
+    below = dict()
+    for path in paths:
+        below.setdefault(path[0], []).append(path[1:])
+    tree = dict(tree)
+    for key, paths in below.items():
+        if not key in tree:
+            continue
+        if any(len(path) == 0 for path in paths):
+            del tree[key]
+        elif isinstance(tree[key], dict):
+            tree[key] = without(tree[key], paths)
+    return tree
+
+
+class Shard:
+    # The store of a worker process. sent is the state of the last delta,
+    # dirty the paths touched since then.
+
+    def __init__(self, tree, deadlines):
+        self.store = diskcache.storeFromParts(tree, deadlines)
+        self.sent = agency.AgencyStore.copyFrom(self.store)
+        self.dirty = set()
+
+    def expire(self, now):
+        if self.store.ttl.due(now):
+            self.dirty.update(touched(self.store.store, path) for path in self.store.expire(now))
+
+    def run(self, entries, end):
+        # entries are (idx, expire, now, program), expire is the latest time
+        # of the entries since the previous one of this shard, end the one
+        # since the last entry
+        store = self.store
+        for idx, expire, now, program in entries:
+            try:
+                self.expire(expire)
+                for record in program:
+                    self.dirty.add(touched(store.store, record[2]))
+                    store.run((record,), now)
+            except Exception as e:
+                raise ShardFailure(idx, repr(e))
+        self.expire(end)
+
+    def delta(self):
+        # Changes since the last delta as (records, parents, deadlines), see
+        # AgencyStore.delta for the records. parents are objects that have to
+        # exist although nothing below them does. Only the touched paths are
+        # compared.
+        records = []
+        parents = []
+        covered = None
+        for path in sorted(self.dirty):
+            if not covered is None and path[:len(covered)] == covered:
+                continue
+            covered = path
+            depth, new = locate(self.store.store, path)
+            sentDepth, old = locate(self.sent.store, path)
+            if depth < len(path):
+                if sentDepth == len(path):
+                    records.append((path, False, None))
+                if depth > 0:
+                    parents.append(path[:depth])
+            elif sentDepth == len(path) and isinstance(old, dict) and isinstance(new, dict):
+                records.extend((path + below, exists, value) for below, exists, value in agency.AgencyStore.delta(old, new))
+            elif not (sentDepth == len(path) and (old is new or (type(old) is type(new) and old == new))):
+                records.append((path, True, new))
+        self.sent = agency.AgencyStore.copyFrom(self.store)
+        self.dirty = set()
+        return records, parents, self.store.ttl.deadlines
+
+
+def serve(conn):
+    # main loop of a worker process, which ends with its replay, also when
+    # the process of the replay is gone without closing it
+    shard = None
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message[0] == "load":
+            shard = Shard(*message[1:])
+        elif message[0] == "run":
+            start = time.process_time()
+            try:
+                shard.run(*message[1:])
+                conn.send(("done", time.process_time() - start))
+            except ShardFailure as e:
+                conn.send(("failed", e.idx, e.text))
+        elif message[0] == "delta":
+            conn.send(shard.delta())
+        elif message[0] == "stop":
+            return
+
+
+class ShardedReplay:
+    # Replays the log with one process per shard and one for the rest. Each
+    # operation goes to the process of the shard its path is in. A store
+    # pruned to a shard behaves the same as the full store, as long as the
+    # parents of the shard are objects. The rest is replayed on the store
+    # without the shards.
+    #
+    # Operations on a parent of a shard, and the expiry of a parent, are
+    # barriers: the shards are assembled into a full store, the entry is run
+    # on it, and the result is split again. Until then, a shard that has
+    # something else than an object as parent is part of the rest.
+    #
+    # Assembling fetches the paths that changed since the last time from the
+    # workers and writes them to a copy of the previous result, so stores
+    # assembled one after another share their nodes. Workers only compare
+    # the subtrees their operations touched.
+    BATCH = 500
+    # how long close waits for a worker
+    STOP_SECONDS = 5
+
+    def __init__(self, shards=SHARDS):
+        self.shards = tuple(tuple(shard) for shard in shards)
+        self.rest = len(self.shards)
+        self.conns = []
+        self.processes = []
+        # workers with a store since the last split
+        self.loaded = ()
+        # pathPrefix of the shards that are replayed apart, with their worker
+        self.routes = ()
+        # pathPrefix of the parents of those shards
+        self.parents = frozenset()
+        # first deadline of a parent
+        self.barrier = math.inf
+        # per worker, the last entry whose time it has seen
+        self.seen = []
+        self.full = None
+
+    def start(self):
+        if len(self.conns) > 0:
+            return
+        # no fork, the ui runs threads
+        context = multiprocessing.get_context("spawn")
+        for _ in range(len(self.shards) + 1):
+            conn, child = context.Pipe()
+            process = context.Process(target=serve, args=(child,), daemon=True)
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    def close(self):
+        # stops the workers, those that do not stop in time are terminated
+        for conn in self.conns:
+            try:
+                conn.send(("stop",))
+            except OSError:
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join(ShardedReplay.STOP_SECONDS)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.conns = []
+        self.processes = []
+
+    def route(self, path):
+        # the worker of the operations on path, in the form of pathPrefix
+        for prefix, worker in self.routes:
+            if path.startswith(prefix):
+                return worker
+        return self.rest
+
+    def split(self, store, idx):
+        # loads store, the state after entry idx, into the workers
+        tree = store.store
+        active = [n for n, shard in enumerate(self.shards) if parentsAreObjects(tree, shard)]
+        self.routes = tuple((agency.AgencyStore.pathPrefix(self.shards[n]), n) for n in active)
+        self.parents = frozenset(agency.AgencyStore.pathPrefix(self.shards[n][:depth])
+                                 for n in active for depth in range(len(self.shards[n])))
+        self.loaded = tuple(active) + (self.rest,)
+        self.seen = [idx] * len(self.conns)
+
+        deadlines = [dict() for _ in self.conns]
+        self.barrier = math.inf
+        for key, entry in store.ttl.deadlines.items():
+            path = agency.AgencyStore.pathPrefix(entry[1])
+            if path in self.parents:
+                self.barrier = min(self.barrier, entry[0])
+            deadlines[self.route(path)][key] = entry
+
+        for n in active:
+            pruned = agency.AgencyStore(tree)
+            pruned.prune(self.shards[n])
+            self.conns[n].send(("load", pruned.store, deadlines[n]))
+        rest = without(tree, [self.shards[n] for n in active])
+        self.conns[self.rest].send(("load", rest, deadlines[self.rest]))
+        self.full = store
+
+    def prepare(self, first, end, program, paths, times):
+        # The entries from first on up to end or the next barrier, as (last
+        # entry, entries per worker, end time per worker). None if first is a
+        # barrier.
+        entries = [[] for _ in self.conns]
+        seen = self.seen
+        last = min(end, first + ShardedReplay.BATCH - 1)
+        idx = first
+        while idx <= last:
+            now = times[idx]
+            entryPaths = paths(idx)
+            if now > self.barrier or any(path in self.parents for path in entryPaths):
+                break
+            records = program(idx)
+            if len(records) == 1:
+                targets = {self.route(entryPaths[0]): records}
+            else:
+                targets = dict()
+                for record, path in zip(records, entryPaths):
+                    targets.setdefault(self.route(path), []).append(record)
+            for worker, part in targets.items():
+                # ttl expires with the latest time, times are not monotonic
+                expire = now if seen[worker] == idx - 1 else max(times[seen[worker] + 1:idx + 1])
+                entries[worker].append((idx, expire, now, tuple(part)))
+                seen[worker] = idx
+            idx += 1
+        if idx == first:
+            return None
+
+        last = idx - 1
+        ends = [0] * len(self.conns)
+        for worker in self.loaded:
+            if seen[worker] < last:
+                ends[worker] = max(times[seen[worker] + 1:last + 1])
+                seen[worker] = last
+        return last, entries, ends
+
+    def replay(self, store, start, end, program, paths, times, runEntry):
+        # Generator that replays entries start to end on top of store, which
+        # it takes over. After each batch and barrier it yields the last
+        # entry done and the cpu time all processes spent on it, assemble
+        # returns the store after that entry. runEntry(store, idx) applies
+        # entry idx to a full store. program(idx) and paths(idx) are those of
+        # the app.
+        self.start()
+        self.split(store, start - 1)
+        idx = start
+        batch = self.prepare(idx, end, program, paths, times)
+        while idx <= end:
+            if batch is None:
+                before = time.process_time()
+                store = self.assemble()
+                runEntry(store, idx)
+                self.split(store, idx)
+                yield idx, time.process_time() - before
+                idx += 1
+                batch = self.prepare(idx, end, program, paths, times) if idx <= end else None
+            else:
+                last = batch[0]
+                for worker in self.loaded:
+                    self.conns[worker].send(("run", batch[1][worker], batch[2][worker]))
+                # the next batch is prepared while the workers are busy
+                following = self.prepare(last + 1, end, program, paths, times) if last < end else None
+                cost = self.collect()
+                yield last, cost
+                idx = last + 1
+                batch = following
+
+    def collect(self):
+        # the replies of a batch, returns the cpu time it took
+        cost = 0
+        failure = None
+        for worker in self.loaded:
+            reply = self.conns[worker].recv()
+            if reply[0] == "failed":
+                if failure is None or reply[1] < failure.idx:
+                    failure = ShardFailure(reply[1], reply[2])
+            else:
+                cost += reply[1]
+        if failure is not None:
+            raise failure
+        return cost
+
+    def assemble(self):
+        # the full store after the last entry done, as a new copy
+        for worker in self.loaded:
+            self.conns[worker].send(("delta",))
+        deltas = {worker: self.conns[worker].recv() for worker in self.loaded}
+        full = self.full
+        ttl = agency.AgencyTtl()
+        # no worker writes to a parent of another one
+        for worker in self.loaded:
+            records, parents, deadlines = deltas[worker]
+            for path in parents:
+                if locate(full.store, path)[0] < len(path):
+                    full.set(path, {})
+            full.writeDelta(records)
+            ttl.deadlines.update(deadlines)
+        ttl.compact()
+        full.replaceTtl(ttl)
+        return agency.AgencyStore.copyFrom(full)
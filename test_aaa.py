@@ -0,0 +1,355 @@
+import argparse
+import copy
+import pickle
+import threading
+import time
+
+import pytest
+
+import agency
+import aaa
+import logtable
+import sharding
+from examples import example
+
+
+class Provider:
+    # a log file provider of given entries and compactions
+    def __init__(self, log, snapshots, agencyState=None):
+        self._log = logtable.LogTable(log)
+        self._snapshots = aaa.sorted_snapshots(snapshots)
+        self._agencyState = agencyState
+
+    def log(self):
+        return self._log
+
+    def snapshots(self):
+        return self._snapshots
+
+    def agencyState(self):
+        return self._agencyState
+
+    def digest(self):
+        return None
+
+
+class App(aaa.LoadedLog):
+    # what a StoreProvider needs of the app, without its worker thread
+    def __init__(self, provider, cacheMb=64):
+        self.provider = provider
+        self.log = None
+        self.args = argparse.Namespace(cache_mb=cacheMb, cold_checkpoints="zlib", checkpoints="adaptive",
+                                       sharded=False, prefetch=False, disk_cache=None)
+        self.storeProvider = aaa.StoreProvider(self, aaa.Rect.zero())
+        self.loadLog()
+
+    def queueEvent(self, ev):
+        pass
+
+    def showProgress(self, progress, msg, rect=None):
+        pass
+
+    def storeAt(self, idx):
+        provider = self.storeProvider
+        result = provider.updateIndex(idx)
+        return result, provider.store.store if result == aaa.StoreUpdateResult.UPDATE_JSON else None
+
+
+def replayed(log, last, first=0, tree={}):
+    # the store after log entry last, replayed on tree from entry first
+    store = agency.AgencyStore(tree)
+    for entry in log[first:last + 1]:
+        store.applyLog(entry)
+    return store.store
+
+
+def compaction(log, last):
+    # compactions have no ttl schedule, see StoreProvider.setAgencyState
+    return {"_key": log[last]["_key"], "readDB": [replayed(log, last)]}
+
+
+def test_compaction_before_the_log_is_skipped():
+    log = example("small.json")
+    first = compaction(log, 60)
+    app = App(Provider(log[50:], [compaction(log, 10), first]))
+    assert app.snapshot is first
+    assert app.storeAt(5) == (aaa.StoreUpdateResult.NOT_COVERED, None)
+    for idx in [10, 11, 100, len(log) - 51]:
+        expected = replayed(log, idx + 50, 61, first["readDB"][0])
+        assert app.storeAt(idx) == (aaa.StoreUpdateResult.UPDATE_JSON, expected)
+
+
+def test_no_compaction_within_the_log():
+    log = example("small.json")
+    app = App(Provider(log[50:], [compaction(log, 10)]))
+    assert app.firstValidLogIdx is None
+    assert app.storeAt(100) == (aaa.StoreUpdateResult.NOT_COVERED, None)
+    assert app.storeProvider.closestSeed(100) is None
+
+
+def test_agency_state_is_verified_by_replay():
+    log = example("small.json")
+    state = replayed(log, 200)
+    app = App(Provider(log, [], (int(log[200]["_key"]), state)))
+    assert app.storeProvider.agencyState == (log[200]["_key"], True)
+    # replays from the state on, which has no ttl schedule
+    assert app.storeAt(240) == (aaa.StoreUpdateResult.UPDATE_JSON, replayed(log, 240, 201, state))
+
+    broken = dict(state, arango=dict(state["arango"], InitDone=False))
+    app = App(Provider(log, [], (int(log[200]["_key"]), broken)))
+    assert app.storeProvider.agencyState == (log[200]["_key"], False)
+    assert app.storeAt(240) == (aaa.StoreUpdateResult.UPDATE_JSON, replayed(log, 240))
+
+
+def test_seeds_start_after_their_last_entry():
+    log = example("small.json")
+    app = App(Provider(log[50:], [compaction(log, 49), compaction(log, 120)]))
+    assert app.firstValidLogIdx == 0
+    assert app.storeProvider.seedStarts == [0, 71]
+    assert app.storeAt(70) == (aaa.StoreUpdateResult.UPDATE_JSON, compaction(log, 120)["readDB"][0])
+
+
+def test_new_seeds_drop_undo_records():
+    log = example("small.json")
+    app = App(Provider(log, []))
+    assert app.storeAt(150)[0] == aaa.StoreUpdateResult.UPDATE_JSON
+    assert len(app.storeProvider.undo) > 0
+    app.storeProvider.setSnapshots([compaction(log, 100)])
+    assert app.storeProvider.undo == {}
+    assert app.storeAt(140) == (aaa.StoreUpdateResult.UPDATE_JSON, replayed(log, 140, 101, replayed(log, 100)))
+
+
+def test_scoped_replay_equals_full_replay():
+    log = example("small.json")
+    app = App(Provider(log, []))
+    scope = ["arango", "Plan"]
+    app.storeProvider.setScope(scope)
+    # forwards, backwards and one entry at a time
+    for idx in [100, 90, 250, 30, 31]:
+        result, tree = app.storeAt(idx)
+        assert result == aaa.StoreUpdateResult.UPDATE_JSON
+        assert list(tree) == ["arango"] and list(tree["arango"]) == ["Plan"]
+        assert tree["arango"]["Plan"] == replayed(log, idx)["arango"]["Plan"]
+    app.storeProvider.setScope(None)
+    assert app.storeAt(120) == (aaa.StoreUpdateResult.UPDATE_JSON, replayed(log, 120))
+
+
+def test_values_outside_of_the_scope_are_looked_up():
+    # e.g. the diff view shows the paths of a request, which may lie outside
+    # of the scope
+    log = example("small.json")
+    app = App(Provider(log, []))
+    app.storeProvider.setScope(["arango", "Current"])
+    for idx in [40, 41, 150]:
+        assert app.storeAt(idx)[0] == aaa.StoreUpdateResult.UPDATE_JSON
+        store = app.storeProvider.store
+        assert store._ref(["arango", "Plan"]) is None
+        for path in [["arango", "Plan"], ["arango", "Current"]]:
+            assert app.storeValue(store, path, idx) == replayed(log, idx)[path[0]][path[1]]
+
+
+def test_lookup_uses_the_seeds():
+    log = example("small.json")
+    app = App(Provider(log[50:], [compaction(log, 10)]))
+    # the log starts after the compaction, nothing can be looked up
+    assert app.storeAt(100) == (aaa.StoreUpdateResult.NOT_COVERED, None)
+    with pytest.raises(ValueError):
+        app.valueAt(["arango", "Plan"], 100)
+
+    seed = compaction(log, 120)
+    app = App(Provider(log[50:], [compaction(log, 49), seed]))
+    app.storeProvider.setScope(["arango", "Current"])
+    for idx in [100, 71, 20, 150]:
+        assert app.valueAt(["arango", "Plan"], idx) == replayed(log, idx + 50)["arango"]["Plan"]
+    # the lookup starts at the latest compaction before the entry
+    assert app.getPathLookup().seed(100)[1].store is seed["readDB"][0]
+
+
+def test_adaptive_checkpoints_cap_the_replay():
+    # a checkpoint is far larger than the cache, but replays are still
+    # interrupted by one after the latency
+    policy = aaa.AdaptiveCheckpoints(latency=0.04)
+    cache = aaa.StoreCache(2**10)
+    cache.set(0, ["x" * 2**20])
+    policy.visit(10**6 - 1, 10**6)
+    assert not policy.place(cache, 1, 10**6 - 1, 0.01, 0.03)
+    assert policy.place(cache, 2, 10**6 - 1, 0.01, 0.04)
+
+
+def coldCache():
+    # a cache of stores sharing nothing, so that each of them is worth
+    # compressing, with a budget too small for all of them
+    log = example("small.json")
+    stores = []
+    store = agency.AgencyStore()
+    for entry in log[:80]:
+        store.applyLog(entry)
+        stores.append(agency.AgencyStore(copy.deepcopy(store.store)))
+    cache = aaa.StoreCache(2**40, aaa.COLD_COMPRESSION["zlib"])
+    for idx in range(0, 80, 10):
+        cache.set(idx, stores[idx])
+    cache.budget = cache.resident * 3 // 4
+    cache.set(79, stores[79])
+    return cache, stores
+
+
+def test_used_cold_checkpoints_are_live_again():
+    cache, stores = coldCache()
+    idx = next(i for i, (value, _, _) in cache.cache.items()
+               if isinstance(value, aaa.DeltaStore) or (isinstance(value, aaa.ColdStore) and value.deltas == 0))
+    store = cache.get(idx)
+    assert store.store == stores[idx].store
+    assert cache.cache[idx][0] is store and next(reversed(cache.cache)) == idx
+
+
+def test_deltas_share_the_accounted_base():
+    cache, stores = coldCache()
+    deltas = [i for i, (value, _, _) in cache.cache.items() if isinstance(value, aaa.DeltaStore)]
+    assert len(deltas) > 1
+    base = cache.cache[deltas[0]][0].base
+    for idx in deltas:
+        store = cache.peek(idx)
+        assert store.store == stores[idx].store
+        # the base is inflated once, the deltas only copy what differs
+        assert cache.baseTree[0] is base
+        assert any(node is cache.baseTree[1]["arango"][key] for key, node in store.store["arango"].items())
+
+    # the base takes its deltas and its tree along
+    removed = [i for i, (value, _, _) in cache.cache.items() if value is base or getattr(value, "base", None) is base]
+    resident = cache.resident - base.live - sum(cache.cache[i][1] for i in removed)
+    cache.remove(next(i for i in removed if cache.cache[i][0] is base))
+    assert cache.baseTree is None and not any(cache.has(i) for i in removed)
+    assert cache.resident == resident
+
+
+def test_close_stops_sharded_replays():
+    app = App(Provider(example("small.json"), []))
+    app.storeProvider.sharded = sharding.ShardedReplay()
+    app.storeProvider.sharded.start()
+    processes = list(app.storeProvider.sharded.processes)
+    app.storeProvider.close()
+    assert not any(process.is_alive() for process in processes)
+
+
+class WorkerApp(App):
+    # an App whose store provider replays on its worker thread, entries take
+    # a while to compile
+    def __init__(self, provider, delay=0):
+        super().__init__(provider)
+        self.updated = threading.Event()
+        self.replaying = threading.Event()
+        self.delay = delay
+        self.served = []
+        updateIndex = self.storeProvider.updateIndex
+
+        def recordingUpdateIndex(idx, cancelled=None):
+            result = updateIndex(idx, cancelled)
+            self.served.append((idx, result))
+            return result
+        self.storeProvider.updateIndex = recordingUpdateIndex
+        self.storeProvider.start()
+
+    def queueEvent(self, ev):
+        if isinstance(ev, aaa.StoreUpdateEvent):
+            self.updated.set()
+
+    def logProgram(self, i):
+        self.replaying.set()
+        time.sleep(self.delay)
+        return super().logProgram(i)
+
+    def waitFor(self, indexes):
+        # the results of the store provider, once it has them
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            self.updated.wait(0.1)
+            self.updated.clear()
+            self.storeProvider.notified = False
+            results = self.storeProvider.request(indexes)
+            if results is not None:
+                return results
+        raise TimeoutError(indexes)
+
+
+def test_worker_replays_the_latest_request():
+    log = example("small.json")
+    app = WorkerApp(Provider(log, []))
+    provider = app.storeProvider
+    with provider.paused():
+        # the worker waits for the lock, each request replaces the last one
+        for idx in [50, 100, 150]:
+            assert provider.request([idx]) is None
+    results = app.waitFor([150])
+    assert results == [(aaa.StoreUpdateResult.UPDATE_JSON, provider.current)]
+    assert provider.current.store == replayed(log, 150)
+    # an older request is given up before anything is replayed for it
+    assert app.served[-1] == (150, aaa.StoreUpdateResult.UPDATE_JSON)
+    assert all(result == aaa.StoreUpdateResult.PENDING for idx, result in app.served[:-1])
+    assert set(provider.results) == {150}
+
+
+def test_worker_pauses_for_log_changes():
+    log = example("small.json")
+    app = WorkerApp(Provider(log[:200], []), delay=0.01)
+    provider = app.storeProvider
+    assert provider.request([190]) is None
+    assert app.replaying.wait(10)
+    started = time.monotonic()
+    with provider.paused():
+        # the replay stops at the next entry, well before it is done, and
+        # the log can be extended like the app does
+        assert time.monotonic() - started < 1
+        app.log.extend(log[200:])
+        app.logPrograms.extend([None] * len(log[200:]))
+        app.logPathSummaries.extend([None] * len(log[200:]))
+    results = app.waitFor([190, 220])
+    assert [result for result, _ in results] == [aaa.StoreUpdateResult.UPDATE_JSON] * 2
+    assert results[0][1].store == replayed(log, 190)
+    assert results[1][1].store == replayed(log, 220)
+    assert (190, aaa.StoreUpdateResult.PENDING) in app.served
+
+
+class LocalClient:
+    # calls a StoreEngine like engine.EngineClient, requests and replies
+    # are pickled like on a connection
+    def __init__(self, storeEngine):
+        self.storeEngine = storeEngine
+
+    def call(self, *request):
+        reply = self.storeEngine.handle(self, *pickle.loads(pickle.dumps(request)))
+        return pickle.loads(pickle.dumps(reply))
+
+
+class RemoteApp(aaa.LoadedLog):
+    # the part of the ui that shows the log of an engine
+    def __init__(self, client):
+        self.provider = aaa.RemoteLogProvider(client)
+        self.log = None
+        self.storeProvider = aaa.RemoteStoreProvider(self, client)
+        self.loadLog()
+
+
+def test_remote_log_is_the_log_of_the_engine():
+    log = example("small.json")
+    snapshot = compaction(log, 60)
+    engineApp = App(Provider(log[50:], [snapshot]))
+    client = LocalClient(aaa.StoreEngine(engineApp))
+    app = RemoteApp(client)
+    local, remote = engineApp.log, app.log
+    assert len(remote) == len(local)
+    for i in range(len(local)):
+        assert (remote.key(i), remote.term(i), remote.time(i), remote.text(i), remote.requestPaths(i)) == \
+               (local.key(i), local.term(i), local.time(i), local.text(i), local.requestPaths(i))
+        assert remote[i] == local[i]
+    assert (app.snapshot["_key"], app.firstValidLogIdx) == (snapshot["_key"], engineApp.firstValidLogIdx)
+    assert app.snapshot.value is None and dict(app.snapshot) == snapshot
+    # nothing is compiled in the ui, filters and the path index run in the engine
+    assert app.logPrograms is None
+    assert remote.grep("Plan") == [i for i in range(len(local)) if "Plan" in local.text(i)]
+    assert remote.regexp("^arango/Plan") == \
+           [i for i in range(len(local)) if any(path.startswith("arango/Plan") for path in local.requestPaths(i))]
+    prefix = agency.AgencyStore.pathPrefix(["arango", "Plan"])
+    index = engineApp.getPathIndex()
+    assert app.getPathIndex().changes(prefix, 10) == index.changes(prefix, 10)
+    assert (app.getPathIndex().next(prefix, 20), app.getPathIndex().prev(prefix, 20)) == \
+           (index.next(prefix, 20), index.prev(prefix, 20))
@@ -0,0 +1,172 @@
+import copy
+import random
+
+import pytest
+
+import agency
+from examples import example
+
+KEYS = ["a", "b", "c"]
+
+# (store, request, store after the request), each written down by hand
+OPERATIONS = [
+    ({}, {"a/b": {"op": "set", "new": 1}}, {"a": {"b": 1}}),
+    ({"a": 1}, {"a/b/c": [1]}, {"a": {"b": {"c": [1]}}}),
+    ({"a": {"b": 1}}, {"/a//b/": {"new": 2}}, {"a": {"b": 2}}),
+    ({"a": {"b": 1, "c": 2}}, {"a/b": {"op": "delete"}}, {"a": {"c": 2}}),
+    ({"a": 1}, {"a/b": {"op": "delete"}}, {"a": 1}),
+    ({"a": {"b": 1}}, {"a/b": {"op": "increment"}, "a/c": {"op": "increment", "step": 5}}, {"a": {"b": 2, "c": 5}}),
+    ({"a": {"b": 1, "c": "x"}}, {"a/b": {"op": "decrement", "step": 3}, "a/c": {"op": "decrement"}},
+     {"a": {"b": -2, "c": -1}}),
+    ({"a": [1], "c": 1}, {"a": {"op": "push", "new": 2}, "b": {"op": "push", "new": 3}, "c": {"op": "push", "new": 4}},
+     {"a": [1, 2], "b": [3], "c": [4]}),
+    ({"a": [1, 2]}, {"a": {"op": "push-queue", "new": 3, "len": 2}, "b": {"op": "push-queue", "new": 4, "len": 0}},
+     {"a": [2, 3], "b": []}),
+    ({"a": [1, 2], "b": 1}, {"a": {"op": "pop"}, "b": {"op": "pop"}}, {"a": [1], "b": 1}),
+    ({"a": [1], "b": 1}, {"a": {"op": "prepend", "new": 0}, "b": {"op": "prepend", "new": 0}}, {"a": [0, 1], "b": [0]}),
+    ({"a": [1, 2], "b": "x"}, {"a": {"op": "shift"}, "b": {"op": "shift"}}, {"a": [2], "b": "x"}),
+    ({"a": [1, 2, 1]}, {"a": {"op": "erase", "val": 1}}, {"a": [2, 1]}),
+    ({"a": [1, 2]}, {"a": {"op": "erase", "val": 3}}, {"a": [1, 2]}),
+    ({"a": [1, 2, 1]}, {"a": {"op": "replace", "val": 1, "new": 3}}, {"a": [3, 2, 3]}),
+    ({"a": {"b": {"c": 1}, "x": 1}}, {"a": {"op": "update", "val": {"b": {"d": 2}, "x": None}}},
+     {"a": {"b": {"c": 1, "d": 2}}}),
+    ({"a": {"b": {"c": 1}}}, {"a": {"op": "update", "val": {"b": {"e": None}}, "mergeObjects": False,
+                                    "keepNull": True}},
+     {"a": {"b": {"e": None}}}),
+    ({}, {"r": {"op": "read-lock", "by": "x"}, "w": {"op": "write-lock", "by": "y"}}, {"r": ["x"], "w": "y"}),
+    ({"r": ["x"], "w": "y"}, {"r": {"op": "read-unlock", "by": "x"}, "w": {"op": "write-unlock", "by": "y"}}, {}),
+    ({"a": 1}, {"a": {"op": "observe"}, "b": {"op": "unobserve"}}, {"a": 1}),
+]
+
+
+@pytest.mark.parametrize("tree, agencyRequest, expected", OPERATIONS)
+def test_operation(tree, agencyRequest, expected):
+    before = copy.deepcopy(tree)
+    program = agency.AgencyStore.compile(agencyRequest)
+    # a program is run on several stores, it is not changed by running it
+    for _ in range(2):
+        store = agency.AgencyStore(tree)
+        store.run(program, 100)
+        assert store.store == expected
+    assert tree == before
+
+
+@pytest.mark.parametrize("agencyRequest", [{"a": {"op": "set"}}, {"a": {"op": "push-queue", "new": 1}},
+                                           {"a": {"op": "unknown"}}])
+def test_broken_operation(agencyRequest):
+    # compiling never fails, running does
+    program = agency.AgencyStore.compile(agencyRequest)
+    with pytest.raises(Exception):
+        agency.AgencyStore().run(program, 100)
+
+
+def test_ttl():
+    store = agency.AgencyStore()
+    store.run(agency.AgencyStore.compile({"a/b": {"op": "set", "new": 1, "ttl": 5}, "c": {"op": "set", "new": 2}}), 100)
+    assert store.ttl.deadlines == {"a/b": (105, ("a", "b"))}
+    store.run(agency.AgencyStore.compile({"c": {"op": "increment"}}), 104)
+    assert store.store == {"a": {"b": 1}, "c": 3}
+
+    # setting the key again moves its deadline, assigning it drops it
+    store.run(agency.AgencyStore.compile({"a/b": {"op": "set", "new": 1, "ttl": 5}}), 104)
+    store.run(agency.AgencyStore.compile({"c": {"op": "increment"}}), 106)
+    assert store.store == {"a": {"b": 1}, "c": 4}
+    store.run(agency.AgencyStore.compile({"a/b": {"op": "set", "new": 1}}), 106)
+    assert store.ttl.deadlines == {}
+    store.run(agency.AgencyStore.compile({"c": {"op": "increment"}}), 200)
+    assert store.store == {"a": {"b": 1}, "c": 5}
+
+    store.run(agency.AgencyStore.compile({"a/b": {"op": "set", "new": 1, "ttl": 5}}), 200)
+    store.run(agency.AgencyStore.compile({"c": {"op": "increment"}}), 206)
+    assert store.store == {"a": {}, "c": 6}
+    assert store.ttl.deadlines == {}
+
+
+def randomPath(rnd):
+    return "/" + "/".join(rnd.choice(KEYS) for _ in range(rnd.randint(1, 4)))
+
+
+def randomValue(rnd, depth=0):
+    kind = rnd.random()
+    if kind < 0.3 and depth < 2:
+        return {k: randomValue(rnd, depth + 1) for k in rnd.sample(KEYS, rnd.randint(0, 3))}
+    if kind < 0.4 and depth < 2:
+        return [randomValue(rnd, depth + 1) for _ in range(2)]
+    return rnd.choice([1, 2, "x", None])
+
+
+def randomRequest(rnd):
+    # a request of the operations that modify arrays, objects and ttls
+    request = dict()
+    for _ in range(rnd.randint(1, 3)):
+        op = rnd.choice(["set", "delete", "push", "pop", "shift", "increment", "update", "prepend", "erase",
+                         "replace", "plain"])
+        if op == "plain":
+            request[randomPath(rnd)] = randomValue(rnd)
+            continue
+        value = {"op": op}
+        if op in ("set", "push", "prepend"):
+            value["new"] = randomValue(rnd)
+        elif op == "update":
+            value["val"] = {k: randomValue(rnd) for k in rnd.sample(KEYS, 2)}
+        elif op == "erase":
+            value["val"] = randomValue(rnd)
+        elif op == "replace":
+            value["val"], value["new"] = 1, 2
+        if rnd.random() < 0.1:
+            value["ttl"] = rnd.randint(1, 5)
+        request[randomPath(rnd)] = value
+    return request
+
+
+def randomLog(seed, count=200):
+    rnd = random.Random(seed)
+    return [{"request": randomRequest(rnd), "epoch_millis": 1000 * t} for t in range(count)]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_revert_restores_the_store(seed):
+    rnd = random.Random(seed)
+    store = agency.AgencyStore()
+    steps = []
+    copies = []
+    for now, entry in enumerate(randomLog(seed, 60)):
+        if rnd.random() < 0.1:
+            copies.append((agency.AgencyStore.copyFrom(store), copy.deepcopy(store.store)))
+        before = (copy.deepcopy(store.store), dict(store.ttl.deadlines))
+        undo = []
+        try:
+            store.run(agency.AgencyStore.compile(entry["request"]), now, undo)
+        except Exception:
+            # a failed run leaves the store in between, there is no way back
+            steps = []
+            continue
+        steps.append((before, undo))
+
+    for (tree, deadlines), undo in reversed(steps):
+        store.revert(undo)
+        assert store.store == tree
+        assert store.ttl.deadlines == deadlines
+    # copies share their nodes with the store, but never see its writes
+    for other, tree in copies:
+        assert other.store == tree
+
+
+@pytest.mark.parametrize("prefix", [("arango", "Plan"), ("arango", "Current", "Collections"), ("arango",)])
+def test_pruned_store_replays_its_prefix(prefix):
+    log = example("agency-dump.json")
+    times = agency.AgencyStore.logTimes(log)
+    full = agency.AgencyStore()
+    for entry, now in zip(log[:100], times):
+        full.run(agency.AgencyStore.compile(entry["request"]), now)
+    pruned = agency.AgencyStore.copyFrom(full)
+    pruned.prune(prefix)
+    assert set(pruned.store) <= {prefix[0]}
+
+    for entry, now in zip(log[100:], times[100:]):
+        program = agency.AgencyStore.compile(entry["request"])
+        full.run(program, now)
+        scoped = [record for record in program if record[2][:len(prefix)] == prefix[:len(record[2])]]
+        pruned.run(scoped, now)
+        assert pruned._ref(list(prefix)) == full._ref(list(prefix))
+    assert full._ref(list(prefix)) is not None
@@ -0,0 +1,76 @@
+import bz2
+import gzip
+import lzma
+import os
+
+import pytest
+
+import aaa
+import decompress
+from examples import EXAMPLE
+
+COMPRESSIONS = {"gz": gzip.compress, "xz": lzma.compress, "bz2": bz2.compress}
+
+
+def entries(provider):
+    log = provider.log()
+    return [log[i] for i in range(len(log))]
+
+
+@pytest.fixture(params=sorted(COMPRESSIONS))
+def compressed(request, tmp_path):
+    # example/small.json compressed, and its uncompressed content
+    with open(os.path.join(EXAMPLE, "small.json"), "rb") as f:
+        data = f.read()
+    path = tmp_path / "small.json.{}".format(request.param)
+    path.write_bytes(COMPRESSIONS[request.param](data))
+    return str(path), data
+
+
+def test_compressed_file_is_read_decompressed(compressed, monkeypatch):
+    path, data = compressed
+    monkeypatch.setattr(decompress.InputFile, "CHUNK", 1000)
+    assert decompress.isCompressed(path)
+    consumed = []
+    with decompress.InputFile(path, consumed.append) as f:
+        assert f.compressed
+        chunks = []
+        while True:
+            chunk = f.read(777)
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+    assert b"".join(chunks) == data
+    # the digest is of the file as it is
+    with open(path, "rb") as f:
+        assert b"".join(consumed) == f.read()
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_compressed_log_equals_uncompressed(compressed, streaming):
+    path, _ = compressed
+    plain = aaa.ArangoAgencyLogFileProvider(os.path.join(EXAMPLE, "small.json"), [], streaming)
+    provider = aaa.ArangoAgencyLogFileProvider(path, [], streaming)
+    assert provider.loader is None
+    assert entries(provider) == entries(plain)
+
+
+def test_uncompressed_file_is_read_as_it_is():
+    path = os.path.join(EXAMPLE, "small.json")
+    assert not decompress.isCompressed(path)
+    with decompress.InputFile(path) as f:
+        assert not f.compressed
+        with open(path, "rb") as raw:
+            assert f.read() == raw.read()
+
+
+def test_broken_compressed_file(compressed, tmp_path):
+    path, _ = compressed
+    with open(path, "rb") as f:
+        data = f.read()
+    broken = tmp_path / "broken"
+    broken.write_bytes(data[:len(data) // 2])
+    assert decompress.isCompressed(str(broken))
+    with pytest.raises(Exception):
+        with decompress.InputFile(str(broken)) as f:
+            f.read()
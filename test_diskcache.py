@@ -0,0 +1,53 @@
+import os
+
+import agency
+import diskcache
+
+
+def store():
+    result = agency.AgencyStore()
+    result.run(agency.AgencyStore.compile({"a/b": {"op": "set", "new": [1, 2.5, None, "ü"], "ttl": 5},
+                                           "c": {"d": True}}), 100)
+    return result
+
+
+def test_saved_checkpoints_are_loaded(tmp_path):
+    cache = diskcache.DiskCache(str(tmp_path), "key", 2**20)
+    cache.save(7, store())
+    # another session
+    cache = diskcache.DiskCache(str(tmp_path), "key", 2**20)
+    assert cache.closest(8) == 7
+    loaded = cache.load(7)
+    assert loaded.store == store().store
+    assert loaded.ttl.deadlines == {"a/b": (105, ("a", "b"))}
+    assert cache.stats().startswith("1 checkpoints")
+
+
+def test_broken_checkpoints_are_discarded(tmp_path):
+    cache = diskcache.DiskCache(str(tmp_path), "key", 2**20)
+    for idx in range(4):
+        cache.save(idx, store())
+    with open(cache.fileName(0), "rb") as f:
+        data = f.read()
+    with open(cache.fileName(3), "rb") as f:
+        other = f.read()
+    # no checkpoint at all, truncated, a checkpoint of another index and of
+    # another format
+    for idx, broken in enumerate([b"{}", data[:len(data) // 2], data, other.replace(b"\x03", b"\x02", 1)]):
+        with open(cache.fileName(idx), "wb") as f:
+            f.write(broken)
+    for idx in range(4):
+        assert cache.load(idx) is None
+    assert cache.failures == 4 and cache.indexes == []
+    assert os.listdir(cache.path) == []
+
+
+def test_least_recently_used_checkpoints_are_pruned(tmp_path):
+    cache = diskcache.DiskCache(str(tmp_path), "key", 2**20)
+    cache.save(0, store())
+    size = os.path.getsize(cache.fileName(0))
+    cache = diskcache.DiskCache(str(tmp_path), "key", 2 * size)
+    cache.save(1, store())
+    os.utime(cache.fileName(0), (0, 0))
+    cache.save(2, store())
+    assert cache.indexes == [1, 2]
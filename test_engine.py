@@ -0,0 +1,28 @@
+import os
+import stat
+
+import pytest
+
+import engine
+
+
+def test_generated_key_is_only_written_to_a_private_file(monkeypatch, capsys):
+    monkeypatch.delenv(engine.KEY_VARIABLE, raising=False)
+    with pytest.raises(engine.EngineError):
+        engine.authkey()
+    key = engine.authkey(generate=True)
+    output = capsys.readouterr().out
+    assert key.decode() not in output
+    path = output.split()[-1]
+    with open(path) as f:
+        assert f.read().encode() == key
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert os.environ[engine.KEY_VARIABLE].encode() == key
+    os.remove(path)
+    os.rmdir(os.path.dirname(path))
+
+
+def test_key_of_the_environment_is_used(monkeypatch, capsys):
+    monkeypatch.setenv(engine.KEY_VARIABLE, "secret")
+    assert engine.authkey(generate=True) == b"secret"
+    assert capsys.readouterr().out == ""
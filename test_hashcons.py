@@ -0,0 +1,44 @@
+import pytest
+
+import agency
+import hashcons
+import logtable
+from examples import example
+
+
+def replay(log, interner):
+    store = agency.AgencyStore()
+    for entry, now in zip(log, agency.AgencyStore.logTimes(log)):
+        store.run(agency.AgencyStore.compile(entry["request"], interner), now)
+    return store
+
+
+@pytest.mark.parametrize("name", ["small.json", "agency-dump.json"])
+def test_interned_replay_equals_plain(name):
+    log = example(name)
+    interner = hashcons.Interner()
+    store = replay(log, interner)
+    plain = replay(log, None)
+    assert store.store == plain.store
+    assert store.ttl.deadlines == plain.ttl.deadlines
+    assert interner.hits > 0
+
+
+def test_interned_values_are_kept_apart():
+    interner = hashcons.Interner()
+    values = [0, 0.0, -0.0, False, 1, 1.0, True, "1", [1], [1.0], {"a": 1}, {"a": True}]
+    shared = [interner.value(value) for value in values]
+    assert [repr(value) for value in shared] == [repr(value) for value in values]
+    assert interner.value({"a": [1, "x"]}) is interner.value({"a": [1, "x"]})
+
+
+def test_log_table_shares_the_interner():
+    entries = example("small.json")
+    log = logtable.LogTable(entries[:100])
+    # appended entries go through the same interner as loaded ones
+    log.extend(entries[100:])
+    for i in range(len(log)):
+        assert all(path is log.interner.string(path) for path in log.requestPaths(i))
+        assert log.clientId(i) is log.interner.value(entries[i]["clientId"])
+    program = agency.AgencyStore.compile(entries[-1]["request"], log.interner)
+    assert all(record[2] is log.interner.path(record[2]) for record in program)
@@ -0,0 +1,88 @@
+import codecs
+import io
+import json
+
+import pytest
+
+import logstream
+
+ENTRIES = [{"_key": "{:020d}".format(i), "request": {"a/b": {"op": "set", "new": "ü" * i}}, "term": 10 ** i}
+           for i in range(20)]
+
+
+def read(data):
+    stream = logstream.LogStream(io.BytesIO(data))
+    entries = []
+    spans = []
+    for entry in stream.entries():
+        entries.append(entry)
+        spans.append(stream.span)
+        # the text of an entry is the span of the file
+        assert stream.raw == data[stream.span[0]:stream.span[1]]
+    return stream, entries, spans
+
+
+@pytest.fixture(params=[1, 2, 3, 7, 64, logstream.LogStream.CHUNK])
+def chunk(request, monkeypatch):
+    # values, multibyte characters and numbers end on every possible byte
+    # of a chunk
+    monkeypatch.setattr(logstream.LogStream, "CHUNK", request.param)
+    return request.param
+
+
+@pytest.mark.parametrize("bom", [b"", codecs.BOM_UTF8])
+def test_list(chunk, bom):
+    data = bom + json.dumps(ENTRIES, ensure_ascii=False, indent=1).encode()
+    stream, entries, spans = read(data)
+    assert entries == ENTRIES
+    assert not stream.object
+    for entry, (start, end) in zip(entries, spans):
+        assert json.loads(data[start:end]) == entry
+
+
+def test_query_result(chunk):
+    data = json.dumps({"hasMore": False, "result": ENTRIES, "count": 12345}, ensure_ascii=False).encode()
+    stream, entries, _ = read(data)
+    assert entries == ENTRIES
+    assert stream.logAttribute == "result"
+    assert stream.fields == {"hasMore": False, "count": 12345}
+    start, end = stream.fieldSpans["count"]
+    assert data[start:end] == b"12345"
+
+
+def test_agency_dump(chunk):
+    dump = {"index": 7, "term": 3, "agency": {"arango": {"ä": [1.5, None]}}, "log": ENTRIES,
+            "compaction": {"_key": "ö", "readDB": [{}]}}
+    data = json.dumps(dump, ensure_ascii=False).encode()
+    stream, entries, _ = read(data)
+    assert entries == ENTRIES
+    assert stream.object and stream.logAttribute == "log"
+    assert stream.fields == {key: value for key, value in dump.items() if not key == "log"}
+    for key, (start, end) in stream.fieldSpans.items():
+        assert json.loads(data[start:end]) == dump[key]
+
+
+@pytest.mark.parametrize("data", [b"[]", b" [ ] ", b"{}", b"{\"log\": []}"])
+def test_empty(chunk, data):
+    _, entries, _ = read(data)
+    assert entries == []
+
+
+@pytest.mark.parametrize("data", [b"[{\"_key\": 1}", b"[{\"_key\": 1} {}]", b"[1,", b"", b"{\"log\" []}"])
+def test_broken(chunk, data):
+    with pytest.raises(json.JSONDecodeError):
+        read(data)
+
+
+@pytest.mark.parametrize("broken, at", [(b"{\"a\": 1 \"b\": 2}", b"\"b\""), (b"{\"a\": tru}", b"tru"),
+                                        (b"{\"a\": [1, 2}", b"}")])
+def test_broken_entry_is_not_read_past(monkeypatch, broken, at):
+    # the rest of the file is not read to find out that an entry is broken
+    monkeypatch.setattr(logstream.LogStream, "CHUNK", 64)
+    head = b"[" + json.dumps(ENTRIES[:3], ensure_ascii=False).encode()[1:-1] + b", "
+    data = head + broken + b", " + json.dumps(ENTRIES * 100).encode()[1:]
+    stream = logstream.LogStream(io.BytesIO(data))
+    with pytest.raises(json.JSONDecodeError) as e:
+        list(stream.entries())
+    assert stream.bytesRead < 1024
+    assert "at byte {} of the file".format(len(head) + broken.index(at)) in str(e.value)
@@ -0,0 +1,157 @@
+import io
+import json
+import os
+
+import pytest
+
+import logstream
+import logtable
+from examples import example
+
+
+def odd(log):
+    # entries with keys and terms that do not fit into the arrays, the odd
+    # key still sorts first
+    log = [dict(entry) for entry in log]
+    log[0]["_key"] = "0"
+    log[1]["term"] = 2 ** 70
+    log[2]["term"] = None
+    return log
+
+
+def columns(log):
+    return [(log.key(i), log.term(i), log.time(i), log.clientId(i), log.requestPaths(i)) for i in range(len(log))]
+
+
+def assertSame(log, entries):
+    assert len(log) == len(entries)
+    assert [log[i] for i in range(len(log))] == entries
+    assert columns(log) == columns(logtable.LogTable(entries))
+
+
+def test_extend():
+    entries = odd(example("small.json"))
+    log = logtable.LogTable(entries[:10])
+    log.extend(entries[10:])
+    assertSame(log, entries)
+    # _key and _id are not kept, but come back at their place, only the _id
+    # of the odd key does not follow from it
+    assert [log.raw(i) for i in range(len(log))] == [json.dumps(entry).encode() for entry in entries]
+    rest = {k: v for k, v in entries[5].items() if not k in ("_key", "_id")}
+    assert log.data[log.offsets[5]:log.offsets[6]] == json.dumps(rest).encode()
+    assert log.data.startswith(b'{"_id"')
+
+
+def test_extend_with_texts():
+    entries = odd(example("small.json"))
+    stream = logstream.LogStream(io.BytesIO(json.dumps(entries[50:] + entries[:50], indent=1).encode()))
+    loaded, texts = [], []
+    for entry in stream.entries():
+        loaded.append(entry)
+        texts.append(stream.raw)
+    log = logtable.LogTable(loaded, texts)
+    assert [log.raw(i) for i in range(len(log))] == texts
+    assertSame(log.sortedByKey(), entries)
+
+
+@pytest.mark.parametrize("shape", ["list", "result", "dump"])
+def test_mapped(tmp_path, shape):
+    entries = odd(example("small.json"))
+    if shape == "list":
+        content = entries
+    elif shape == "result":
+        content = {"result": entries}
+    else:
+        content = {"index": 5, "agency": {"a": 1}, "log": entries, "compaction": {"_key": "1"}}
+    path = tmp_path / "log.json"
+    path.write_text(json.dumps(content, indent=2))
+    index = tmp_path / "index"
+
+    scanned = logtable.MappedLogTable(str(path), str(index))
+    indexed = logtable.MappedLogTable(str(path), str(index))
+    assert not scanned.indexed and indexed.indexed
+    for log in [scanned, indexed]:
+        assertSame(log, entries)
+        assert log.object == (not shape == "list")
+        if shape == "dump":
+            assert log.field("index") == 5 and log.field("compaction") == {"_key": "1"}
+        log.close()
+    # nothing is written next to the log without an index directory
+    assert not logtable.MappedLogTable(str(path)).indexed
+    assert sorted(os.listdir(tmp_path)) == ["index", "log.json"]
+
+
+def test_mapped_sorts_by_key(tmp_path):
+    entries = example("small.json")
+    path = tmp_path / "log.json"
+    path.write_text(json.dumps(entries[50:] + entries[:50]))
+    log = logtable.MappedLogTable(str(path))
+    assertSame(log, entries)
+    log.close()
+
+
+def test_mapped_index_beyond_the_file(tmp_path):
+    entries = example("small.json")
+    path = tmp_path / "log.json"
+    path.write_text(json.dumps(entries))
+    log = logtable.MappedLogTable(str(path), str(tmp_path))
+    name = log.indexPath()
+    log.close()
+    with open(name, "rb") as f:
+        fields, table = logtable.unpackColumns(f.read(), logtable.TABLE_COLUMNS)
+    table[1][-1] = 2 ** 40
+    with open(name, "wb") as f:
+        f.write(logtable.packColumns(fields, table))
+    log = logtable.MappedLogTable(str(path), str(tmp_path))
+    assert not log.indexed
+    assertSame(log, entries)
+    log.close()
+
+
+def test_container(tmp_path):
+    entries = odd(example("small.json"))
+    snapshots = [{"_key": "1", "readDB": [{"a": 1}]}]
+    path = str(tmp_path / "log.aaa")
+    logtable.writeContainer(path, logtable.LogTable(entries), snapshots, (5, {"a": 1}))
+    assert logtable.isContainer(path)
+    log = logtable.ContainerLogTable(path)
+    assertSame(log, entries)
+    # compactions are loaded when more than their key is read
+    assert log.snapshots[0]["_key"] == "1" and log.snapshots[0].value is None
+    assert log.snapshots == snapshots
+    assert log.agencyState() == (5, {"a": 1})
+
+    # a container of a log that is not json.dumps of its entries
+    other = str(tmp_path / "other.aaa")
+    logtable.writeContainer(other, log, snapshots, None)
+    log.close()
+    log = logtable.ContainerLogTable(other)
+    assertSame(log, entries)
+    assert log.snapshots == snapshots
+    assert log.agencyState() is None
+    log.close()
+
+
+def test_broken_container(tmp_path):
+    path = str(tmp_path / "log.aaa")
+    logtable.writeContainer(path, logtable.LogTable(example("small.json")), [], None)
+    with open(path, "rb") as f:
+        data = f.read()
+    for broken in [data[:len(data) // 2], data[:len(logtable.CONTAINER_MAGIC) + 8] + bytes(100)]:
+        with open(path, "wb") as f:
+            f.write(broken)
+        with pytest.raises(ValueError):
+            logtable.ContainerLogTable(path)
+
+    # a broken text of a compaction is found when it is loaded
+    logtable.writeContainer(path, logtable.LogTable(example("small.json")), [{"_key": "1", "readDB": [{}]}], None)
+    log = logtable.ContainerLogTable(path)
+    start, end = log.snapshots[0].span
+    log.close()
+    with open(path, "r+b") as f:
+        f.seek(start)
+        f.write(bytes(end - start))
+    log = logtable.ContainerLogTable(path)
+    with pytest.raises(ValueError):
+        log.snapshots[0]["readDB"]
+    log.close()
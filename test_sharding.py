@@ -0,0 +1,53 @@
+import agency
+import sharding
+from examples import example
+
+
+def test_sharded_replay_equals_serial():
+    log = example("agency-dump.json")
+    # a barrier: an operation on a parent of the shards, and a key with a
+    # ttl in the rest
+    log[len(log) // 2] = dict(log[len(log) // 2], request={"arango/Marker": {"op": "set", "new": 1, "ttl": 5}})
+    log[len(log) // 3] = dict(log[len(log) // 3], request={"arango": {"op": "update", "val": {"Marker": 0}}})
+    programs = [agency.AgencyStore.compile(entry["request"]) for entry in log]
+    paths = [tuple(agency.AgencyStore.pathPrefix(record[2]) for record in program) for program in programs]
+    times = agency.AgencyStore.logTimes(log)
+
+    serial = agency.AgencyStore()
+    trees = []
+    for program, now in zip(programs, times):
+        serial.run(program, now)
+        trees.append(agency.AgencyStore.copyFrom(serial))
+
+    def runEntry(store, idx):
+        store.run(programs[idx], times[idx])
+
+    replay = sharding.ShardedReplay()
+    done = []
+    try:
+        # the store after each batch and barrier, like the checkpoints of
+        # StoreProvider
+        for last, _ in replay.replay(agency.AgencyStore(), 0, len(log) - 1, programs.__getitem__,
+                                     paths.__getitem__, times, runEntry):
+            done.append((last, replay.assemble()))
+    finally:
+        replay.close()
+    assert done[-1][0] == len(log) - 1
+    assert len(done) > 2
+    for last, sharded in done:
+        assert sharded.store == trees[last].store
+        assert sharded.ttl.deadlines == trees[last].ttl.deadlines
+
+
+def test_workers_stop_without_their_replay():
+    replay = sharding.ShardedReplay()
+    replay.start()
+    processes = list(replay.processes)
+    # the replay is gone without close, e.g. the app exited at once
+    for conn in replay.conns:
+        conn.close()
+    for process in processes:
+        process.join(10)
+        assert not process.is_alive()
+    replay.conns = []
+    replay.close()